@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Optional
+
+# Приоритеты работы с моделью: меньше — важнее
+PRIORITY_UPDATE = 0    # отметка покупок и правки существующего списка
+PRIORITY_NEW_LIST = 1  # новый список
+PRIORITY_CHAT = 2      # болтовня и все остальное
+
+PRIORITY_NAMES = {PRIORITY_UPDATE: "update", PRIORITY_NEW_LIST: "new_list", PRIORITY_CHAT: "chat"}
+
+BUSY_MESSAGES = {
+    "ru": "⏳ Сейчас очень много запросов. Попробуй еще раз через минуту.",
+    "uz": "⏳ Hozir so'rovlar juda ko'p. Bir daqiqadan keyin qayta urinib ko'ring.",
+}
+
+_CYRILLIC_RE = re.compile("[а-яё]", re.IGNORECASE)
+
+
+def busy_message(text: str = "") -> str:
+    """Сообщение "занято" на языке пользователя (кириллица — русский, иначе узбекский)"""
+    return BUSY_MESSAGES["ru" if not text or _CYRILLIC_RE.search(text) else "uz"]
+
+
+class Overloaded(Exception):
+    """Работа не дождалась слота до дедлайна и была сброшена"""
+
+    def __init__(self, priority: int):
+        super().__init__(f"LLM admission queue deadline exceeded (priority {PRIORITY_NAMES.get(priority, priority)})")
+        self.priority = priority
+
+
+class _AdmissionBase:
+    """Общие настройки и метрики контроллеров допуска"""
+
+    def __init__(self, name: str, max_concurrent: int, queue_deadline: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.queue_deadline = queue_deadline
+        self.active = 0
+        self.admitted: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+        self.shed: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+        self.queued: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+        self.wait_seconds_total = 0.0
+        self._seq = itertools.count()
+        self._user_queued: Dict[int, int] = {}
+
+    def _user_rank(self, user_id: Optional[int]) -> int:
+        """Сколько запросов пользователя уже ждет: его следующий запрос встает за чужими"""
+        if user_id is None:
+            return 0
+        rank = self._user_queued.get(user_id, 0)
+        self._user_queued[user_id] = rank + 1
+        return rank
+
+    def _user_done(self, user_id: Optional[int]):
+        if user_id is None:
+            return
+        left = self._user_queued[user_id] - 1
+        if left:
+            self._user_queued[user_id] = left
+        else:
+            del self._user_queued[user_id]
+
+    def _record_admit(self, priority: int, waited: float):
+        self.admitted[priority] = self.admitted.get(priority, 0) + 1
+        self.wait_seconds_total += waited
+
+    def _record_shed(self, priority: int):
+        self.shed[priority] = self.shed.get(priority, 0) + 1
+
+    def snapshot(self) -> Dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": {PRIORITY_NAMES[p]: n for p, n in self.queued.items()},
+            "admitted": {PRIORITY_NAMES[p]: n for p, n in self.admitted.items()},
+            "shed": {PRIORITY_NAMES[p]: n for p, n in self.shed.items()},
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+        }
+
+    def render_metrics(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        prefix = f"{self.name}_admission"
+        lines: List[str] = [
+            f"# TYPE {prefix}_active gauge",
+            f"{prefix}_active {self.active}",
+            f"# TYPE {prefix}_max_concurrent gauge",
+            f"{prefix}_max_concurrent {self.max_concurrent}",
+            f"# TYPE {prefix}_queue_depth gauge",
+        ]
+        lines += [f'{prefix}_queue_depth{{priority="{PRIORITY_NAMES[p]}"}} {n}' for p, n in self.queued.items()]
+        lines.append(f"# TYPE {prefix}_admitted_total counter")
+        lines += [f'{prefix}_admitted_total{{priority="{PRIORITY_NAMES[p]}"}} {n}' for p, n in self.admitted.items()]
+        lines.append(f"# TYPE {prefix}_shed_total counter")
+        lines += [f'{prefix}_shed_total{{priority="{PRIORITY_NAMES[p]}"}} {n}' for p, n in self.shed.items()]
+        lines.append(f"# TYPE {prefix}_wait_seconds_total counter")
+        lines.append(f"{prefix}_wait_seconds_total {self.wait_seconds_total:.3f}")
+        return "\n".join(lines) + "\n"
+
+
+class AdmissionController(_AdmissionBase):
+    """Ограничивает число одновременных запросов к модели в asyncio-процессе.
+
+    Если свободных слотов нет, работа ждет в очереди по приоритету. При равном
+    приоритете запросы разных пользователей чередуются: k-й ждущий запрос
+    пользователя встает после (k-1)-х запросов остальных, так что один активный
+    пользователь не растит задержку всем. Не дождавшись слота за queue_deadline секунд,
+    получает Overloaded, и пользователю сразу отвечают "попробуй позже".
+    """
+
+    def __init__(self, name: str, max_concurrent: int, queue_deadline: float):
+        super().__init__(name, max_concurrent, queue_deadline)
+        self._waiters: List = []
+
+    async def acquire(self, priority: int, user_id: Optional[int] = None):
+        # Сброшенные по дедлайну ожидания убираем лениво
+        while self._waiters and self._waiters[0][-1].done():
+            heapq.heappop(self._waiters)
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self._record_admit(priority, 0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._user_rank(user_id), next(self._seq), future))
+        self.queued[priority] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.queue_deadline)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # release() мог передать нам слот одновременно с отменой или дедлайном — отдаем его дальше
+            if future.done() and not future.cancelled():
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._record_shed(priority)
+            raise Overloaded(priority)
+        finally:
+            self.queued[priority] -= 1
+            self._user_done(user_id)
+        # Слот передан нам в release(), active уже учтен
+        self._record_admit(priority, time.monotonic() - started)
+
+    def release(self):
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[-1]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int, user_id: Optional[int] = None):
+        await self.acquire(priority, user_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class ThreadAdmissionController(_AdmissionBase):
+    """То же, что AdmissionController, для многопоточных серверов (Flask)"""
+
+    def __init__(self, name: str, max_concurrent: int, queue_deadline: float):
+        super().__init__(name, max_concurrent, queue_deadline)
+        self._waiters: List = []
+        self._condition = threading.Condition()
+
+    def acquire(self, priority: int, user_id: Optional[int] = None):
+        with self._condition:
+            while self._waiters and self._waiters[0][-1] is not None:
+                heapq.heappop(self._waiters)
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                self._record_admit(priority, 0.0)
+                return
+
+            # [приоритет, очередь пользователя, порядок, статус]:
+            # статус "granted" ставит release(), "shed" — сам ждущий
+            entry = [priority, self._user_rank(user_id), next(self._seq), None]
+            heapq.heappush(self._waiters, entry)
+            self.queued[priority] += 1
+            started = time.monotonic()
+            deadline = started + self.queue_deadline
+            try:
+                while entry[-1] is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        entry[-1] = "shed"
+                        self._record_shed(priority)
+                        raise Overloaded(priority)
+                    self._condition.wait(remaining)
+            finally:
+                self.queued[priority] -= 1
+                self._user_done(user_id)
+            self._record_admit(priority, time.monotonic() - started)
+
+    def release(self):
+        with self._condition:
+            while self._waiters:
+                entry = heapq.heappop(self._waiters)
+                if entry[-1] is None:
+                    entry[-1] = "granted"
+                    self._condition.notify_all()
+                    return
+            self.active -= 1
+
+    @contextmanager
+    def slot(self, priority: int, user_id: Optional[int] = None):
+        self.acquire(priority, user_id)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,151 @@
+import heapq
+from array import array
+from datetime import date
+from typing import Dict, List, Tuple
+
+
+def _parse_day(value: str) -> date:
+    """Достает дату из строки формата "%Y-%m-%d %H:%M:%S" """
+    return date.fromisoformat(value[:10])
+
+
+def _month_key(day: date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def _month_label(key: int) -> str:
+    return f"{key // 12}-{key % 12 + 1:02d}"
+
+
+class ExpenseAnalytics:
+    """Колоночное хранилище купленных товаров с предрасчитанными агрегатами.
+
+    Каждая позиция покупки хранится как строка в параллельных массивах
+    (пользователь, день, категория, продукт, цена). Категории и продукты
+    кодируются словарями, поэтому колонки остаются компактными массивами чисел.
+    Дневные и месячные суммы по пользователю и категории обновляются при
+    добавлении записи, так что запросы /stats не сканируют историю.
+    """
+
+    def __init__(self):
+        # Колонки
+        self.users = array('q')
+        self.days = array('l')
+        self.categories = array('l')
+        self.products = array('l')
+        self.prices = array('q')
+
+        # Словари кодирования
+        self._category_names: List[str] = []
+        self._category_codes: Dict[str, int] = {}
+        self._product_names: List[str] = []
+        self._product_codes: Dict[str, int] = {}
+
+        # Предрасчитанные агрегаты по пользователю
+        self._daily: Dict[int, Dict[Tuple[int, int], int]] = {}
+        self._monthly: Dict[int, Dict[Tuple[int, int], int]] = {}
+        self._monthly_totals: Dict[int, Dict[int, int]] = {}
+        self._category_totals: Dict[int, Dict[int, int]] = {}
+        self._product_totals: Dict[int, Dict[int, List[int]]] = {}
+        self._purchase_counts: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def _encode_category(self, category: str) -> int:
+        code = self._category_codes.get(category)
+        if code is None:
+            code = len(self._category_names)
+            self._category_names.append(category)
+            self._category_codes[category] = code
+        return code
+
+    def _encode_product(self, product: str) -> int:
+        key = product.strip().lower()
+        code = self._product_codes.get(key)
+        if code is None:
+            code = len(self._product_names)
+            self._product_names.append(product.strip())
+            self._product_codes[key] = code
+        return code
+
+    def add_record(self, user_id: int, record: Dict):
+        """Добавляет одну запись истории покупок и обновляет агрегаты"""
+        user_id = int(user_id)
+        day = _parse_day(record["date"])
+        day_key = day.toordinal()
+        month_key = _month_key(day)
+
+        daily = self._daily.setdefault(user_id, {})
+        monthly = self._monthly.setdefault(user_id, {})
+        monthly_totals = self._monthly_totals.setdefault(user_id, {})
+        category_totals = self._category_totals.setdefault(user_id, {})
+        product_totals = self._product_totals.setdefault(user_id, {})
+        self._purchase_counts[user_id] = self._purchase_counts.get(user_id, 0) + 1
+
+        for item in record.get("items", []):
+            # Цена, подставленная из индекса цен, — оценка, а не расход
+            if item.get("estimated"):
+                continue
+            price = int(item.get("price", 0))
+            category_code = self._encode_category(item.get("category", ""))
+            product_code = self._encode_product(item.get("product", ""))
+
+            self.users.append(user_id)
+            self.days.append(day_key)
+            self.categories.append(category_code)
+            self.products.append(product_code)
+            self.prices.append(price)
+
+            daily[(day_key, category_code)] = daily.get((day_key, category_code), 0) + price
+            monthly[(month_key, category_code)] = monthly.get((month_key, category_code), 0) + price
+            monthly_totals[month_key] = monthly_totals.get(month_key, 0) + price
+            category_totals[category_code] = category_totals.get(category_code, 0) + price
+
+            totals = product_totals.get(product_code)
+            if totals is None:
+                product_totals[product_code] = [price, 1]
+            else:
+                totals[0] += price
+                totals[1] += 1
+
+    def purchase_count(self, user_id: int) -> int:
+        return self._purchase_counts.get(user_id, 0)
+
+    def category_spend(self, user_id: int) -> List[Tuple[str, int]]:
+        """Расходы по категориям за все время, по убыванию"""
+        totals = self._category_totals.get(user_id, {})
+        return sorted(((self._category_names[code], spent) for code, spent in totals.items()),
+                      key=lambda pair: pair[1], reverse=True)
+
+    def monthly_trend(self, user_id: int, months: int = 6) -> List[Tuple[str, int]]:
+        """Суммы за последние месяцы с покупками, от старых к новым"""
+        totals = self._monthly_totals.get(user_id, {})
+        keys = heapq.nlargest(months, totals)
+        return [(_month_label(key), totals[key]) for key in sorted(keys)]
+
+    def monthly_category_spend(self, user_id: int, year: int, month: int) -> List[Tuple[str, int]]:
+        """Расходы по категориям за конкретный месяц"""
+        key = year * 12 + month - 1
+        monthly = self._monthly.get(user_id, {})
+        result = [(self._category_names[code], monthly[(key, code)])
+                  for code in self._category_totals.get(user_id, {})
+                  if (key, code) in monthly]
+        return sorted(result, key=lambda pair: pair[1], reverse=True)
+
+    def daily_spend(self, user_id: int, day: date) -> int:
+        """Сумма расходов за один день"""
+        day_key = day.toordinal()
+        daily = self._daily.get(user_id, {})
+        return sum(daily.get((day_key, code), 0) for code in self._category_totals.get(user_id, {}))
+
+    def recent_spend(self, user_id: int, today: date, days: int = 7) -> int:
+        """Сумма расходов за последние days дней, включая today"""
+        last = today.toordinal()
+        return sum(self.daily_spend(user_id, date.fromordinal(day_key)) for day_key in range(last - days + 1, last + 1))
+
+    def top_products(self, user_id: int, limit: int = 5) -> List[Tuple[str, int, int]]:
+        """Продукты с наибольшими расходами: (название, сумма, количество покупок)"""
+        totals = self._product_totals.get(user_id, {})
+        top = heapq.nlargest(limit, totals.items(), key=lambda pair: pair[1][0])
+        return [(self._product_names[code], spent, count) for code, (spent, count) in top]
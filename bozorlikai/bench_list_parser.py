@@ -0,0 +1,206 @@
+"""Фазз-проверка и микробенчмарк list_parser против прежнего трехпроходного разбора.
+
+1. Для корпуса ответов модели (ручные крайние случаи + случайно сгенерированные)
+   проверяет, что ListParser дает тот же результат, что и прежний путь
+   (поиск эмодзи/слов -> fix_list_formatting -> parse_shopping_list), в том
+   числе при подаче текста случайными кусками.
+2. Сравнивает время обоих вариантов.
+
+Пример:
+    python bench_list_parser.py --cases 2000 --repeat 5
+"""
+import argparse
+import random
+import timeit
+from typing import Dict, List, Tuple
+
+from list_parser import ListParser, parse_list_output
+
+# --- Прежний путь из main.py, сохранен как эталон ---
+
+LEGACY_EMOJIS = ['🥕', '🍎', '🥛', '🍖', '📦', '🥤', '🧴', '📝']
+LEGACY_WORDS = ['овощи:', 'фрукты:', 'молочные:', 'мясо:', 'бакалея:', 'напитки:', 'химия:', 'другое:']
+
+
+def legacy_fix_list_formatting(text: str) -> str:
+    lines = text.split('\n')
+    fixed_lines = []
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            fixed_lines.append("")
+            continue
+
+        if line.lower().startswith('овощи') and line.endswith(':'):
+            fixed_lines.append("🥕 Овощи:")
+        elif line.lower().startswith('фрукты') and line.endswith(':'):
+            fixed_lines.append("🍎 Фрукты:")
+        elif any(word in line.lower() for word in ['молочные', 'молоко']) and line.endswith(':'):
+            fixed_lines.append("🥛 Молочные продукты:")
+        elif any(word in line.lower() for word in ['мясо', 'рыба']) and line.endswith(':'):
+            fixed_lines.append("🍖 Мясо и рыба:")
+        elif line.lower().startswith('бакалея') and line.endswith(':'):
+            fixed_lines.append("📦 Бакалея:")
+        elif line.lower().startswith('напитки') and line.endswith(':'):
+            fixed_lines.append("🥤 Напитки:")
+        elif line.lower().startswith('химия') and line.endswith(':'):
+            fixed_lines.append("🧴 Химия:")
+        elif line.lower().startswith('другое') and line.endswith(':'):
+            fixed_lines.append("📝 Другое:")
+        elif line.startswith('-'):
+            fixed_line = '•' + line[1:]
+            fixed_lines.append(fixed_line)
+        else:
+            fixed_lines.append(line)
+
+    return '\n'.join(fixed_lines)
+
+
+def legacy_parse_shopping_list(text: str) -> Dict[str, List[Tuple[str, str, bool, int]]]:
+    categories = {}
+    current_category = None
+
+    lines = text.split('\n')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if any(emoji in line for emoji in LEGACY_EMOJIS) and line.endswith(':'):
+            current_category = line[:-1]
+            categories[current_category] = []
+        elif (line.startswith('•') or line.startswith('-')) and current_category:
+            if line.startswith('-'):
+                line = '•' + line[1:]
+
+            product_line = line[1:].strip()
+            if '—' in product_line:
+                product, quantity = product_line.split('—', 1)
+                product = product.strip()
+                quantity = quantity.strip()
+            elif '-' in product_line:
+                product, quantity = product_line.split('-', 1)
+                product = product.strip()
+                quantity = quantity.strip()
+            else:
+                product = product_line
+                quantity = ""
+            categories[current_category].append((product, quantity, False, 0))
+
+    return categories
+
+
+def legacy_parse(response: str):
+    if any(emoji in response for emoji in LEGACY_EMOJIS) or any(word in response.lower() for word in LEGACY_WORDS):
+        response = legacy_fix_list_formatting(response)
+        return True, response, legacy_parse_shopping_list(response)
+    return False, None, None
+
+
+# --- Корпус ---
+
+SEED_CORPUS = [
+    "",
+    "Привет! Что нужно купить сегодня?",
+    "Извините, я могу помочь только со списком базара.",
+    "🥕 Овощи:\n• Лук — 1 кг\n• Морковь — 2 кг\n\n🥛 Молочные продукты:\n• Молоко — 1 литр",
+    "Овощи:\n- Лук - 1 кг\n- Морковь\nФрукты:\n- Яблоко —\n",
+    "Бакалея и молоко:\n- Сухое молоко — 1 пачка",
+    "Мясо молоко:\n• Кефир",
+    "- молоко:\n- Сыр",
+    "• 🥕 морковь:\n• Лук — 1",
+    "🥕 Овощи:\n• Лук — 1 кг\n🥕 Овощи:\n• Картошка — 3 кг",
+    "  📝 Другое:  \r\n  • Батарейки —  4 шт  \r\n",
+    "Товары:\n• Хлеб — 1\nДругое:\n-Соль-1 пачка",
+    "🧴 Химия:\n• Порошок — 1 — большой\n• Мыло-детское - 2",
+    "Напитки:\n\n\n• Вода — 5 л\n:\n•",
+    "МЯСО И РЫБА:\n- Курица — 1 кг\n- Рыба-\n",
+    "Вот ваш список:\n🍎 Фрукты:\n• Бананы — 1 кг\nСпасибо!",
+]
+
+HEADERS = ["🥕 Овощи:", "🍎 Фрукты:", "🥛 Молочные продукты:", "🍖 Мясо и рыба:", "📦 Бакалея:", "🥤 Напитки:",
+           "🧴 Химия:", "📝 Другое:", "Овощи:", "фрукты:", "Молочные:", "Мясо:", "бакалея:", "Напитки:", "ХИМИЯ:",
+           "Другое:", "Рыба и молоко:", "Категория:", "Список:"]
+PRODUCTS = ["Лук", "Морковь", "Молоко", "Хлеб", "Курица", "Рис", "Сахар", "Вода", "Мыло", "Яйца", "Сыр", "Кофе",
+            "Помидоры", "Чай", "Масло", "Мясо", "Рыба", "Соль"]
+QUANTITIES = ["1 кг", "2 кг", "1 литр", "", "10 шт", "0.5 кг", "3 пачки", "1-2 кг"]
+BULLETS = ["• ", "- ", "•", "-", "", "* "]
+SEPARATORS = [" — ", " - ", "—", "-", " ", " — — "]
+NOISE = ["Привет!", "Вот список:", "Хорошего дня!", ":", "—", "  ", "Категория: овощи", "🥕", "- :"]
+
+
+def random_response(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randint(0, 6)):
+        if rng.random() < 0.2:
+            lines.append(rng.choice(NOISE))
+        lines.append(rng.choice(HEADERS))
+        for _ in range(rng.randint(0, 6)):
+            line = rng.choice(BULLETS) + rng.choice(PRODUCTS) + rng.choice(SEPARATORS) + rng.choice(QUANTITIES)
+            if rng.random() < 0.2:
+                line = " " * rng.randint(1, 4) + line + " " * rng.randint(0, 3)
+            lines.append(line)
+        if rng.random() < 0.5:
+            lines.append("")
+    newline = "\r\n" if rng.random() < 0.1 else "\n"
+    return newline.join(lines)
+
+
+def random_chunks(rng: random.Random, text: str) -> List[str]:
+    cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, 8)))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def check_equivalence(corpus: List[str], rng: random.Random) -> int:
+    mismatches = 0
+    for text in corpus:
+        is_list, fixed, categories = legacy_parse(text)
+        result = parse_list_output(text)
+
+        parser = ListParser()
+        for chunk in random_chunks(rng, text):
+            parser.feed(chunk)
+        chunked = parser.close()
+
+        for candidate in (result, chunked):
+            same = candidate.is_list == is_list and (
+                not is_list or (candidate.text == fixed and candidate.categories == categories))
+            if not same:
+                mismatches += 1
+                print(f"MISMATCH for {text!r}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz and benchmark list_parser against the legacy path")
+    parser.add_argument("--cases", type=int, default=2000, help="number of generated responses")
+    parser.add_argument("--repeat", type=int, default=5, help="benchmark repetitions")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = SEED_CORPUS + [random_response(rng) for _ in range(args.cases)]
+
+    mismatches = check_equivalence(corpus, rng)
+    print(f"Equivalence: {len(corpus)} responses, {mismatches} mismatches")
+
+    def run_legacy():
+        for text in corpus:
+            legacy_parse(text)
+
+    def run_single_pass():
+        for text in corpus:
+            parse_list_output(text)
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=args.repeat))
+    single_pass = min(timeit.repeat(run_single_pass, number=1, repeat=args.repeat))
+    per_item = 1e6 / len(corpus)
+    print(f"legacy three-pass: {legacy * per_item:8.2f} us/response")
+    print(f"single-pass:       {single_pass * per_item:8.2f} us/response")
+    print(f"speedup:           {legacy / single_pass:8.2f}x")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
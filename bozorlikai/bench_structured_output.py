@@ -0,0 +1,110 @@
+"""Оценка разбора ответов модели: прежний json.loads против JSONExtractor.
+
+1. Генерирует ответы на покупки и правки в прежнем формате (name/price,
+   action/old_product/...) и в коротком формате схемы (b/n/p, c/a/o/n/q).
+2. Портит часть ответов так, как это бывает у модели: пояснение вокруг JSON,
+   ```json, висячая запятая, оборванный конец.
+3. Печатает долю ответов, которые не разобрались бы (пользователю пришлось бы
+   повторять сообщение), и средний размер ответа в символах — выходные
+   токены растут вместе с ним.
+
+Реальные показатели в проде — на /metrics (bot_structured_output_*), там же
+видно, сколько ответов в режиме json_schema вообще пришлось чинить.
+
+Пример:
+    python bench_structured_output.py --cases 5000 --corrupt 0.1
+"""
+import argparse
+import json
+import random
+from typing import Callable, Dict, List, Tuple
+
+from structured_output import extract_json, normalize_edit_changes, normalize_purchases
+
+PRODUCTS = ["молоко", "хлеб", "картошка", "яблоки", "красная рыба", "сыр", "гречка", "помидоры", "лук", "кефир"]
+QUANTITIES = ["", "1 кг", "2 кг", "1 литр", "3 шт", "500 г"]
+
+
+def purchase_payloads(rng: random.Random) -> Tuple[Dict, Dict]:
+    bought = rng.sample(PRODUCTS, rng.randint(0, 3))
+    prices = [rng.choice([0, 5000, 12000, 25000, 80000]) for _ in bought]
+    legacy = {"products": [{"name": name, "price": price} for name, price in zip(bought, prices)]}
+    compact = {"b": [{"n": name, "p": price} for name, price in zip(bought, prices)]}
+    return legacy, compact
+
+
+def edit_payloads(rng: random.Random) -> Tuple[Dict, Dict]:
+    legacy, compact = [], []
+    for _ in range(rng.randint(1, 3)):
+        action = rng.choice(["add", "remove", "replace"])
+        old = rng.choice(PRODUCTS) if action != "add" else ""
+        new = rng.choice(PRODUCTS) if action != "remove" else ""
+        quantity = rng.choice(QUANTITIES) if action != "remove" else ""
+        legacy.append({"action": action, "old_product": old, "new_product": new, "quantity": quantity})
+        compact.append({"a": action, "o": old, "n": new, "q": quantity})
+    return {"changes": legacy}, {"c": compact}
+
+
+def corrupt(text: str, rng: random.Random) -> str:
+    kind = rng.choice(["prose", "fence", "trailing_comma", "truncate"])
+    if kind == "prose":
+        return f"Вот результат: {text} Надеюсь, помог!"
+    if kind == "fence":
+        return f"```json\n{text}\n```"
+    if kind == "trailing_comma" and text.endswith("]}"):
+        return text[:-2] + ",]}"
+    return text[:rng.randint(len(text) // 2, len(text) - 1)]
+
+
+def legacy_parse(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def run(cases: int, corrupt_share: float, seed: int):
+    rng = random.Random(seed)
+    generators: List[Tuple[str, Callable, Callable]] = [
+        ("purchases", purchase_payloads, normalize_purchases),
+        ("edit_changes", edit_payloads, normalize_edit_changes),
+    ]
+    for name, generate, normalize in generators:
+        legacy_chars = compact_chars = 0
+        legacy_failures = extractor_failures = wrong = 0
+        for _ in range(cases):
+            legacy, compact = generate(rng)
+            legacy_text = json.dumps(legacy, ensure_ascii=False)
+            compact_text = json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
+            legacy_chars += len(legacy_text)
+            compact_chars += len(compact_text)
+
+            broken = rng.random() < corrupt_share
+            legacy_input = corrupt(legacy_text, rng) if broken else legacy_text
+            if legacy_parse(legacy_input) is None:
+                legacy_failures += 1
+            value, _ = extract_json(legacy_input)
+            if value is None:
+                extractor_failures += 1
+            elif not broken and normalize(value) != normalize(legacy):
+                wrong += 1
+
+        print(f"{name}: {cases} responses, {corrupt_share:.0%} corrupted")
+        print(f"  unparseable, json.loads:     {legacy_failures / cases:7.2%}")
+        print(f"  unparseable, JSONExtractor:  {extractor_failures / cases:7.2%}")
+        print(f"  clean responses parsed wrong: {wrong}")
+        print(f"  avg response size: {legacy_chars / cases:6.1f} chars legacy, "
+              f"{compact_chars / cases:6.1f} chars compact ({1 - compact_chars / legacy_chars:.0%} less)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare legacy JSON parsing with the tolerant extractor")
+    parser.add_argument("--cases", type=int, default=5000)
+    parser.add_argument("--corrupt", type=float, default=0.1, help="доля испорченных ответов")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    run(args.cases, args.corrupt, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
 import requests
 import os
+import time
 from dotenv import load_dotenv
 
+from admission import ThreadAdmissionController, Overloaded, PRIORITY_CHAT, busy_message
+from traffic_log import SOURCE_CHAT, TrafficRecorder, mask_text, request_fingerprint
+
 # Load environment variables
 load_dotenv()
 
@@ -13,6 +17,20 @@ CORS(app)  # Enable CORS for frontend to connect
 # Get API key from .env
 SILICONFLOW_API_KEY = os.getenv("SILICONFLOW_API_KEY")
 
+# Limit concurrent SiliconFlow calls; requests that wait longer than the deadline get a "busy" reply
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "8"))
+LLM_QUEUE_DEADLINE = float(os.getenv("LLM_QUEUE_DEADLINE", "10"))
+llm_admission = ThreadAdmissionController("chatbot", LLM_MAX_CONCURRENT, LLM_QUEUE_DEADLINE)
+
+# Opt-in anonymized traffic log for replay_traffic.py (disabled when CHAT_TRAFFIC_LOG is unset)
+CHAT_TRAFFIC_LOG = os.getenv("CHAT_TRAFFIC_LOG")
+traffic_recorder = (TrafficRecorder(CHAT_TRAFFIC_LOG, int(os.getenv("TRAFFIC_LOG_MAX_MB", "50")) * 1024 * 1024,
+                                    salt=os.getenv("TRAFFIC_LOG_SALT"))
+                    if CHAT_TRAFFIC_LOG else None)
+
+# Replacement for requests.post to SiliconFlow; set by replay_traffic.py to serve recorded responses
+llm_transport = None
+
 # System prompt
 SYSTEM_PROMPT = """
 Siz Bozorlik AI chatbot sizisiz. Sizning vazifangiz foydalanuvchilarga savollariga yordam berish.
@@ -40,6 +58,19 @@ QO'SHIMCHA VAZIFA – JAVOB BERISHI SHART BO'LGAN 2 SAVOL:
 2. "Как работает Bozorlik AI?" — кратко опишите процесс: пользователь говорит/пишет → бот формирует список → можно отмечать покупки и цены.
 """
 
+@app.before_request
+def start_timer():
+    g.started = time.time()
+
+
+@app.after_request
+def record_traffic(response):
+    if traffic_recorder is not None and request.path == '/chat':
+        traffic_recorder.record_update(SOURCE_CHAT, request.get_json(silent=True) or {}, g.started,
+                                       time.time() - g.started)
+    return response
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -79,12 +110,21 @@ def chat():
         print(f"[DEBUG] API URL: https://api.siliconflow.com/v1/chat/completions")
         print(f"[DEBUG] Model: {payload['model']}")
         
-        response = requests.post(
-            'https://api.siliconflow.com/v1/chat/completions',
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        post = llm_transport or requests.post
+        with llm_admission.slot(PRIORITY_CHAT):
+            llm_started = time.time()
+            response = post(
+                'https://api.siliconflow.com/v1/chat/completions',
+                headers=headers,
+                json=payload,
+                timeout=30
+            )
+            llm_duration = time.time() - llm_started
+
+        if traffic_recorder is not None:
+            traffic_recorder.record_llm(None, request_fingerprint(payload['model'], payload['messages']),
+                                        {'status': response.status_code, 'body': mask_text(response.text)},
+                                        llm_started, llm_duration)
         
         print(f"[DEBUG] API Response Status: {response.status_code}")
         print(f"[DEBUG] API Response Text: {response.text[:500]}")  # First 500 chars
@@ -99,6 +139,9 @@ def chat():
             print(f"[ERROR] API Error Response: {error_text}")
             return jsonify({'error': f'API error: {response.status_code} - {error_text}'}), 500
             
+    except Overloaded as e:
+        print(f"[WARN] Shedding request: {str(e)}")
+        return jsonify({'response': busy_message(user_message), 'busy': True})
     except requests.exceptions.RequestException as e:
         print(f"[ERROR] Request Error: {str(e)}")
         return jsonify({'error': f'API request failed: {str(e)}'}), 500
@@ -115,6 +158,10 @@ def chat():
 def health():
     return jsonify({'status': 'ok'})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(llm_admission.render_metrics(), mimetype='text/plain')
+
 if __name__ == '__main__':
     if not SILICONFLOW_API_KEY:
         print("WARNING: SILICONFLOW_API_KEY not found in .env file")
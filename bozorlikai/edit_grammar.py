@@ -0,0 +1,228 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from price_index import normalize_product_name
+
+_FLAGS = re.IGNORECASE | re.UNICODE
+
+_APOSTROPHE = r"['ʻ’`]?"
+
+# Русские команды стоят перед объектом: "удали картошку"
+RU_VERB_RE = re.compile(
+    r"\b(?:(?P<add>добавь(?:те)?|добавить|хочу\s+добавить|допиши|впиши)|"
+    r"(?P<remove>удали(?:те|ть)?|убери(?:те)?|убрать|вычеркни(?:те)?|не\s+нужн[оаы]?|не\s+надо)|"
+    r"(?P<replace>замени(?:те|ть)?|поменяй(?:те)?|поменять|измени(?:те|ть)?))\b", _FLAGS)
+
+# Узбекские команды стоят после объекта: "kartoshkani o'chir"
+UZ_VERB_RE = re.compile(
+    rf"\b(?:(?P<add>qo{_APOSTROPHE}sh(?:ing|ib\s+qo{_APOSTROPHE}y)?)|"
+    rf"(?P<remove>o{_APOSTROPHE}chir(?:ing)?|olib\s+tashla(?:ng)?|kerak\s+emas)|"
+    rf"(?P<replace>almashtir(?:ing)?))\b", _FLAGS)
+
+_FILLER_RE = re.compile(
+    r"^[\W\s]*(?:(?:пожалуйста|плиз|ещё|еще|также|тоже|и|а|iltimos|yana|ham|va)\b[\W\s]*)*$", _FLAGS)
+_LEADING_FILLER_RE = re.compile(
+    r"^(?:[\W\s]*\b(?:пожалуйста|ещё|еще|также|тоже|и|а|iltimos|yana|ham|va)\b)*[\W\s]*", _FLAGS)
+_TRAILING_CONNECTOR_RE = re.compile(r"(?:[\s,]+(?:и|а|va|ham|пожалуйста|iltimos))*[\s,.!]*$", _FLAGS)
+
+_CLAUSE_SPLIT_RE = re.compile(r"[;\n!?]+|\.(?!\d)")
+_ITEM_SPLIT_RE = re.compile(r"\s*,\s*|\s+(?:и|va)\s+", _FLAGS)
+_RU_REPLACE_SPLIT_RE = re.compile(r"\s+на\s+", _FLAGS)
+_UZ_REPLACE_RE = re.compile(r"^(?P<old>.+?)(?:ni|ini)\s+(?P<new>.+?)(?:ga|ka|qa)$", _FLAGS)
+
+_NUMBER_WORDS = (r"один|одна|одну|два|две|три|четыре|пять|шесть|семь|восемь|девять|десять|пол|полтора|полторы|"
+                 rf"bir|ikki|uch|to{_APOSTROPHE}rt|besh|olti|yetti|sakkiz|to{_APOSTROPHE}qqiz|o{_APOSTROPHE}n|yarim")
+_UNITS = (r"кг|килограмм\w*|кило|г|гр|грамм\w*|л|литр\w*|мл|шт|штук\w*|пач\w*|бутыл\w*|бан\w*|упаков\w*|"
+          r"десят\w*|kg|kilo\w*|gramm?|litr|dona|ta|quti")
+_QUANTITY = (rf"(?:\d+(?:[.,]\d+)?\s*(?:{_UNITS})?|(?:{_NUMBER_WORDS})\s*(?:{_UNITS})|"
+             rf"полкило|полкилограмма|пол-кило)")
+_TRAILING_QUANTITY_RE = re.compile(rf"\s+(?P<quantity>{_QUANTITY})\.?$", _FLAGS)
+_LEADING_QUANTITY_RE = re.compile(rf"^(?P<quantity>{_QUANTITY})\.?\s+", _FLAGS)
+
+# Окончания косвенных падежей: "огурцов", "картошку", "молоком". Начальную форму по ним
+# надежно не восстановить ("огурцов" -> "огурцы"?), поэтому такие названия решает модель
+_RU_INFLECTED_ENDINGS = ("ую", "юю", "у", "ю", "ов", "ев", "ёв", "ей", "ами", "ями", "ах", "ях", "ом", "ем", "ой",
+                         "ого", "его", "ому", "ему")
+# Узбекские падежные окончания: -ning, -dan, -da, -ga
+_UZ_INFLECTED_ENDINGS = ("ning", "dan", "da", "ga", "ka", "qa")
+# "что-нибудь", "что-то", "кое-что": не продукт, а просьба, которую поймет только модель
+_INDEFINITE_RE = re.compile(r"-(?:нибудь|то|либо)$|^кое-", _FLAGS)
+
+MAX_PRODUCT_WORDS = 4
+
+
+def _is_filler(text: str) -> bool:
+    return _FILLER_RE.match(text) is not None
+
+
+def _clean(text: str) -> str:
+    text = _LEADING_FILLER_RE.sub('', text)
+    return _TRAILING_CONNECTOR_RE.sub('', text).strip()
+
+
+def split_quantity(item: str) -> Tuple[str, str]:
+    """Отделяет количество от названия: "молоко 1 литр" -> ("молоко", "1 литр")"""
+    match = _TRAILING_QUANTITY_RE.search(item) or _LEADING_QUANTITY_RE.search(item)
+    if not match:
+        return item.strip(), ""
+    name = item[:match.start()] + item[match.end():]
+    return name.strip(), match.group("quantity").strip()
+
+
+def _is_inflected(word: str, uzbek: bool) -> bool:
+    word = word.lower()
+    endings = _UZ_INFLECTED_ENDINGS if uzbek else _RU_INFLECTED_ENDINGS
+    return any(len(word) > len(ending) + 2 and word.endswith(ending) for ending in endings)
+
+
+def _strip_uzbek_suffix(name: str, suffixes: Tuple[str, ...]) -> str:
+    for suffix in suffixes:
+        if len(name) > len(suffix) + 2 and name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _valid_name(name: str) -> bool:
+    return bool(name) and re.search(r"[^\W\d_]", name) is not None and len(name.split()) <= MAX_PRODUCT_WORDS
+
+
+def _stem(name: str) -> str:
+    stems = []
+    for word in normalize_product_name(name).split():
+        if len(word) > 4:
+            word = word[:-2]
+        elif len(word) > 3:
+            word = word[:-1]
+        stems.append(word)
+    return " ".join(stems)
+
+
+def _new_product_name(item: str, name: str, products: Dict[str, str], uzbek: bool) -> Optional[str]:
+    """Название нового продукта, если его можно вписать без модели.
+
+    item — название вместе с количеством. Только одно слово в начальной форме,
+    которого еще нет в списке, и не после количества: в "2 кг сахара", "10 яиц"
+    родительный падеж, который по окончанию не отличить от начальной формы
+    ("сахара" и "картошка"). Такие названия, как и "добавь что-нибудь вкусное
+    на ужин", уходят модели.
+    """
+    if _LEADING_QUANTITY_RE.search(item):
+        return None
+    if not _valid_name(name) or len(name.split()) != 1:
+        return None
+    if _INDEFINITE_RE.search(name) or _is_inflected(name, uzbek):
+        return None
+    if resolve_product(name, products) is not None:
+        return None
+    return _capitalize(name)
+
+
+def resolve_product(name: str, products: Dict[str, str]) -> Optional[str]:
+    """Находит продукт из списка по названию в любом падеже.
+
+    Только точное совпадение или совпадение основ всех слов; по началу названия
+    не ищем ("рис" — не "Рисовая мука"). Неоднозначное совпадение — None.
+    """
+    key = normalize_product_name(name)
+    for product in products:
+        if normalize_product_name(product) == key:
+            return product
+    stem = _stem(name)
+    candidates = [product for product in products if _stem(product) == stem]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def _capitalize(name: str) -> str:
+    return name[:1].upper() + name[1:]
+
+
+def _build_changes(action: str, body: str, products: Dict[str, str], uzbek: bool) -> Optional[List[Dict]]:
+    body = _clean(body)
+    if not body:
+        return None
+
+    if action == "replace":
+        if uzbek:
+            match = _UZ_REPLACE_RE.match(body)
+            if not match:
+                return None
+            old_part, new_part = match.group("old"), match.group("new")
+        else:
+            parts = _RU_REPLACE_SPLIT_RE.split(body, maxsplit=1)
+            if len(parts) != 2:
+                return None
+            old_part, new_part = parts
+        old_name, _ = split_quantity(old_part)
+        new_name, quantity = split_quantity(new_part)
+        old_product = resolve_product(old_name, products)
+        new_product = _new_product_name(new_part, new_name, products, uzbek)
+        if old_product is None or new_product is None:
+            return None
+        return [{"action": "replace", "old_product": old_product, "new_product": new_product,
+                 "quantity": quantity or products[old_product]}]
+
+    changes = []
+    for item in _ITEM_SPLIT_RE.split(body):
+        name, quantity = split_quantity(item)
+        if uzbek:
+            name = _strip_uzbek_suffix(name, ("ini", "ni"))
+        if not _valid_name(name):
+            return None
+        if action == "add":
+            new_product = _new_product_name(item, name, products, uzbek)
+            if new_product is None:
+                return None
+            changes.append({"action": "add", "old_product": "", "new_product": new_product,
+                            "quantity": quantity})
+        else:
+            old_product = resolve_product(name, products)
+            if old_product is None:
+                return None
+            changes.append({"action": "remove", "old_product": old_product, "new_product": "", "quantity": ""})
+    return changes
+
+
+def _parse_clause(clause: str, products: Dict[str, str]) -> Optional[List[Dict]]:
+    ru_verbs = list(RU_VERB_RE.finditer(clause))
+    if ru_verbs:
+        if not _is_filler(clause[:ru_verbs[0].start()]):
+            return None
+        bounds = [(verb, verb.end(), next_verb.start() if next_verb else len(clause))
+                  for verb, next_verb in zip(ru_verbs, ru_verbs[1:] + [None])]
+        uzbek = False
+    else:
+        uz_verbs = list(UZ_VERB_RE.finditer(clause))
+        if not uz_verbs or not _is_filler(clause[uz_verbs[-1].end():]):
+            return None
+        starts = [0] + [verb.end() for verb in uz_verbs[:-1]]
+        bounds = [(verb, start, verb.start()) for verb, start in zip(uz_verbs, starts)]
+        uzbek = True
+
+    changes = []
+    for verb, start, end in bounds:
+        parsed = _build_changes(verb.lastgroup, clause[start:end], products, uzbek)
+        if parsed is None:
+            return None
+        changes.extend(parsed)
+    return changes
+
+
+def parse_edit_commands(text: str, products: Dict[str, str]) -> Optional[List[Dict]]:
+    """Разбирает команды редактирования списка без обращения к модели.
+
+    products — текущие продукты списка {название: количество}.
+    Возвращает изменения в формате detect_edit_changes или None, если хотя бы
+    часть сообщения не удалось разобрать (тогда решает модель). Удалить или
+    заменить можно только продукт, найденный в списке, поэтому узбекские
+    команды локально работают лишь для продуктов, записанных по-узбекски:
+    "kartoshkani o'chir" для "Картошка" решает модель.
+    """
+    changes = []
+    for clause in _CLAUSE_SPLIT_RE.split(text):
+        if _is_filler(clause):
+            continue
+        parsed = _parse_clause(clause.strip(), products)
+        if parsed is None:
+            return None
+        changes.extend(parsed)
+    return changes or None
@@ -0,0 +1,183 @@
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS purchases (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    total_cost INTEGER NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS purchases_user_date ON purchases (user_id, date);
+
+CREATE TABLE IF NOT EXISTS purchase_items (
+    purchase_id INTEGER NOT NULL REFERENCES purchases (id),
+    product TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    category TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    estimated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS purchase_items_purchase ON purchase_items (purchase_id);
+
+CREATE TABLE IF NOT EXISTS llm_usage (
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS migration_checkpoints (
+    source TEXT PRIMARY KEY,
+    source_size INTEGER NOT NULL,
+    records_done INTEGER NOT NULL
+);
+"""
+
+
+class ExpenseStore:
+    """Хранилище истории расходов в SQLite.
+
+    Записи имеют тот же вид, что и в shopping_expenses.json:
+    {"date": ..., "total_cost": ..., "items": [{"product", "quantity", "category", "price"[, "estimated"]}]}
+
+    Соединение общее для потоков (бот пишет из фонового потока записи),
+    поэтому все обращения идут под блокировкой.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        # Базы, созданные до появления оцененных цен
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(purchase_items)")}
+        if "estimated" not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE purchase_items ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _insert(self, user_id: int, record: Dict, source: Optional[str] = None):
+        cursor = self.conn.execute(
+            "INSERT INTO purchases (user_id, date, total_cost, source) VALUES (?, ?, ?, ?)",
+            (int(user_id), record["date"], int(record.get("total_cost", 0)), source))
+        self.conn.executemany(
+            "INSERT INTO purchase_items (purchase_id, product, quantity, category, price, estimated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(cursor.lastrowid, item.get("product", ""), item.get("quantity", ""), item.get("category", ""),
+              int(item.get("price", 0)), int(bool(item.get("estimated")))) for item in record.get("items", [])])
+
+    def add_purchase(self, user_id: int, record: Dict):
+        with self._lock, self.conn:
+            self._insert(user_id, record)
+
+    def add_purchases(self, records: Iterable[Tuple[int, Dict]], source: Optional[str] = None):
+        """Вставляет пачку записей одной транзакцией"""
+        with self._lock, self.conn:
+            for user_id, record in records:
+                self._insert(user_id, record, source)
+
+    @staticmethod
+    def _item(product: str, quantity: str, category: str, price: int, estimated: int) -> Dict:
+        item = {"product": product, "quantity": quantity, "category": category, "price": price}
+        if estimated:
+            item["estimated"] = True
+        return item
+
+    def _items(self, purchase_id: int) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT product, quantity, category, price, estimated FROM purchase_items "
+            "WHERE purchase_id = ? ORDER BY rowid", (purchase_id,))
+        return [self._item(*row) for row in rows]
+
+    def user_records(self, user_id: int, limit: Optional[int] = None) -> List[Dict]:
+        """Записи пользователя в хронологическом порядке (последние limit, если задан)"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, date, total_cost FROM purchases WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (int(user_id), -1 if limit is None else limit)).fetchall()
+            return [{"date": date, "total_cost": total_cost, "items": self._items(purchase_id)}
+                    for purchase_id, date, total_cost in reversed(rows)]
+
+    def purchase_count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0]
+
+    def total_cost(self, user_id: int) -> int:
+        with self._lock:
+            row = self.conn.execute("SELECT COALESCE(SUM(total_cost), 0) FROM purchases WHERE user_id = ?",
+                                    (int(user_id),)).fetchone()
+        return row[0]
+
+    def iter_records(self) -> Iterator[Tuple[str, Dict]]:
+        """Все записи по порядку вставки, как пары (user_id, record)"""
+        # Отдельные курсоры на своем соединении: чтение не держит общую блокировку.
+        # closing: соединение закрывается, даже если итерацию бросили на середине
+        with closing(sqlite3.connect(self.path)) as conn:
+            purchases = conn.execute("SELECT id, user_id, date, total_cost FROM purchases ORDER BY id")
+            items = conn.execute(
+                "SELECT purchase_id, product, quantity, category, price, estimated FROM purchase_items "
+                "ORDER BY purchase_id, rowid")
+            item = next(items, None)
+            for purchase_id, user_id, date, total_cost in purchases:
+                record = {"date": date, "total_cost": total_cost, "items": []}
+                while item is not None and item[0] <= purchase_id:
+                    if item[0] == purchase_id:
+                        record["items"].append(self._item(*item[1:]))
+                    item = next(items, None)
+                yield str(user_id), record
+
+    def source_totals(self, source: str) -> Tuple[int, int, int, int]:
+        """(записей, товаров, сумма total_cost, сумма цен товаров) для данных из source"""
+        with self._lock:
+            records, total_cost = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(total_cost), 0) FROM purchases WHERE source = ?",
+                (source,)).fetchone()
+            items, item_prices = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(price), 0) FROM purchase_items "
+                "JOIN purchases ON purchases.id = purchase_items.purchase_id WHERE source = ?", (source,)).fetchone()
+        return records, items, total_cost, item_prices
+
+    def get_checkpoint(self, source: str) -> Optional[Tuple[int, int]]:
+        """(размер исходного файла, сколько записей уже перенесено) или None"""
+        with self._lock:
+            return self.conn.execute("SELECT source_size, records_done FROM migration_checkpoints WHERE source = ?",
+                                     (source,)).fetchone()
+
+    def add_migration_batch(self, records: List[Tuple[int, Dict]], source: str, source_size: int,
+                            records_done: int):
+        """Вставляет пачку и сдвигает контрольную точку в той же транзакции"""
+        with self._lock, self.conn:
+            for user_id, record in records:
+                self._insert(user_id, record, source)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO migration_checkpoints (source, source_size, records_done) VALUES (?, ?, ?)",
+                (source, source_size, records_done))
+
+    def get_llm_usage(self, user_id: int, day: str) -> int:
+        """Токены модели, потраченные пользователем за день (YYYY-MM-DD)"""
+        with self._lock:
+            row = self.conn.execute("SELECT tokens FROM llm_usage WHERE user_id = ? AND day = ?",
+                                    (int(user_id), day)).fetchone()
+        return row[0] if row else 0
+
+    def add_llm_usage(self, user_id: int, day: str, tokens: int):
+        self.add_llm_usage_batch([(user_id, day, tokens)])
+
+    def add_llm_usage_batch(self, rows: Iterable[Tuple[int, str, int]]):
+        """Добавляет расход токенов (user_id, день, токены) одной транзакцией"""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO llm_usage (user_id, day, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, day) DO UPDATE SET tokens = tokens + excluded.tokens",
+                [(int(user_id), day, tokens) for user_id, day, tokens in rows])
@@ -0,0 +1,109 @@
+import codecs
+import json
+import os
+from typing import Dict, Iterator, Tuple
+
+# Размер блока чтения файла в байтах
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+class ExpenseStreamReader:
+    """Потоковое чтение shopping_expenses.json формата {user_id: [records]}.
+
+    Файл читается блоками, в памяти держится только текущий блок и одна
+    запись, поэтому расход памяти не зависит от размера файла.
+    Итерация выдает пары (user_id, record) в порядке следования в файле.
+    """
+
+    def __init__(self, path: str, chunk_size: int = CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.total_bytes = os.path.getsize(path)
+        self.bytes_read = 0
+        self.records_read = 0
+
+        self._decoder = json.JSONDecoder()
+        self._file = None
+        self._text_decoder = None
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Дочитывает следующий блок в буфер. False, если файл закончился"""
+        if self._eof:
+            return False
+        chunk = self._file.read(self.chunk_size)
+        self.bytes_read += len(chunk)
+        if not chunk:
+            self._eof = True
+            self._buf += self._text_decoder.decode(b"", final=True)
+            return False
+        # Отбрасываем уже разобранную часть буфера
+        self._buf = self._buf[self._pos:] + self._text_decoder.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Пропускает пробелы и возвращает следующий символ ('' в конце файла)"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char: str):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at byte ~{self.bytes_read}, found {found!r}")
+        self._pos += 1
+
+    def _decode_value(self):
+        """Разбирает одно JSON-значение, дочитывая файл пока оно не станет полным"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict]]:
+        with open(self.path, 'rb') as f:
+            self._file = f
+            self._text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+            self._buf, self._pos, self._eof = "", 0, False
+            self.bytes_read = self.records_read = 0
+
+            self._expect('{')
+            if self._peek() == '}':
+                return
+            while True:
+                user_id = self._decode_value()
+                self._expect(':')
+                self._expect('[')
+                if self._peek() != ']':
+                    while True:
+                        record = self._decode_value()
+                        self.records_read += 1
+                        yield user_id, record
+                        if self._peek() != ',':
+                            break
+                        self._pos += 1
+                self._expect(']')
+                if self._peek() != ',':
+                    break
+                self._pos += 1
+            self._expect('}')
+
+    @property
+    def progress(self) -> float:
+        """Доля прочитанного файла от 0 до 1"""
+        return self.bytes_read / self.total_bytes if self.total_bytes else 1.0
@@ -0,0 +1,167 @@
+"""Потоковая выгрузка истории расходов в CSV или Parquet.
+
+Источник — база SQLite из EXPENSES_DB (или --db), если она задана, иначе
+shopping_expenses.json (или --input).
+
+Примеры:
+    python export_expenses.py expenses.csv
+    python export_expenses.py expenses.csv --db expenses.db
+    python export_expenses.py expenses.parquet --user 12345 --since 2024-01-01 --until 2024-03-31
+"""
+import argparse
+import csv
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from expense_store import ExpenseStore
+from expense_stream import ExpenseStreamReader
+
+EXPENSES_FILE = "shopping_expenses.json"
+
+COLUMNS = ["user_id", "date", "category", "product", "quantity", "price", "estimated"]
+
+
+class ExpenseStoreReader:
+    """Записи из ExpenseStore с тем же интерфейсом прогресса, что у ExpenseStreamReader"""
+
+    def __init__(self, path: str):
+        self.store = ExpenseStore(path)
+        self.total_records = self.store.purchase_count()
+        self.records_read = 0
+
+    @property
+    def progress(self) -> float:
+        return self.records_read / self.total_records if self.total_records else 1.0
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict]]:
+        for user_id, record in self.store.iter_records():
+            self.records_read += 1
+            yield user_id, record
+
+    def close(self):
+        self.store.close()
+
+
+ExpenseReader = Union[ExpenseStreamReader, ExpenseStoreReader]
+
+
+def iter_expense_rows(reader: ExpenseReader, users: Optional[Set[str]] = None,
+                      since: Optional[str] = None, until: Optional[str] = None) -> Iterator[Dict]:
+    """Разворачивает записи истории в строки по одной на купленный товар.
+
+    since/until — даты в формате YYYY-MM-DD, обе границы включительно.
+    """
+    for user_id, record in reader:
+        if users and user_id not in users:
+            continue
+        day = record.get("date", "")[:10]
+        if (since and day < since) or (until and day > until):
+            continue
+        for item in record.get("items", []):
+            yield {
+                "user_id": user_id,
+                "date": record.get("date", ""),
+                "category": item.get("category", ""),
+                "product": item.get("product", ""),
+                "quantity": item.get("quantity", ""),
+                "price": int(item.get("price", 0)),
+                "estimated": bool(item.get("estimated")),
+            }
+
+
+def iter_chunks(rows: Iterator[Dict], chunk_rows: int) -> Iterator[List[Dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def report_progress(reader: ExpenseReader, rows_written: int):
+    sys.stderr.write(f"\r{reader.progress:6.1%}  records: {reader.records_read}  rows: {rows_written}")
+    sys.stderr.flush()
+
+
+def export_csv(chunks: Iterator[List[Dict]], output: str, reader: ExpenseReader, progress: bool) -> int:
+    rows_written = 0
+    with open(output, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for chunk in chunks:
+            writer.writerows(chunk)
+            rows_written += len(chunk)
+            if progress:
+                report_progress(reader, rows_written)
+    return rows_written
+
+
+def export_parquet(chunks: Iterator[List[Dict]], output: str, reader: ExpenseReader, progress: bool) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet export requires pyarrow: pip install pyarrow")
+
+    schema = pa.schema([
+        ("user_id", pa.string()),
+        ("date", pa.string()),
+        ("category", pa.string()),
+        ("product", pa.string()),
+        ("quantity", pa.string()),
+        ("price", pa.int64()),
+        ("estimated", pa.bool_()),
+    ])
+    rows_written = 0
+    # Каждый блок пишется отдельной row group, файл не собирается в памяти
+    with pq.ParquetWriter(output, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            rows_written += len(chunk)
+            if progress:
+                report_progress(reader, rows_written)
+    return rows_written
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export shopping expenses to CSV or Parquet")
+    parser.add_argument("output", help="output file (.csv or .parquet)")
+    parser.add_argument("--input", help=f"expenses JSON file (default: {EXPENSES_FILE} when no database is set)")
+    parser.add_argument("--db", default=os.getenv("EXPENSES_DB"),
+                        help="expenses SQLite database (default: EXPENSES_DB)")
+    parser.add_argument("--format", choices=["csv", "parquet"], help="output format (default: from extension)")
+    parser.add_argument("--user", action="append", help="only export this user_id (repeatable)")
+    parser.add_argument("--since", help="first date to include, YYYY-MM-DD")
+    parser.add_argument("--until", help="last date to include, YYYY-MM-DD")
+    parser.add_argument("--chunk-rows", type=int, default=10000, help="rows per write chunk")
+    parser.add_argument("--no-progress", action="store_true", help="do not print progress to stderr")
+    args = parser.parse_args(argv)
+
+    output_format = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+    # Явный --input важнее базы из окружения
+    if args.db and not args.input:
+        reader = ExpenseStoreReader(args.db)
+    else:
+        reader = ExpenseStreamReader(args.input or EXPENSES_FILE)
+    rows = iter_expense_rows(reader, set(args.user) if args.user else None, args.since, args.until)
+    chunks = iter_chunks(rows, args.chunk_rows)
+
+    export = export_parquet if output_format == "parquet" else export_csv
+    try:
+        rows_written = export(chunks, args.output, reader, not args.no_progress)
+    finally:
+        if isinstance(reader, ExpenseStoreReader):
+            reader.close()
+
+    if not args.no_progress:
+        report_progress(reader, rows_written)
+        sys.stderr.write("\n")
+    print(f"Exported {rows_written} rows from {reader.records_read} records to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
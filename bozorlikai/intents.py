@@ -0,0 +1,117 @@
+import re
+from typing import NamedTuple
+
+INTENT_GREETING = "greeting"
+INTENT_NEW_LIST = "new_list"
+INTENT_PURCHASE = "purchase"
+INTENT_EDIT = "edit"
+INTENT_OFF_TOPIC = "off_topic"
+INTENT_AMBIGUOUS = "ambiguous"
+
+# Ответы, которые раньше модель возвращала по правилам SYSTEM_PROMPT
+CANNED_REPLIES = {
+    INTENT_GREETING: "Привет! Что нужно купить сегодня?",
+    INTENT_OFF_TOPIC: "Извините, я могу помочь только со списком базара.",
+}
+
+# Ниже этой уверенности (или при близком втором кандидате) решение остается за моделью
+CONFIDENCE_THRESHOLD = 0.6
+CONFIDENCE_MARGIN = 0.15
+
+_FLAGS = re.IGNORECASE | re.UNICODE
+
+GREETING_RE = re.compile(
+    r"^\W*(?:привет\w*|салам\w*|салом|здравствуй\w*|добр\w+\s+(?:утро|день|вечер)|хай|"
+    r"ассалому?\s+алайкум|assalomu?\s+alaykum|salom\w*|hello|hi)"
+    r"(?:[\s,!.]+(?:бот|bozorlik(?:\s+ai)?|друг|всем))?\W*$", _FLAGS)
+
+PURCHASE_VERB_RE = re.compile(
+    r"\b(?:купил[аио]?|купили|куплен[аоы]?|приобр[её]л[аи]?|приобретено|взял[аи]?|"
+    r"sotib\s+oldi\w*|oldim|oldik)\b", _FLAGS)
+
+PRICE_RE = re.compile(
+    r"\d[\d\s.,]*\s*(?:сум\w*|so['ʻ’`]?m|сўм|тыс\w*|т\.?р\.?|k|к|ming)\b|\bза\s+\d", _FLAGS)
+
+EDIT_VERB_RE = re.compile(
+    r"^\W*(?:добав\w*|удал\w*|убер\w*|убра\w*|замен\w*|помен\w*|измени\w*|"
+    r"qo['ʻ’`]?sh\w*|o['ʻ’`]?chir\w*|olib\s+tashla\w*|almashtir\w*)\b", _FLAGS)
+
+QUANTITY_RE = re.compile(
+    r"\d+(?:[.,]\d+)?\s*(?:кг|кило\w*|г|гр\w*|л|литр\w*|шт\w*|пач\w*|бутыл\w*|бан\w*|упак\w*|"
+    r"десят\w*|dona|kilo\w*|litr\w*)\b", _FLAGS)
+
+GROCERY_RE = re.compile(
+    r"\b(?:молок\w*|хлеб\w*|яйц\w*|яиц|картош\w*|картофел\w*|лук\w*|морков\w*|мяс\w*|рыб\w*|кур\w*|"
+    r"говядин\w*|баранин\w*|рис\w*|сахар\w*|соль|масл\w*|мук\w*|макарон\w*|помидор\w*|огур\w*|"
+    r"яблок\w*|банан\w*|сыр\w*|творог\w*|кефир\w*|сметан\w*|чай|кофе|вод\w*|сок\w*|"
+    r"порош\w*|мыл\w*|шампун\w*|капуст\w*|перец|чеснок\w*|зелень|фрукт\w*|овощ\w*|"
+    r"sut|non|tuxum|kartoshka|piyoz|sabzi|go['ʻ’`]?sht|guruch|shakar|yog['ʻ’`]?|olma|pomidor|bodring)\b",
+    _FLAGS)
+
+OFF_TOPIC_RE = re.compile(
+    r"\b(?:реши\w*|задач\w*|домашн\w*|уравнени\w*|теорем\w*|докажи|столиц\w*|анекдот\w*|"
+    r"погод\w*|стих\w*|кто\s+такой|что\s+такое|напиши\s+(?:код|сочинение|программ\w*)|"
+    r"переведи|masala|uy\s+vazifa\w*)\b", _FLAGS)
+
+# Сообщение целиком — арифметический пример: "2+2", "15*3=?"
+ARITHMETIC_RE = re.compile(r"^[\s(]*\d+(?:[.,]\d+)?(?:[\s()]*[-+*/^×÷:][\s()]*\d+(?:[.,]\d+)?)+[\s)]*=?[\s?]*$")
+# Пример внутри текста: "сколько будет 2+2" или диапазон количества "хурма 2-3" — решает модель
+INLINE_ARITHMETIC_RE = re.compile(r"\d+\s*[-+*/^]\s*\d+")
+
+LIST_SEPARATOR_RE = re.compile(r"[,;\n•]")
+
+
+class Intent(NamedTuple):
+    name: str
+    confidence: float
+
+
+def classify_intent(text: str, has_list: bool = False) -> Intent:
+    """Определяет намерение сообщения без обращения к модели.
+
+    Возвращает INTENT_AMBIGUOUS, если ни одно намерение не набрало
+    CONFIDENCE_THRESHOLD или два лучших отличаются меньше чем на CONFIDENCE_MARGIN.
+    """
+    text = text.strip()
+    if not text:
+        return Intent(INTENT_AMBIGUOUS, 0.0)
+    if GREETING_RE.match(text):
+        return Intent(INTENT_GREETING, 0.95)
+
+    purchase_verbs = len(PURCHASE_VERB_RE.findall(text))
+    prices = len(PRICE_RE.findall(text))
+    grocery = len(GROCERY_RE.findall(text))
+    quantities = len(QUANTITY_RE.findall(text))
+    separators = len(LIST_SEPARATOR_RE.findall(text))
+    edit_verb = EDIT_VERB_RE.match(text) is not None
+    off_topic = OFF_TOPIC_RE.search(text) is not None or ARITHMETIC_RE.match(text) is not None
+    inline_arithmetic = INLINE_ARITHMETIC_RE.search(text) is not None
+
+    scores = {}
+    if has_list:
+        if purchase_verbs:
+            scores[INTENT_PURCHASE] = min(0.7 + 0.25 * bool(prices) + 0.05 * bool(grocery), 0.98)
+        elif prices:
+            scores[INTENT_PURCHASE] = 0.7
+        if edit_verb:
+            scores[INTENT_EDIT] = 0.9
+
+    list_signals = grocery + quantities + min(separators, 3)
+    # Цены при открытом списке означают отчет о покупке, а не новый список
+    if list_signals and not purchase_verbs and not edit_verb and not (has_list and prices):
+        scores[INTENT_NEW_LIST] = min(0.45 + 0.15 * list_signals, 0.95)
+
+    if off_topic and not grocery:
+        scores[INTENT_OFF_TOPIC] = 0.9
+    elif inline_arithmetic and not grocery:
+        # Ниже порога: одного этого признака мало, чтобы не пустить сообщение к модели
+        scores[INTENT_OFF_TOPIC] = 0.5
+
+    if not scores:
+        return Intent(INTENT_AMBIGUOUS, 0.0)
+    ranked = sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+    name, confidence = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+    if confidence < CONFIDENCE_THRESHOLD or confidence - runner_up < CONFIDENCE_MARGIN:
+        return Intent(INTENT_AMBIGUOUS, confidence)
+    return Intent(name, confidence)
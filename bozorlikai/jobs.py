@@ -0,0 +1,407 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Сколько раз повторять упавшую задачу, прежде чем отбросить ее (durable — в файл отказов)
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+
+# Журнал сжимается (переписывается без выполненных задач), когда вырастает больше этого размера
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+
+
+class Job(NamedTuple):
+    job_id: int
+    kind: str
+    payload: Any
+    durable: bool
+    enqueued: float
+
+
+class _JobKind(NamedTuple):
+    handler: Callable
+    batch: bool
+    durable: bool
+    on_success: Optional[Callable]
+
+
+class JobQueue:
+    """Фоновая очередь задач с записью после ответа (write-behind).
+
+    Обработчики регистрируются по виду задачи. Синхронные обработчики
+    выполняются в отдельном потоке записи (один поток, поэтому записи в файл и
+    SQLite не пересекаются), корутины — в цикле событий. Обработчик с
+    batch=True получает список payload: воркер забирает из очереди все, что
+    накопилось за batch_window секунд (не больше batch_size задач). Пачки
+    одного batch-вида выполняются по очереди, в порядке постановки задач.
+    Повторяется при ошибке только handler; on_success(payload) вызывается один
+    раз после его успеха — туда идет то, что нельзя делать дважды.
+
+    Очередь ограничена maxsize: submit() ждет, если воркеры не успевают.
+    Задачи durable=True до постановки в очередь дописываются в журнал с fsync,
+    а после выполнения помечаются в нем выполненными. Журнал пишет отдельный
+    поток, fsync общий для задач, поставленных одновременно, — цикл событий
+    диск не ждет. При запуске невыполненные задачи из журнала ставятся в
+    очередь снова, так что после сбоя задача выполнится хотя бы один раз
+    (возможен повтор последней пачки). Задача, упавшая MAX_ATTEMPTS раз подряд,
+    отбрасывается с ошибкой в логе; durable-задача при этом сохраняется в
+    файл отказов <журнал>.failed, откуда ее можно поставить заново.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1000, workers: int = 2, batch_size: int = 100,
+                 batch_window: float = 0.05, journal_path: Optional[str] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.journal_path = journal_path
+        self.dead_letter_path = journal_path + ".failed" if journal_path else None
+
+        self._kinds: Dict[str, _JobKind] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._collect_lock: Optional[asyncio.Lock] = None
+        self._kind_locks: Dict[str, asyncio.Lock] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._journal_executor: Optional[ThreadPoolExecutor] = None
+        self._journal = None
+        # Строки журнала, ждущие общего fsync, и признак, что поток журнала уже их пишет
+        self._journal_buffer: List[Tuple[str, asyncio.Future]] = []
+        self._journal_flushing = False
+        self._pending_ids = set()
+        self._next_id = 1
+        self._closed = False
+
+        # Метрики
+        self.submitted: Dict[str, int] = {}
+        self.completed: Dict[str, int] = {}
+        self.failed: Dict[str, int] = {}
+        self.latency_seconds_total: Dict[str, float] = {}
+        self.latency_seconds_max: Dict[str, float] = {}
+        self.batches = 0
+        self.batched_jobs = 0
+        self.dead_lettered = 0
+
+    def register(self, kind: str, handler: Callable, batch: bool = False, durable: bool = False,
+                 on_success: Optional[Callable] = None):
+        self._kinds[kind] = _JobKind(handler, batch, durable, on_success)
+        for counter in (self.submitted, self.completed, self.failed):
+            counter.setdefault(kind, 0)
+        self.latency_seconds_total.setdefault(kind, 0.0)
+        self.latency_seconds_max.setdefault(kind, 0.0)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        """Запускает воркеры и ставит в очередь невыполненные задачи из журнала"""
+        self._queue = asyncio.Queue(self.maxsize)
+        self._collect_lock = asyncio.Lock()
+        self._kind_locks = {kind: asyncio.Lock() for kind, job_kind in self._kinds.items() if job_kind.batch}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-writer")
+        self._closed = False
+        restored = []
+        if self.journal_path:
+            self._journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-journal")
+            restored = await asyncio.get_running_loop().run_in_executor(self._journal_executor, self._load_journal)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        for job in restored:
+            await self._queue.put(job)
+        if restored:
+            logging.info(f"Job queue {self.name}: restored {len(restored)} pending jobs from journal")
+
+    async def submit(self, kind: str, payload: Any):
+        """Ставит задачу в очередь; для durable-задач возвращается после записи в журнал"""
+        if self._closed or self._queue is None:
+            raise RuntimeError(f"Job queue {self.name} is not running")
+        job_kind = self._kinds[kind]
+        job = Job(self._next_id, kind, payload, job_kind.durable, time.monotonic())
+        self._next_id += 1
+        if job.durable and self._journal is not None:
+            # В pending сразу: пока строка ждет fsync, журнал нельзя сжимать
+            self._pending_ids.add(job.job_id)
+            try:
+                await self._journal_durable({"id": job.job_id, "kind": kind, "payload": payload})
+            except Exception:
+                self._pending_ids.discard(job.job_id)
+                raise
+        self.submitted[kind] += 1
+        await self._queue.put(job)
+
+    async def run_blocking(self, func: Callable, *args):
+        """Выполняет функцию в потоке записи очереди"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def close(self):
+        """Дожидается выполнения всех задач и останавливает воркеры"""
+        if self._queue is None:
+            return
+        self._closed = True
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+        if self._journal is not None:
+            # Пометки о выполнении пишет поток журнала: дожидаемся их до сжатия
+            self._journal_executor.shutdown(wait=True)
+            if not self._pending_ids:
+                self._compact_journal()
+            self._journal.close()
+            self._journal = None
+        self._queue = None
+
+    async def _collect(self, first: Job) -> List[Job]:
+        jobs = [first]
+        if not self._kinds[first.kind].batch:
+            return jobs
+        deadline = time.monotonic() + self.batch_window
+        while len(jobs) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return jobs
+
+    async def _worker(self):
+        while True:
+            locked: List[asyncio.Lock] = []
+            # Пачку собирает один воркер за раз, иначе соседние записи разошлись бы по разным пачкам.
+            # Замки batch-видов берутся до того, как следующий воркер соберет свою пачку, поэтому
+            # пачки одного вида выполняются в порядке сбора и записи ложатся в хранилище по порядку
+            async with self._collect_lock:
+                jobs = await self._collect(await self._queue.get())
+                try:
+                    for kind in sorted({job.kind for job in jobs if job.kind in self._kind_locks}):
+                        await self._kind_locks[kind].acquire()
+                        locked.append(self._kind_locks[kind])
+                except BaseException:
+                    for lock in locked:
+                        lock.release()
+                    for _ in jobs:
+                        self._queue.task_done()
+                    raise
+            try:
+                # Пачка могла захватить задачи других видов: выполняем группами, сохраняя порядок
+                groups: Dict[str, List[Job]] = {}
+                for job in jobs:
+                    groups.setdefault(job.kind, []).append(job)
+                for kind, group in groups.items():
+                    await self._run_group(kind, group)
+            finally:
+                for lock in locked:
+                    lock.release()
+                for _ in jobs:
+                    self._queue.task_done()
+
+    async def _run_group(self, kind: str, jobs: List[Job]):
+        job_kind = self._kinds[kind]
+        if job_kind.batch:
+            self.batches += 1
+            self.batched_jobs += len(jobs)
+            chunks = [(jobs, [job.payload for job in jobs])]
+        else:
+            chunks = [([job], job.payload) for job in jobs]
+
+        for chunk, payload in chunks:
+            error = None
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    if asyncio.iscoroutinefunction(job_kind.handler):
+                        await job_kind.handler(payload)
+                    else:
+                        await self.run_blocking(job_kind.handler, payload)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt < MAX_ATTEMPTS:
+                        logging.warning(f"Job queue {self.name}: {kind} failed (attempt {attempt}): {e}")
+                        await asyncio.sleep(RETRY_DELAY * attempt)
+
+            if error is None:
+                self.completed[kind] += len(chunk)
+                if job_kind.on_success is not None:
+                    # Не повторяется: handler уже выполнен, повтор записал бы данные дважды
+                    try:
+                        job_kind.on_success(payload)
+                    except Exception as e:
+                        logging.error(f"Job queue {self.name}: {kind} on_success failed: {e}")
+            else:
+                self.failed[kind] += len(chunk)
+                durable = [job for job in chunk if job.job_id in self._pending_ids]
+                if durable:
+                    logging.error(f"Job queue {self.name}: {kind} failed after {MAX_ATTEMPTS} attempts, "
+                                  f"moving {len(durable)} jobs to {self.dead_letter_path}: {error}")
+                else:
+                    logging.error(f"Job queue {self.name}: {kind} failed after {MAX_ATTEMPTS} attempts, "
+                                  f"dropping {len(chunk)} jobs: {error}")
+            self._finish(kind, chunk, error)
+
+    def _finish(self, kind: str, jobs: List[Job], error: Optional[Exception] = None):
+        now = time.monotonic()
+        for job in jobs:
+            latency = now - job.enqueued
+            self.latency_seconds_total[kind] += latency
+            self.latency_seconds_max[kind] = max(self.latency_seconds_max[kind], latency)
+        done = [job for job in jobs if job.job_id in self._pending_ids]
+        if done and self._journal is not None:
+            self._pending_ids.difference_update(job.job_id for job in done)
+            failed = []
+            if error is not None:
+                self.dead_lettered += len(done)
+                failed = [{"kind": job.kind, "payload": job.payload, "error": str(error), "failed_at": time.time()}
+                          for job in done]
+            # Очередь потока журнала — FIFO: пометка ляжет после строк этих задач, а сжатие не обгонит
+            # строки задач, поставленных позже
+            self._journal_executor.submit(self._journal_finish, [job.job_id for job in done], failed,
+                                          not self._pending_ids)
+
+    @staticmethod
+    def _line(entry: Dict) -> str:
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    async def _journal_durable(self, entry: Dict):
+        """Дописывает строку в журнал и ждет fsync; одновременные вызовы делят один fsync"""
+        future = asyncio.get_running_loop().create_future()
+        self._journal_buffer.append((self._line(entry), future))
+        if not self._journal_flushing:
+            self._journal_flushing = True
+            asyncio.get_running_loop().create_task(self._flush_journal())
+        await future
+
+    async def _flush_journal(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._journal_buffer:
+                batch, self._journal_buffer = self._journal_buffer, []
+                try:
+                    await loop.run_in_executor(self._journal_executor, self._journal_append,
+                                               [line for line, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._journal_flushing = False
+
+    def _journal_append(self, lines: List[str], sync: bool = True):
+        # Выполняется в потоке журнала
+        self._journal.write("".join(lines))
+        self._journal.flush()
+        if sync:
+            os.fsync(self._journal.fileno())
+
+    def _journal_finish(self, done: List[int], failed: List[Dict], idle: bool):
+        # Выполняется в потоке журнала. Отказы сохраняются с fsync до пометки о выполнении
+        try:
+            if failed:
+                with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    f.write("".join(self._line(entry) for entry in failed))
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._journal_append([self._line({"done": done})], sync=False)
+            if idle and self._journal.tell() > JOURNAL_COMPACT_BYTES:
+                self._compact_journal()
+        except Exception as e:
+            logging.error(f"Job queue {self.name}: journal update failed: {e}")
+
+    def _load_journal(self) -> List[Job]:
+        entries: Dict[int, Dict] = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Оборванная последняя строка: задача не была подтверждена вызывающему
+                        continue
+                    if "done" in entry:
+                        for job_id in entry["done"]:
+                            entries.pop(job_id, None)
+                    else:
+                        entries[entry["id"]] = entry
+
+        restored = []
+        for entry in entries.values():
+            if entry["kind"] not in self._kinds:
+                logging.error(f"Job queue {self.name}: no handler for journaled job kind {entry['kind']}")
+                continue
+            restored.append(Job(self._next_id, entry["kind"], entry["payload"], True, time.monotonic()))
+            self._next_id += 1
+
+        # Переписываем журнал: только невыполненные задачи под новыми номерами
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in restored:
+                f.write(json.dumps({"id": job.job_id, "kind": job.kind, "payload": job.payload},
+                                   ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self._pending_ids = {job.job_id for job in restored}
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        return restored
+
+    def _compact_journal(self):
+        # Вызывается, только когда в момент пометки ничего не ждало выполнения; задачи, поставленные
+        # позже, допишут свои строки в поток журнала уже после сжатия
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def snapshot(self) -> Dict:
+        return {
+            "depth": self.depth,
+            "maxsize": self.maxsize,
+            "pending_durable": len(self._pending_ids),
+            "submitted": dict(self.submitted),
+            "completed": dict(self.completed),
+            "failed": dict(self.failed),
+            "batches": self.batches,
+            "batched_jobs": self.batched_jobs,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    def render_metrics(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        prefix = f"{self.name}_jobs"
+        lines = [
+            f"# TYPE {prefix}_queue_depth gauge",
+            f"{prefix}_queue_depth {self.depth}",
+            f"# TYPE {prefix}_queue_capacity gauge",
+            f"{prefix}_queue_capacity {self.maxsize}",
+            f"# TYPE {prefix}_pending_durable gauge",
+            f"{prefix}_pending_durable {len(self._pending_ids)}",
+        ]
+        for metric, values in (("submitted_total", self.submitted), ("completed_total", self.completed),
+                               ("failed_total", self.failed)):
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            lines += [f'{prefix}_{metric}{{kind="{kind}"}} {n}' for kind, n in values.items()]
+        lines.append(f"# TYPE {prefix}_latency_seconds_total counter")
+        lines += [f'{prefix}_latency_seconds_total{{kind="{kind}"}} {value:.3f}'
+                  for kind, value in self.latency_seconds_total.items()]
+        lines.append(f"# TYPE {prefix}_latency_seconds_max gauge")
+        lines += [f'{prefix}_latency_seconds_max{{kind="{kind}"}} {value:.3f}'
+                  for kind, value in self.latency_seconds_max.items()]
+        lines.append(f"# TYPE {prefix}_batches_total counter")
+        lines.append(f"{prefix}_batches_total {self.batches}")
+        lines.append(f"# TYPE {prefix}_batched_jobs_total counter")
+        lines.append(f"{prefix}_batched_jobs_total {self.batched_jobs}")
+        lines.append(f"# TYPE {prefix}_dead_lettered_total counter")
+        lines.append(f"{prefix}_dead_lettered_total {self.dead_lettered}")
+        return "\n".join(lines) + "\n"
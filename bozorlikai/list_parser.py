@@ -0,0 +1,116 @@
+import re
+from typing import Dict, List, NamedTuple, Tuple
+
+# Эмодзи разрешенных категорий из SYSTEM_PROMPT (каждое — один символ)
+CATEGORY_EMOJI_RE = re.compile("[🥕🍎🥛🍖📦🥤🧴📝]")
+
+# Слова, по которым ответ модели без эмодзи все равно считается списком
+LIST_MARKER_RE = re.compile("овощи:|фрукты:|молочные:|мясо:|бакалея:|напитки:|химия:|другое:")
+
+# Исправление заголовков без эмодзи. Порядок проверок важен: "Бакалея и молоко:" — молочные
+_HEADER_PREFIX_RE = re.compile("^(?:(?P<veg>овощи)|(?P<fruit>фрукты))")
+_DAIRY_RE = re.compile("молочные|молоко")
+_MEAT_RE = re.compile("мясо|рыба")
+_HEADER_OTHER_RE = re.compile("^(?:(?P<grocery>бакалея)|(?P<drinks>напитки)|(?P<chemicals>химия)|(?P<other>другое))")
+
+_HEADERS = {
+    "veg": "🥕 Овощи:",
+    "fruit": "🍎 Фрукты:",
+    "dairy": "🥛 Молочные продукты:",
+    "meat": "🍖 Мясо и рыба:",
+    "grocery": "📦 Бакалея:",
+    "drinks": "🥤 Напитки:",
+    "chemicals": "🧴 Химия:",
+    "other": "📝 Другое:",
+}
+
+Categories = Dict[str, List[Tuple[str, str, bool, int]]]
+
+
+class ParsedList(NamedTuple):
+    is_list: bool
+    text: str
+    categories: Categories
+
+
+def _fix_header(line: str, lower: str) -> str:
+    match = _HEADER_PREFIX_RE.match(lower)
+    if match:
+        return _HEADERS[match.lastgroup]
+    if _DAIRY_RE.search(lower):
+        return _HEADERS["dairy"]
+    if _MEAT_RE.search(lower):
+        return _HEADERS["meat"]
+    match = _HEADER_OTHER_RE.match(lower)
+    if match:
+        return _HEADERS[match.lastgroup]
+    return line
+
+
+class ListParser:
+    """Однопроходный разбор ответа модели со списком покупок.
+
+    За один просмотр каждой строки определяет, является ли ответ списком,
+    исправляет форматирование (заголовки без эмодзи, "-" вместо "•") и
+    раскладывает товары по категориям. Текст можно подавать частями через
+    feed(), например по мере стриминга ответа; незаконченная строка ждет
+    следующей части.
+    """
+
+    def __init__(self):
+        self.is_list = False
+        self.lines: List[str] = []
+        self.categories: Categories = {}
+        self._current_category = None
+        self._pending = ""
+
+    def feed(self, chunk: str):
+        lines = (self._pending + chunk).split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._process_line(line)
+
+    def close(self) -> ParsedList:
+        self._process_line(self._pending)
+        self._pending = ""
+        return ParsedList(self.is_list, '\n'.join(self.lines), self.categories)
+
+    def _process_line(self, line: str):
+        line = line.strip()
+        if not line:
+            self.lines.append("")
+            return
+
+        lower = line.lower()
+        has_emoji = CATEGORY_EMOJI_RE.search(line) is not None
+        if not self.is_list and (has_emoji or LIST_MARKER_RE.search(lower)):
+            self.is_list = True
+
+        if line.endswith(':'):
+            fixed = _fix_header(line, lower)
+            if fixed is not line:
+                line = fixed
+                has_emoji = True
+            elif line[0] == '-':
+                line = '•' + line[1:]
+            if has_emoji:
+                self._current_category = line[:-1]
+                self.categories[self._current_category] = []
+                self.lines.append(line)
+                return
+        elif line[0] == '-':
+            line = '•' + line[1:]
+        self.lines.append(line)
+
+        if line[0] == '•' and self._current_category:
+            product_line = line[1:].strip()
+            separator = '—' if '—' in product_line else '-'
+            product, _, quantity = product_line.partition(separator)
+            self.categories[self._current_category].append((product.strip(), quantity.strip(), False, 0))
+
+
+def parse_list_output(text: str) -> ParsedList:
+    """Разбирает полный ответ модели за один проход"""
+    parser = ListParser()
+    parser.feed(text)
+    return parser.close()
@@ -0,0 +1,123 @@
+import re
+from typing import Dict, List, Optional
+
+from edit_grammar import resolve_product, split_quantity
+from price_index import normalize_product_name
+
+_FLAGS = re.IGNORECASE | re.UNICODE
+
+# Категории из SYSTEM_PROMPT и корни продуктов для них
+CATEGORY_PATTERNS = [
+    ("🥕 Овощи", re.compile(r"\b(?:картош|картоф|лук|морков|капуст|помидор|томат|огур|перец|чеснок|свекл|"
+                            r"баклажан|кабач|зелен|укроп|петрушк|kartoshka|piyoz|sabzi|karam|pomidor|bodring)",
+                            _FLAGS)),
+    ("🍎 Фрукты", re.compile(r"\b(?:яблок|груш|банан|апельсин|мандарин|лимон|виноград|арбуз|дын|персик|слив|"
+                             r"гранат|olma|nok|banan|uzum|tarvuz|qovun|anor)", _FLAGS)),
+    ("🥛 Молочные продукты", re.compile(r"\b(?:молок|кефир|сыр|творог|сметан|йогурт|ряженк|сливк|масло\s+слив|"
+                                        r"sut|qatiq|pishloq|tvorog|qaymoq)", _FLAGS)),
+    ("🍖 Мясо и рыба", re.compile(r"\b(?:мяс|говяд|баран|свини|кур|фарш|колбас|сосиск|рыб|филе|печен|"
+                                  r"go['ʻ’`]?sht|tovuq|baliq|qiyma)", _FLAGS)),
+    ("🥤 Напитки", re.compile(r"\b(?:вод|сок|чай|кофе|лимонад|кол|компот|suv|sharbat|choy|qahva)", _FLAGS)),
+    ("🧴 Химия", re.compile(r"\b(?:порош|мыл|шампун|гель|зубн|туалетн|салфет|губк|отбел|sovun|kukun)", _FLAGS)),
+    ("📦 Бакалея", re.compile(r"\b(?:рис|греч|мук|сахар|соль|макарон|масл|хлеб|яйц|яиц|круп|овсян|чечевиц|"
+                              r"горох|фасол|консерв|печень|guruch|un|shakar|tuz|makaron|yog['ʻ’`]?|non|tuxum)",
+                              _FLAGS)),
+]
+OTHER_CATEGORY = "📝 Другое"
+
+_ITEM_SPLIT_RE = re.compile(r"[,;\n]+|\s+(?:и|va)\s+", _FLAGS)
+_BULLET_RE = re.compile(r"^\s*(?:[•\-*]|\d+[.)](?!\d))\s*")
+_LIST_PREFIX_RE = re.compile(r"^\W*(?:нужно\s+купить|надо\s+купить|купить|список|sotib\s+olish\s+kerak)\W*",
+                             _FLAGS)
+
+# "за 12 тысяч", "за 12.000", "15000 сум", "20 тыс", "12k"
+_PRICE_RE = re.compile(
+    r"(?:\bза\s+(?P<after_za>\d{1,3}(?:[ .,]\d{3})+|\d+(?:[.,]\d+)?)\s*(?P<za_unit>тыс\w*|т\.|k|к|ming)?(?!\w))|"
+    r"(?:(?P<number>\d{1,3}(?:[ .,]\d{3})+|\d+(?:[.,]\d+)?)\s*(?P<unit>тыс\w*|т\.|k|к|ming|сум\w*|so['ʻ’`]?m)(?!\w))",
+    _FLAGS)
+_WORD_RE = re.compile(r"[^\W\d_][\w'ʻ’`-]*")
+_THOUSANDS_RE = re.compile(r"^\d{1,3}(?:[ .,]\d{3})+$")
+
+MAX_LOCAL_ITEMS = 50
+
+
+def _category_for(product: str) -> str:
+    for category, pattern in CATEGORY_PATTERNS:
+        if pattern.search(product):
+            return category
+    return OTHER_CATEGORY
+
+
+def build_local_list(text: str) -> Dict[str, List]:
+    """Составляет список по категориям без модели: "молоко 1 л, хлеб и 2 кг картошки".
+
+    Категория определяется по корню слова, неизвестные продукты идут в "Другое".
+    Возвращает пустой словарь, если в тексте не нашлось продуктов.
+    """
+    categories: Dict[str, List] = {}
+    text = _LIST_PREFIX_RE.sub('', text)
+    for raw_item in _ITEM_SPLIT_RE.split(text)[:MAX_LOCAL_ITEMS]:
+        item = _BULLET_RE.sub('', raw_item).strip(" .!")
+        if not item:
+            continue
+        product, quantity = split_quantity(item)
+        if not re.search(r"[^\W\d_]", product):
+            continue
+        product = product[:1].upper() + product[1:]
+        categories.setdefault(_category_for(product), []).append((product, quantity, False, 0))
+    # Порядок категорий как в SYSTEM_PROMPT
+    order = [category for category, _ in CATEGORY_PATTERNS] + [OTHER_CATEGORY]
+    return {category: categories[category] for category in order if category in categories}
+
+
+def _parse_price(number: str, unit: Optional[str]) -> int:
+    if _THOUSANDS_RE.match(number):
+        value = float(re.sub(r"[ .,]", "", number))
+    else:
+        value = float(number.replace(',', '.'))
+    if unit and unit[0].lower() in "тkкm":
+        value *= 1000
+    return int(value)
+
+
+def detect_purchases_locally(text: str, products: List[str]) -> List[Dict]:
+    """Находит в сообщении продукты из списка и их цены без модели.
+
+    Цена берется из ближайшего упоминания "за N"/"N сум" после названия
+    продукта и до следующего продукта; если цены нет, она равна 0.
+    Формат ответа как у detect_purchased_products_with_prices.
+    """
+    lower = text.lower()
+    known = {name: "" for name in products}
+    words = list(_WORD_RE.finditer(lower))
+    mentions = []
+    index = 0
+    while index < len(words):
+        # Сначала пробуем два слова подряд ("красную рыбу"), потом одно
+        for size in (2, 1):
+            if index + size > len(words):
+                continue
+            product = resolve_product(" ".join(word.group(0) for word in words[index:index + size]), known)
+            if product is not None:
+                mentions.append((words[index].start(), product))
+                index += size
+                break
+        else:
+            index += 1
+
+    found = []
+    seen = set()
+    for index, (start, product) in enumerate(mentions):
+        if product in seen:
+            continue
+        seen.add(product)
+        end = mentions[index + 1][0] if index + 1 < len(mentions) else len(lower)
+        price_match = _PRICE_RE.search(lower, start, end)
+        price = 0
+        if price_match:
+            if price_match.group("after_za"):
+                price = _parse_price(price_match.group("after_za"), price_match.group("za_unit"))
+            else:
+                price = _parse_price(price_match.group("number"), price_match.group("unit"))
+        found.append({"name": normalize_product_name(product), "price": price})
+    return found
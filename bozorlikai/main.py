@@ -1,17 +1,42 @@
-import openai
+import time
+# Отсчет времени старта — до тяжелых импортов
+_process_started = time.perf_counter()
 import aiohttp
+import asyncio
+import io
 import logging
 import json
+import math
 import os
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Collection, Dict, Iterator, List, Set, Tuple, Optional
 from datetime import datetime
 from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.utils import executor
 from aiogram.types import ContentType, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import ReplyKeyboardRemove
+from aiohttp import web
 from dotenv import load_dotenv
 
+from admission import (AdmissionController, Overloaded, PRIORITY_CHAT, PRIORITY_NEW_LIST, PRIORITY_UPDATE,
+                       busy_message)
+from analytics import ExpenseAnalytics
+from edit_grammar import parse_edit_commands
+from expense_store import ExpenseStore
+from jobs import JobQueue
+from intents import CANNED_REPLIES, INTENT_EDIT, INTENT_NEW_LIST, INTENT_PURCHASE, classify_intent
+from list_parser import ParsedList, parse_list_output
+from local_fallbacks import build_local_list, detect_purchases_locally
+from price_index import PriceIndex
+from profiler import LoopProfiler, LoopWatchdog, StartupTimer, render_folded, top_functions
+from rate_limit import UserRateLimiter
+from structured_output import (EDIT_TASK, MODE_JSON_SCHEMA, MODE_OFF, PURCHASE_TASK, STRUCTURED_MODES,
+                               StructuredOutputStats, StructuredTask, build_request, extract_json, response_text)
+from traffic_log import SOURCE_BOT, TrafficRecorder, describe_llm_response, request_fingerprint
+
 logging.basicConfig(level=logging.INFO)
+startup_timer = StartupTimer(_process_started)
+startup_timer.mark("imports")
 
 # Load environment variables
 load_dotenv()
@@ -21,14 +46,85 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 bot = Bot(token=TOKEN)
 dp = Dispatcher(bot)
-openai.api_key = OPENAI_API_KEY
+
+# Модуль openai импортируется при первом обращении (или в фоне после старта):
+# его импорт — заметная часть времени перезапуска
+_openai = None
 
 # Хранилище данных пользователей
 user_data: Dict[int, Dict] = {}
 
+# Ограничение одновременных запросов к OpenAI и очередь по приоритетам
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "8"))
+LLM_QUEUE_DEADLINE = float(os.getenv("LLM_QUEUE_DEADLINE", "10"))
+llm_admission = AdmissionController("bot", LLM_MAX_CONCURRENT, LLM_QUEUE_DEADLINE)
+
+# Порт для /metrics (если не задан, сервер метрик не запускается)
+METRICS_PORT = os.getenv("METRICS_PORT")
+metrics_runner: Optional[web.AppRunner] = None
+
 # Файл для хранения аналитики расходов
 EXPENSES_FILE = "shopping_expenses.json"
 
+# Если задан путь к базе SQLite, история расходов хранится в ней вместо JSON-файла
+# (перенос старых данных: python migrate_expenses.py --db <путь>)
+EXPENSES_DB = os.getenv("EXPENSES_DB")
+expense_store: Optional[ExpenseStore] = ExpenseStore(EXPENSES_DB) if EXPENSES_DB else None
+
+# Лимиты на пользователя. Сверх лимита токенов модели бот работает локально
+RATE_MESSAGES_PER_MINUTE = float(os.getenv("RATE_MESSAGES_PER_MINUTE", "20"))
+RATE_VOICE_SECONDS_PER_HOUR = float(os.getenv("RATE_VOICE_SECONDS_PER_HOUR", "600"))
+RATE_LLM_TOKENS_PER_HOUR = float(os.getenv("RATE_LLM_TOKENS_PER_HOUR", "30000"))
+DAILY_LLM_TOKEN_QUOTA = int(os.getenv("DAILY_LLM_TOKEN_QUOTA", "100000"))
+rate_limiter = UserRateLimiter(RATE_MESSAGES_PER_MINUTE, RATE_VOICE_SECONDS_PER_HOUR, RATE_LLM_TOKENS_PER_HOUR,
+                               DAILY_LLM_TOKEN_QUOTA, usage_store=expense_store)
+
+RATE_LIMIT_TEXT = "⏳ Слишком много сообщений подряд. Подожди немного и попробуй снова."
+VOICE_LIMIT_TEXT = "🎤 Лимит голосовых сообщений пока исчерпан. Напиши, пожалуйста, текстом."
+VOICE_TOO_LONG_TEXT = "🎤 Голосовое слишком длинное. Запиши покороче или напиши текстом."
+# Запись обезличенного трафика для воспроизведения (python replay_traffic.py <журнал>).
+# Выключена, если TRAFFIC_LOG не задан; TRAFFIC_LOG_SALT делает псевдонимы стабильными между запусками
+TRAFFIC_LOG = os.getenv("TRAFFIC_LOG")
+TRAFFIC_LOG_MAX_MB = int(os.getenv("TRAFFIC_LOG_MAX_MB", "50"))
+traffic_recorder: Optional[TrafficRecorder] = (
+    TrafficRecorder(TRAFFIC_LOG, TRAFFIC_LOG_MAX_MB * 1024 * 1024, salt=os.getenv("TRAFFIC_LOG_SALT"))
+    if TRAFFIC_LOG else None)
+
+# Ответы модели для покупок и правок: json_schema (строгая схема), tools (вызов функции) или off (JSON по промпту)
+STRUCTURED_OUTPUT_MODE = os.getenv("STRUCTURED_OUTPUT_MODE", MODE_JSON_SCHEMA)
+if STRUCTURED_OUTPUT_MODE not in STRUCTURED_MODES:
+    logging.warning(f"Unknown STRUCTURED_OUTPUT_MODE {STRUCTURED_OUTPUT_MODE!r}, using {MODE_JSON_SCHEMA}")
+    STRUCTURED_OUTPUT_MODE = MODE_JSON_SCHEMA
+# Попыток на запрос, если ответ не удалось разобрать даже с починкой
+STRUCTURED_MAX_ATTEMPTS = 2
+structured_stats = StructuredOutputStats("bot")
+
+# Подмена вызова OpenAI: (user_id, create, **kwargs) -> ответ. Задается при воспроизведении трафика
+llm_transport: Optional[Callable] = None
+
+LLM_QUOTA_TEXT = "⚠️ Лимит запросов к AI на сегодня исчерпан. Я понимаю списки через запятую, команды 'добавь/удали/замени' и покупки вида 'купил молоко за 12 тысяч'."
+
+# Фоновая очередь: запись истории расходов, пересчет аналитики и удаление временных файлов
+# идут после ответа пользователю. Невыполненные записи переживают перезапуск через журнал
+JOBS_JOURNAL = os.getenv("JOBS_JOURNAL", "background_jobs.journal")
+JOBS_QUEUE_SIZE = int(os.getenv("JOBS_QUEUE_SIZE", "1000"))
+background_jobs = JobQueue("bot", maxsize=JOBS_QUEUE_SIZE, journal_path=JOBS_JOURNAL or None)
+
+# Аналитика расходов и индекс цен. Строятся в фоне после старта, бот
+# отвечает сразу; до готовности оценка цен пустая, а /stats ждет построения
+expense_analytics: Optional[ExpenseAnalytics] = None
+price_index: Optional[PriceIndex] = None
+expense_indexes_task: Optional[asyncio.Task] = None
+_empty_price_index = PriceIndex()
+
+# Пользователи Telegram, которым доступна команда /profile (через запятую)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+PROFILE_DEFAULT_SECONDS = 10.0
+# Предупреждение в лог, если что-то блокирует цикл событий дольше порога (0 — не следить)
+SLOW_CALLBACK_MS = float(os.getenv("SLOW_CALLBACK_MS", "100"))
+loop_profiler = LoopProfiler()
+loop_watchdog: Optional[LoopWatchdog] = LoopWatchdog(SLOW_CALLBACK_MS / 1000) if SLOW_CALLBACK_MS > 0 else None
+
 SYSTEM_PROMPT = """
 You are Bozorlik AI — an assistant that ONLY creates grocery shopping lists.
 You MUST always respond in Russian.
@@ -135,64 +231,150 @@ SYSTEM_PROMPT_EDIT = """
 """
 
 
+def read_expenses_file():
+    """Читает файл расходов; ошибки чтения пробрасывает"""
+    if not os.path.exists(EXPENSES_FILE):
+        return {}
+    with open(EXPENSES_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
 def load_expenses():
     """Загружает данные о расходах из файла"""
-    if os.path.exists(EXPENSES_FILE):
-        try:
-            with open(EXPENSES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"Error loading expenses: {e}")
-            return {}
-    return {}
+    try:
+        return read_expenses_file()
+    except Exception as e:
+        logging.error(f"Error loading expenses: {e}")
+        return {}
 
 
 def save_expenses(expenses_data):
-    """Сохраняет данные о расходах в файл"""
+    """Сохраняет данные о расходах в файл; ошибки пробрасывает, чтобы очередь повторила запись"""
+    # Пишем во временный файл и подменяем: читатели в других потоках не увидят файл наполовину
+    tmp_file = EXPENSES_FILE + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(expenses_data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, EXPENSES_FILE)
+
+
+def write_expense_records(entries: List[Dict]):
+    """Добавляет пачку записей {"user_id", "record"} в историю за одну запись на диск"""
+    if expense_store is not None:
+        expense_store.add_purchases((entry["user_id"], entry["record"]) for entry in entries)
+        return
+    # Не load_expenses(): нечитаемый файл превратился бы в {} и запись стерла бы всю историю
+    expenses_data = read_expenses_file()
+    for entry in entries:
+        expenses_data.setdefault(str(entry["user_id"]), []).append(entry["record"])
+    save_expenses(expenses_data)
+
+
+async def persist_expense_records(entries: List[Dict]):
+    """Фоновая задача: запись истории в потоке записи (при ошибке очередь повторяет только ее)"""
+    # Пишем только после построения индексов: иначе запись попала бы в них дважды или ни разу
+    await load_expense_indexes()
+    await background_jobs.run_blocking(write_expense_records, entries)
+
+
+def apply_expense_rollups(entries: List[Dict]):
+    """После успешной записи: пересчет аналитики и индекса цен, ровно один раз на пачку"""
+    # Аналитику обновляем в цикле событий, где ее читают обработчики
+    for entry in entries:
+        expense_analytics.add_record(int(entry["user_id"]), entry["record"])
+        price_index.add_record(int(entry["user_id"]), entry["record"])
+
+
+def remove_temp_file(path: str):
     try:
-        with open(EXPENSES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(expenses_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.error(f"Error saving expenses: {e}")
-
-
-def parse_shopping_list(text: str) -> Dict[str, List[Tuple[str, str]]]:
-    """Парсит отформатированный список покупок на категории и товары"""
-    categories = {}
-    current_category = None
-
-    lines = text.split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-
-        # Определяем категорию (строка с эмодзи и двоеточием)
-        if any(emoji in line for emoji in ['🥕', '🍎', '🥛', '🍖', '📦', '🥤', '🧴', '📝']) and line.endswith(':'):
-            current_category = line[:-1]
-            categories[current_category] = []
-        elif (line.startswith('•') or line.startswith('-')) and current_category:
-            if line.startswith('-'):
-                line = '•' + line[1:]
-
-            product_line = line[1:].strip()
-            if '—' in product_line:
-                product, quantity = product_line.split('—', 1)
-                product = product.strip()
-                quantity = quantity.strip()
-            elif '-' in product_line:
-                product, quantity = product_line.split('-', 1)
-                product = product.strip()
-                quantity = quantity.strip()
-            else:
-                product = product_line
-                quantity = ""
-            categories[current_category].append((product, quantity, False, 0))  # False - не куплен, 0 - цена
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_llm_usage(entries: List[Dict]):
+    """Пачка расходов токенов {"user_id", "day", "tokens"} в хранилище одной транзакцией"""
+    totals: Dict[Tuple[int, str], int] = {}
+    for entry in entries:
+        key = (entry["user_id"], entry["day"])
+        totals[key] = totals.get(key, 0) + entry["tokens"]
+    expense_store.add_llm_usage_batch((user_id, day, tokens) for (user_id, day), tokens in totals.items())
+
+
+background_jobs.register("expense", persist_expense_records, batch=True, durable=True,
+                         on_success=apply_expense_rollups)
+background_jobs.register("remove_file", remove_temp_file)
+background_jobs.register("llm_usage", write_llm_usage, batch=True)
+
+
+def load_user_expenses(user_id: int, limit: Optional[int] = None) -> List[Dict]:
+    """История расходов пользователя (последние limit записей, если задан)"""
+    if expense_store is not None:
+        return expense_store.user_records(user_id, limit)
+    records = load_expenses().get(str(user_id), [])
+    return records[-limit:] if limit else records
+
 
-    return categories
+def iter_expense_records() -> Iterator[Tuple[str, Dict]]:
+    """Все записи истории расходов как пары (user_id, record)"""
+    if expense_store is not None:
+        return expense_store.iter_records()
+    return ((user_id, record) for user_id, records in load_expenses().items() for record in records)
 
 
-def format_shopping_list(categories: Dict[str, List[Tuple[str, str, bool, int]]]) -> str:
+def build_expense_indexes() -> Tuple[ExpenseAnalytics, PriceIndex]:
+    """Строит аналитику расходов и индекс цен из истории за один проход"""
+    analytics = ExpenseAnalytics()
+    index = PriceIndex()
+    for user_id, record in iter_expense_records():
+        analytics.add_record(int(user_id), record)
+        index.add_record(int(user_id), record)
+    return analytics, index
+
+
+async def _build_expense_indexes():
+    global expense_analytics, price_index, expense_indexes_task
+    started = time.perf_counter()
+    try:
+        expense_analytics, price_index = await asyncio.to_thread(build_expense_indexes)
+    except Exception:
+        # Следующее обращение попробует снова
+        expense_indexes_task = None
+        raise
+    logging.info(f"Expense indexes built in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+async def load_expense_indexes():
+    """Строит индексы в отдельном потоке один раз; одновременные вызовы ждут ту же сборку"""
+    global expense_indexes_task
+    if expense_analytics is not None:
+        return
+    if expense_indexes_task is None:
+        expense_indexes_task = asyncio.ensure_future(_build_expense_indexes())
+    await asyncio.shield(expense_indexes_task)
+
+
+async def get_expense_analytics() -> ExpenseAnalytics:
+    await load_expense_indexes()
+    return expense_analytics
+
+
+def get_price_index() -> PriceIndex:
+    """Индекс цен; пока он строится после старта — пустой (цены неизвестны)"""
+    return price_index if price_index is not None else _empty_price_index
+
+
+def get_openai():
+    global _openai
+    if _openai is None:
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        _openai = openai
+    return _openai
+
+
+def format_shopping_list(categories: Dict[str, List[Tuple[str, str, bool, int]]],
+                         estimated: Collection[str] = ()) -> str:
+    """estimated — продукты, цена которых взята из истории, а не названа пользователем (показываются с ~)"""
     result = []
 
     for category, items in categories.items():
@@ -200,7 +382,8 @@ def format_shopping_list(categories: Dict[str, List[Tuple[str, str, bool, int]]]
             result.append(f"{category}:")
             for product, quantity, purchased, price in items:
                 if purchased and price > 0:
-                    result.append(f"✅ {product} — {quantity} - {price:,} сум".replace(',', '.'))
+                    approximate = "~" if product in estimated else ""
+                    result.append(f"✅ {product} — {quantity} - {approximate}{price:,} сум".replace(',', '.'))
                 elif purchased:
                     result.append(f"✅ {product} — {quantity}")
                 else:
@@ -210,8 +393,35 @@ def format_shopping_list(categories: Dict[str, List[Tuple[str, str, bool, int]]]
     return "\n".join(result).strip()
 
 
-async def format_list_with_gpt(text: str) -> str:
-    completion = openai.chat.completions.create(
+async def call_llm(priority: int, user_id: int, create: Callable, **kwargs):
+    """Вызывает OpenAI через контроллер допуска, не блокируя цикл событий.
+
+    Потраченные токены списываются с лимитов пользователя.
+    """
+    async with llm_admission.slot(priority, user_id):
+        started = time.time()
+        if llm_transport is not None:
+            result = await asyncio.to_thread(llm_transport, user_id, create, **kwargs)
+        else:
+            result = await asyncio.to_thread(create, **kwargs)
+        duration = time.time() - started
+    if traffic_recorder is not None:
+        traffic_recorder.record_llm(user_id, request_fingerprint(kwargs.get("model", ""), kwargs.get("messages")),
+                                    describe_llm_response(result), started, duration)
+    usage = getattr(result, "usage", None)
+    if usage is not None and getattr(usage, "total_tokens", None):
+        day = rate_limiter.charge_llm_tokens(user_id, usage.total_tokens)
+        # Лимит уже учтен в памяти, запись в SQLite — в фоне, не в цикле событий
+        if expense_store is not None:
+            await background_jobs.submit("llm_usage", {"user_id": user_id, "day": day, "tokens": usage.total_tokens})
+    return result
+
+
+async def format_list_with_gpt(text: str, user_id: int, priority: int = PRIORITY_NEW_LIST) -> str:
+    completion = await call_llm(
+        priority,
+        user_id,
+        get_openai().chat.completions.create,
         model="gpt-4o-mini-2024-07-18",
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
@@ -221,7 +431,42 @@ async def format_list_with_gpt(text: str) -> str:
     return completion.choices[0].message.content
 
 
-async def detect_purchased_products_with_prices(text: str, available_products: List[str]) -> List[Dict]:
+async def request_structured(task: StructuredTask, legacy_prompt: str, text: str, user_id: int) -> List[Dict]:
+    """Запрос с ответом по схеме задачи; неразобранный ответ повторяется один раз.
+
+    Починенный ответ, в котором не осталось ни одного элемента (оборвался на
+    первом), тоже считается неразобранным: иначе пользователь молча получил бы
+    пустой результат. legacy_prompt — прежний системный промпт с описанием JSON
+    для режима off.
+    """
+    mode = STRUCTURED_OUTPUT_MODE
+    system_prompt = legacy_prompt if mode == MODE_OFF else task.system_prompt
+    for attempt in range(1, STRUCTURED_MAX_ATTEMPTS + 1):
+        completion = await call_llm(
+            PRIORITY_UPDATE,
+            user_id,
+            get_openai().chat.completions.create,
+            model="gpt-4o-mini-2024-07-18",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text}
+            ],
+            **build_request(task, mode)
+        )
+        data, repaired = extract_json(response_text(completion))
+        result = task.normalize(data) if data is not None else []
+        parsed = data is not None and (bool(result) or not repaired)
+        usage = getattr(completion, "usage", None)
+        structured_stats.record_attempt(task.name, mode, parsed, repaired, attempt > 1,
+                                        getattr(usage, "completion_tokens", None) or 0)
+        if parsed:
+            return result
+        logging.warning(f"Unparseable {task.name} response (attempt {attempt})")
+    structured_stats.record_failure(task.name, mode)
+    return []
+
+
+async def detect_purchased_products_with_prices(text: str, available_products: List[str], user_id: int) -> List[Dict]:
     prompt = f"""
 Доступные продукты: {', '.join(available_products)}
 
@@ -231,50 +476,58 @@ async def detect_purchased_products_with_prices(text: str, available_products: L
 """
 
     try:
-        completion = openai.chat.completions.create(
-            model="gpt-4o-mini-2024-07-18",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_PURCHASE},
-                {"role": "user", "content": prompt}
-            ]
-        )
-
-        response = completion.choices[0].message.content
-        data = json.loads(response)
-        return data.get("products", [])
+        return await request_structured(PURCHASE_TASK, SYSTEM_PROMPT_PURCHASE, prompt, user_id)
+    except Overloaded:
+        raise
     except Exception as e:
         logging.error(f"Error detecting purchased products with prices: {e}")
         return []
 
 
-async def detect_edit_changes(text: str) -> List[Dict]:
+async def detect_edit_changes(text: str, user_id: int) -> List[Dict]:
     """Определяет изменения для редактирования списка"""
     try:
-        completion = openai.chat.completions.create(
-            model="gpt-4o-mini-2024-07-18",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_EDIT},
-                {"role": "user", "content": text}
-            ]
-        )
-
-        response = completion.choices[0].message.content
-        data = json.loads(response)
-        return data.get("changes", [])
+        return await request_structured(EDIT_TASK, SYSTEM_PROMPT_EDIT, text, user_id)
+    except Overloaded:
+        raise
     except Exception as e:
         logging.error(f"Error detecting edit changes: {e}")
         return []
 
 
-async def transcribe_voice(file_path: str) -> str:
-    with open(file_path, "rb") as audio_file:
-        transcript = openai.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file
-        )
+async def download_voice(file_id: str, path: str):
+    """Скачивает голосовое сообщение из Telegram в файл"""
+    file_info = await bot.get_file(file_id)
+    file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(file_url) as resp:
+            if resp.status == 200:
+                with open(path, "wb") as f:
+                    f.write(await resp.read())
+
+
+async def transcribe_voice(file_path: str, user_id: int, priority: int = PRIORITY_NEW_LIST) -> str:
+    try:
+        with open(file_path, "rb") as audio_file:
+            transcript = await call_llm(
+                priority,
+                user_id,
+                get_openai().audio.transcriptions.create,
+                model="whisper-1",
+                file=audio_file
+            )
+    finally:
+        await background_jobs.submit("remove_file", file_path)
     return transcript.text
 
 
+def build_list_locally(text: str) -> ParsedList:
+    """Список без модели, когда лимит токенов пользователя исчерпан"""
+    categories = build_local_list(text)
+    return ParsedList(bool(categories), format_shopping_list(categories), categories)
+
+
 def get_all_products_from_categories(categories: Dict[str, List[Tuple[str, str, bool, int]]]) -> List[str]:
     all_products = []
     for category_items in categories.values():
@@ -284,10 +537,16 @@ def get_all_products_from_categories(categories: Dict[str, List[Tuple[str, str,
 
 
 def mark_products_as_purchased_with_prices(categories: Dict[str, List[Tuple[str, str, bool, int]]],
-                                           purchased_products: List[Dict]) -> Tuple[
-    Dict[str, List[Tuple[str, str, bool, int]]], int]:
+                                           purchased_products: List[Dict],
+                                           price_estimator: Optional[Callable[[str], Optional[int]]] = None) -> Tuple[
+    Dict[str, List[Tuple[str, str, bool, int]]], int, Set[str]]:
+    """Отмечает купленные продукты. Если цена не названа, берет ее из price_estimator.
+
+    Возвращает (категории, добавленные расходы, продукты с оцененной ценой).
+    """
     total_cost = 0
-    purchased_products_lower = {p['name'].lower(): p.get('price', 0) for p in purchased_products}
+    estimated = set()
+    purchased_products_lower = {p['name'].lower(): p.get('price') or 0 for p in purchased_products}
 
     updated_categories = {}
     for category, items in categories.items():
@@ -300,6 +559,10 @@ def mark_products_as_purchased_with_prices(categories: Dict[str, List[Tuple[str,
 
             for purchased_product, purchased_price in purchased_products_lower.items():
                 if (purchased_product in product_lower or product_lower in purchased_product) and not purchased:
+                    if not purchased_price and price_estimator:
+                        purchased_price = price_estimator(product) or price_estimator(purchased_product) or 0
+                        if purchased_price:
+                            estimated.add(product)
                     is_purchased = True
                     price = purchased_price
                     total_cost += purchased_price
@@ -308,14 +571,7 @@ def mark_products_as_purchased_with_prices(categories: Dict[str, List[Tuple[str,
             updated_items.append((product, quantity, is_purchased, price))
         updated_categories[category] = updated_items
 
-    return updated_categories, total_cost
-
-
-def is_purchase_message(text: str) -> bool:
-    purchase_keywords = ['купил', 'купила', 'купили', 'приобрел', 'приобрела', 'приобрели',
-                         'взял', 'взяла', 'взяли', 'куплено', 'приобретено', 'купилa', 'за', 'сум']
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in purchase_keywords)
+    return updated_categories, total_cost, estimated
 
 
 def calculate_completion_percentage(categories: Dict[str, List[Tuple[str, str, bool, int]]]) -> Tuple[int, int, int]:
@@ -337,48 +593,8 @@ def calculate_completion_percentage(categories: Dict[str, List[Tuple[str, str, b
     return int(percentage), purchased_items, total_cost
 
 
-def fix_list_formatting(text: str) -> str:
-    lines = text.split('\n')
-    fixed_lines = []
-
-    for line in lines:
-        line = line.strip()
-        if not line:
-            fixed_lines.append("")
-            continue
-
-        # Исправляем категории (добавляем эмодзи если нужно)
-        if line.lower().startswith('овощи') and line.endswith(':'):
-            fixed_lines.append("🥕 Овощи:")
-        elif line.lower().startswith('фрукты') and line.endswith(':'):
-            fixed_lines.append("🍎 Фрукты:")
-        elif any(word in line.lower() for word in ['молочные', 'молоко']) and line.endswith(':'):
-            fixed_lines.append("🥛 Молочные продукты:")
-        elif any(word in line.lower() for word in ['мясо', 'рыба']) and line.endswith(':'):
-            fixed_lines.append("🍖 Мясо и рыба:")
-        elif line.lower().startswith('бакалея') and line.endswith(':'):
-            fixed_lines.append("📦 Бакалея:")
-        elif line.lower().startswith('напитки') and line.endswith(':'):
-            fixed_lines.append("🥤 Напитки:")
-        elif line.lower().startswith('химия') and line.endswith(':'):
-            fixed_lines.append("🧴 Химия:")
-        elif line.lower().startswith('другое') and line.endswith(':'):
-            fixed_lines.append("📝 Другое:")
-        elif line.startswith('-'):
-            fixed_line = '•' + line[1:]
-            fixed_lines.append(fixed_line)
-        else:
-            fixed_lines.append(line)
-
-    return '\n'.join(fixed_lines)
-
-
-def save_shopping_history(user_id: int, categories: Dict[str, List[Tuple[str, str, bool, int]]], total_cost: int):
-    expenses_data = load_expenses()
-
-    if str(user_id) not in expenses_data:
-        expenses_data[str(user_id)] = []
-
+async def save_shopping_history(user_id: int, categories: Dict[str, List[Tuple[str, str, bool, int]]],
+                                total_cost: int, estimated: Collection[str] = ()):
     purchase_record = {
         "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "total_cost": total_cost,
@@ -388,20 +604,37 @@ def save_shopping_history(user_id: int, categories: Dict[str, List[Tuple[str, st
     for category, items in categories.items():
         for product, quantity, purchased, price in items:
             if purchased and price > 0:
-                purchase_record["items"].append({
+                item = {
                     "product": product,
                     "quantity": quantity,
                     "category": category,
                     "price": price
-                })
+                }
+                # Оцененные цены не попадают в индекс цен и аналитику, иначе медиана тянулась бы к прошлым оценкам
+                if product in estimated:
+                    item["estimated"] = True
+                purchase_record["items"].append(item)
 
-    expenses_data[str(user_id)].append(purchase_record)
-    save_expenses(expenses_data)
+    # Запись на диск и пересчет аналитики — в фоне; возвращаемся после записи задачи в журнал
+    await background_jobs.submit("expense", {"user_id": user_id, "record": purchase_record})
+
+
+def format_estimate_line(user_id: int, categories: Dict[str, List[Tuple[str, str, bool, int]]]) -> str:
+    """Строка с примерной стоимостью списка по истории цен или пустая строка"""
+    products = [product for items in categories.values() for product, _, _, _ in items]
+    estimated_total, known = get_price_index().estimate_total(user_id, products)
+    if known == 0:
+        return ""
+    line = f"\n\n💡 Примерная стоимость: ~{estimated_total:,} сум".replace(',', '.')
+    if known < len(products):
+        line += f" (по ценам {known} из {len(products)} товаров)"
+    return line
 
 
 def get_total_expenses(user_id: int) -> int:
-    expenses_data = load_expenses()
-    user_expenses = expenses_data.get(str(user_id), [])
+    if expense_store is not None:
+        return expense_store.total_cost(user_id)
+    user_expenses = load_user_expenses(user_id)
     total = sum(record["total_cost"] for record in user_expenses)
     return total
 
@@ -459,7 +692,7 @@ def create_list_keyboard() -> InlineKeyboardMarkup:
 @dp.message_handler(commands=['start'])
 async def start_handler(message: types.Message):
     await message.reply(
-        "Привет! 😊 Я помогу тебе составить список базара и отслеживать расходы. Отправь текст или голосовое сообщение с тем, что нужно купить.\n\nКоманды:\n/list - показать текущий список\n/clear - очистить список\n/status - показать прогресс покупок\n/expenses - показать историю расходов\n/total - общие расходы за все время")
+        "Привет! 😊 Я помогу тебе составить список базара и отслеживать расходы. Отправь текст или голосовое сообщение с тем, что нужно купить.\n\nКоманды:\n/list - показать текущий список\n/clear - очистить список\n/status - показать прогресс покупок\n/expenses - показать историю расходов\n/total - общие расходы за все время\n/stats - статистика расходов")
 
 
 @dp.message_handler(commands=['clear'])
@@ -485,7 +718,7 @@ async def list_handler(message: types.Message):
     user_id = message.from_user.id
     if user_id in user_data and user_data[user_id].get('categories'):
         categories = user_data[user_id]['categories']
-        formatted_list = format_shopping_list(categories)
+        formatted_list = format_shopping_list(categories, user_data[user_id].get('estimated', ()))
         percentage, purchased_count, total_cost = calculate_completion_percentage(categories)
 
         response = f"🛒 Твой текущий список:\n\n{formatted_list}"
@@ -527,19 +760,19 @@ async def status_handler(message: types.Message):
 @dp.message_handler(commands=['expenses'])
 async def expenses_handler(message: types.Message):
     user_id = message.from_user.id
-    expenses_data = load_expenses()
-    user_expenses = expenses_data.get(str(user_id), [])
+    user_expenses = load_user_expenses(user_id, limit=5)
 
     if not user_expenses:
         await message.reply("📊 У тебя еще нет истории расходов.")
         return
 
     response = "📊 История твоих покупок:\n\n"
-    for i, record in enumerate(user_expenses[-5:], 1):  # последние 5 записей
+    for i, record in enumerate(user_expenses, 1):  # последние 5 записей
         response += f"{i}. {record['date']}\n"
         response += f"   💰 Общая сумма: {record['total_cost']:,} сум\n".replace(',', '.')
         for item in record['items'][:3]:  # первые 3 товара
-            response += f"   • {item['product']} - {item['price']:,} сум\n".replace(',', '.')
+            approximate = "~" if item.get("estimated") else ""
+            response += f"   • {item['product']} - {approximate}{item['price']:,} сум\n".replace(',', '.')
         if len(record['items']) > 3:
             response += f"   ... и еще {len(record['items']) - 3} товаров\n"
         response += "\n"
@@ -558,6 +791,75 @@ async def total_handler(message: types.Message):
         await message.reply("📊 У тебя еще нет записей о расходах.")
 
 
+@dp.message_handler(commands=['stats'])
+async def stats_handler(message: types.Message):
+    user_id = message.from_user.id
+    analytics = await get_expense_analytics()
+
+    if analytics.purchase_count(user_id) == 0:
+        await message.reply("📊 У тебя еще нет истории расходов.")
+        return
+
+    response = f"📊 Статистика расходов ({analytics.purchase_count(user_id)} завершенных списков):\n\n"
+
+    response += "🗂 По категориям:\n"
+    for category, spent in analytics.category_spend(user_id):
+        response += f"   {category} — {spent:,} сум\n".replace(',', '.')
+
+    today = datetime.now().date()
+    month_spend = analytics.monthly_category_spend(user_id, today.year, today.month)
+    if month_spend:
+        response += "\n🗓 В этом месяце:\n"
+        for category, spent in month_spend:
+            response += f"   {category} — {spent:,} сум\n".replace(',', '.')
+    response += f"\n📆 За последние 7 дней: {analytics.recent_spend(user_id, today):,} сум\n".replace(',', '.')
+
+    response += "\n📅 По месяцам:\n"
+    for month, spent in analytics.monthly_trend(user_id):
+        response += f"   {month} — {spent:,} сум\n".replace(',', '.')
+
+    response += "\n🏆 Топ продуктов:\n"
+    for i, (product, spent, count) in enumerate(analytics.top_products(user_id), 1):
+        response += f"   {i}. {product} — {spent:,} сум ({count} раз)\n".replace(',', '.')
+
+    await message.reply(response)
+
+
+@dp.message_handler(commands=['profile'])
+async def profile_handler(message: types.Message):
+    """Профиль цикла событий за N секунд для администраторов: /profile 10"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    argument = message.get_args().strip()
+    try:
+        seconds = float(argument) if argument else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        seconds = math.nan
+    # "nan", "inf" и "0" float() принимает, но профиль за такое время пуст
+    if not math.isfinite(seconds) or seconds <= 0:
+        await message.reply("Использование: /profile [секунд]")
+        return
+    if loop_profiler.running:
+        await message.reply("⏱ Профиль уже снимается, подожди.")
+        return
+
+    await message.reply(f"⏱ Снимаю профиль {seconds:g} с...")
+    stacks = await loop_profiler.profile(seconds)
+    response = f"⏱ Профиль: {sum(stacks.values())} семплов\n\nСобственное время:\n"
+    for name, share in top_functions(stacks):
+        response += f"   {share:6.1%} {name}\n"
+    if loop_watchdog is not None and loop_watchdog.recent:
+        response += f"\nЗависания цикла > {SLOW_CALLBACK_MS:g} мс: {loop_watchdog.stalls_total}, " \
+                    f"последнее {loop_watchdog.recent[-1].duration * 1000:.0f} мс"
+    await message.reply(response[:4096])
+    if not stacks:
+        # Пустой файл Telegram не принимает
+        return
+    # Свернутые стеки: flamegraph.pl profile.folded > profile.svg или speedscope.app
+    await message.reply_document(types.InputFile(io.BytesIO(render_folded(stacks).encode()),
+                                                 filename="profile.folded"))
+
+
 @dp.callback_query_handler(lambda c: c.data == "edit_list")
 async def process_edit_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
@@ -574,7 +876,7 @@ async def process_edit_callback(callback_query: types.CallbackQuery):
             "• 'добавь [продукт] [количество]' - добавить продукт\n"
             "• 'удали [продукт]' - удалить продукт\n"
             "• 'замени [старый продукт] на [новый продукт]' - заменить продукт\n\n"
-            f"Текущий список:\n{format_shopping_list(user_data[user_id]['categories'])}"
+            f"Текущий список:\n{format_shopping_list(user_data[user_id]['categories'], user_data[user_id].get('estimated', ()))}"
         )
     else:
         await bot.answer_callback_query(callback_query.id, "У тебя нет списка для редактирования")
@@ -608,62 +910,96 @@ async def process_new_list_callback(callback_query: types.CallbackQuery):
                            "📝 Отлично! Напиши или запиши голосовое сообщение с тем, что нужно купить:")
 
 
-@dp.message_handler(content_types=ContentType.TEXT)
-async def handle_text(message: types.Message):
-    user_id = message.from_user.id
-    text = message.text
+EDIT_RETRY_HINT_TEXT = "❌ Не понял, что нужно изменить. Попробуй еще раз:\n\n• 'добавь молоко 1 литр'\n• 'удали картошку'\n• 'замени яблоки на груши'"
+EDIT_RETRY_HINT_VOICE = "❌ Не понял, что нужно изменить. Попробуй сказать четче:\n\n• 'добавь молоко один литр'\n• 'удали картошку'\n• 'замени яблоки на груши'"
 
-    # Проверяем режим редактирования
-    if user_id in user_data and user_data[user_id].get('editing'):
-        categories = user_data[user_id]['categories']
 
-        # Определяем изменения
-        changes = await detect_edit_changes(text)
+async def process_edit_request(message: types.Message, user_id: int, text: str, retry_hint: str,
+                               use_llm: bool = True):
+    """Применяет к списку изменения из сообщения и отправляет обновленный список"""
+    categories = user_data[user_id]['categories']
 
-        if changes:
-            # Применяем изменения
-            updated_categories = apply_edit_changes(categories, changes)
-            user_data[user_id]['categories'] = updated_categories
-            user_data[user_id]['editing'] = False
+    # Простые команды разбираем локально, модель нужна только для остальных
+    products = {product: quantity for items in categories.values() for product, quantity, _, _ in items}
+    changes = parse_edit_commands(text, products)
+    if changes is None and use_llm:
+        changes = await detect_edit_changes(text, user_id)
 
-            # Удаляем старое сообщение со списком
-            if 'list_message_id' in user_data[user_id]:
-                try:
-                    await bot.delete_message(user_id, user_data[user_id]['list_message_id'])
-                except Exception as e:
-                    logging.error(f"Error deleting message: {e}")
+    if changes:
+        # Применяем изменения
+        updated_categories = apply_edit_changes(categories, changes)
+        user_data[user_id]['categories'] = updated_categories
+        user_data[user_id]['editing'] = False
 
-            # Отправляем обновленный список
-            formatted_list = format_shopping_list(updated_categories)
-            total_items = sum(len(items) for items in updated_categories.values())
+        # Удаляем старое сообщение со списком
+        if 'list_message_id' in user_data[user_id]:
+            try:
+                await bot.delete_message(user_id, user_data[user_id]['list_message_id'])
+            except Exception as e:
+                logging.error(f"Error deleting message: {e}")
 
-            response = f"✅ Список обновлен! ({total_items} товаров):\n\n{formatted_list}"
-            sent_message = await message.reply(response, reply_markup=create_list_keyboard())
-            user_data[user_id]['list_message_id'] = sent_message.message_id
-        else:
-            await message.reply(
-                "❌ Не понял, что нужно изменить. Попробуй еще раз:\n\n• 'добавь молоко 1 литр'\n• 'удали картошку'\n• 'замени яблоки на груши'")
+        # Отправляем обновленный список
+        formatted_list = format_shopping_list(updated_categories, user_data[user_id].get('estimated', ()))
+        total_items = sum(len(items) for items in updated_categories.values())
+
+        response = f"✅ Список обновлен! ({total_items} товаров):\n\n{formatted_list}"
+        sent_message = await message.reply(response, reply_markup=create_list_keyboard())
+        user_data[user_id]['list_message_id'] = sent_message.message_id
+    else:
+        await message.reply(retry_hint)
+
+
+async def process_user_text(message: types.Message, text: str):
+    """Обрабатывает текст сообщения — набранный или распознанный из голосового.
 
+    Правка списка в режиме редактирования, иначе маршрутизация по намерению:
+    готовый ответ, правка, отметка покупок или новый список. Без доступа к
+    модели (квота) правки, покупки и списки разбираются локально.
+    """
+    user_id = message.from_user.id
+    use_llm = rate_limiter.llm_allowed(user_id)
+    retry_hint = EDIT_RETRY_HINT_VOICE if message.voice else EDIT_RETRY_HINT_TEXT
+
+    # Проверяем режим редактирования
+    if user_id in user_data and user_data[user_id].get('editing'):
+        await process_edit_request(message, user_id, text, retry_hint, use_llm)
         return
 
-    if user_id in user_data and user_data[user_id].get('categories') and is_purchase_message(text):
+    has_list = user_id in user_data and bool(user_data[user_id].get('categories'))
+    intent = classify_intent(text, has_list)
+    logging.info(f"Intent for {user_id}: {intent.name} ({intent.confidence:.2f})")
+
+    if intent.name in CANNED_REPLIES:
+        await message.reply(CANNED_REPLIES[intent.name])
+
+    elif has_list and intent.name == INTENT_EDIT:
+        await process_edit_request(message, user_id, text, retry_hint, use_llm)
+
+    elif has_list and intent.name == INTENT_PURCHASE:
         categories = user_data[user_id]['categories']
         all_products = get_all_products_from_categories(categories)
 
         if all_products:
-            purchased_products = await detect_purchased_products_with_prices(text, all_products)
+            if use_llm:
+                purchased_products = await detect_purchased_products_with_prices(text, all_products, user_id)
+            else:
+                purchased_products = detect_purchases_locally(text, all_products)
 
             if purchased_products:
-                updated_categories, new_costs = mark_products_as_purchased_with_prices(categories, purchased_products)
+                price_estimator = lambda product: get_price_index().estimate(user_id, product)
+                updated_categories, new_costs, estimated = mark_products_as_purchased_with_prices(
+                    categories, purchased_products, price_estimator)
                 user_data[user_id]['categories'] = updated_categories
+                estimated_products = user_data[user_id].setdefault('estimated', set())
+                estimated_products.update(estimated)
 
-                formatted_list = format_shopping_list(updated_categories)
+                formatted_list = format_shopping_list(updated_categories, estimated_products)
 
                 percentage, purchased_count, total_cost = calculate_completion_percentage(updated_categories)
                 total_items = sum(len(items) for items in updated_categories.values())
 
                 if percentage == 100:
-                    save_shopping_history(user_id, updated_categories, total_cost)
+                    await save_shopping_history(user_id, updated_categories, total_cost, estimated_products)
 
                     response = f"🎉 Отлично! Все {total_items} товаров куплены! Список завершен!\n\n{formatted_list}\n\n💰 Общая стоимость покупки: {total_cost:,} сум".replace(
                         ',', '.')
@@ -699,14 +1035,17 @@ async def handle_text(message: types.Message):
             await message.reply("📝 Сначала создай список покупок!")
 
     else:
-        response = await format_list_with_gpt(text)
-
-        if any(emoji in response for emoji in ['🥕', '🍎', '🥛', '🍖', '📦', '🥤', '🧴', '📝']) or any(
-                word in response.lower() for word in
-                ['овощи:', 'фрукты:', 'молочные:', 'мясо:', 'бакалея:', 'напитки:', 'химия:', 'другое:']):
-            response = fix_list_formatting(response)
+        if use_llm:
+            response = await format_list_with_gpt(text, user_id,
+                                                  PRIORITY_NEW_LIST if intent.name == INTENT_NEW_LIST else PRIORITY_CHAT)
+            parsed = parse_list_output(response)
+        else:
+            response = LLM_QUOTA_TEXT
+            parsed = build_list_locally(text) if intent.name == INTENT_NEW_LIST else ParsedList(False, "", {})
 
-            categories = parse_shopping_list(response)
+        if parsed.is_list:
+            response = parsed.text
+            categories = parsed.categories
             user_data[user_id] = {
                 'categories': categories,
                 'last_message_id': message.message_id,
@@ -715,6 +1054,7 @@ async def handle_text(message: types.Message):
 
             total_items = sum(len(items) for items in categories.values())
             response_with_info = f"📋 Создал список покупок ({total_items} товаров):\n\n{response}"
+            response_with_info += format_estimate_line(user_id, categories)
 
             sent_message = await message.reply(response_with_info, reply_markup=create_list_keyboard())
             user_data[user_id]['list_message_id'] = sent_message.message_id
@@ -722,137 +1062,145 @@ async def handle_text(message: types.Message):
             await message.reply(response)
 
 
-@dp.message_handler(content_types=ContentType.VOICE)
-async def handle_voice(message: types.Message):
-    user_id = message.from_user.id
-
-    # Проверяем режим редактирования
-    if user_id in user_data and user_data[user_id].get('editing'):
-        file_info = await bot.get_file(message.voice.file_id)
-        file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as resp:
-                if resp.status == 200:
-                    with open("voice_edit.ogg", "wb") as f:
-                        f.write(await resp.read())
-
-        text = await transcribe_voice("voice_edit.ogg")
-        categories = user_data[user_id]['categories']
-
-        # Определяем изменения
-        changes = await detect_edit_changes(text)
-
-        if changes:
-            # Применяем изменения
-            updated_categories = apply_edit_changes(categories, changes)
-            user_data[user_id]['categories'] = updated_categories
-            user_data[user_id]['editing'] = False
-
-            # Удаляем старое сообщение со списком
-            if 'list_message_id' in user_data[user_id]:
-                try:
-                    await bot.delete_message(user_id, user_data[user_id]['list_message_id'])
-                except Exception as e:
-                    logging.error(f"Error deleting message: {e}")
+@dp.message_handler(content_types=ContentType.TEXT)
+async def handle_text(message: types.Message):
+    if not rate_limiter.allow_message(message.from_user.id):
+        await message.reply(RATE_LIMIT_TEXT)
+        return
+    await process_user_text(message, message.text)
 
-            # Отправляем обновленный список
-            formatted_list = format_shopping_list(updated_categories)
-            total_items = sum(len(items) for items in updated_categories.values())
 
-            response = f"✅ Список обновлен! ({total_items} товаров):\n\n{formatted_list}"
-            sent_message = await message.reply(response, reply_markup=create_list_keyboard())
-            user_data[user_id]['list_message_id'] = sent_message.message_id
-        else:
-            await message.reply(
-                "❌ Не понял, что нужно изменить. Попробуй сказать четче:\n\n• 'добавь молоко один литр'\n• 'удали картошку'\n• 'замени яблоки на груши'")
+@dp.message_handler(content_types=ContentType.VOICE)
+async def handle_voice(message: types.Message):
+    user_id = message.from_user.id
 
+    if not rate_limiter.allow_message(user_id):
+        await message.reply(RATE_LIMIT_TEXT)
+        return
+    # Распознавание речи работает только через модель
+    if not rate_limiter.llm_allowed(user_id):
+        await message.reply(LLM_QUOTA_TEXT)
+        return
+    if not rate_limiter.allow_voice(user_id, message.voice.duration):
+        too_long = message.voice.duration > rate_limiter.max_voice_seconds
+        await message.reply(VOICE_TOO_LONG_TEXT if too_long else VOICE_LIMIT_TEXT)
         return
 
-    file_info = await bot.get_file(message.voice.file_id)
-    file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
+    # Имя с message_id: файл удаляется в фоне и не должен совпасть со следующим голосовым
+    voice_file = f"voice_{user_id}_{message.message_id}.ogg"
+    await download_voice(message.voice.file_id, voice_file)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(file_url) as resp:
-            if resp.status == 200:
-                with open("voice.ogg", "wb") as f:
-                    f.write(await resp.read())
+    # Правка или отметка покупок в существующем списке важнее нового списка
+    has_list = user_id in user_data and bool(user_data[user_id].get('categories'))
+    editing = user_id in user_data and user_data[user_id].get('editing')
+    text = await transcribe_voice(voice_file, user_id, PRIORITY_UPDATE if has_list or editing else PRIORITY_NEW_LIST)
+    await process_user_text(message, text)
 
-    text = await transcribe_voice("voice.ogg")
 
-    if user_id in user_data and user_data[user_id].get('categories') and is_purchase_message(text):
-        categories = user_data[user_id]['categories']
-        all_products = get_all_products_from_categories(categories)
+@dp.errors_handler(exception=Overloaded)
+async def overloaded_handler(update: types.Update, exception: Overloaded):
+    """Запрос не дождался очереди к модели — сразу просим повторить позже"""
+    logging.warning(f"Shedding update {update.update_id}: {exception}")
+    if update.message:
+        await update.message.reply(busy_message(update.message.text or ""))
+    return True
 
-        if all_products:
-            purchased_products = await detect_purchased_products_with_prices(text, all_products)
 
-            if purchased_products:
-                updated_categories, new_costs = mark_products_as_purchased_with_prices(categories, purchased_products)
-                user_data[user_id]['categories'] = updated_categories
+class StartupTimingMiddleware(BaseMiddleware):
+    """Отмечает время от запуска процесса до первого обработанного обновления"""
 
-                formatted_list = format_shopping_list(updated_categories)
+    async def on_post_process_update(self, update: types.Update, results: List, data: Dict):
+        if "first_update" not in startup_timer.phases:
+            startup_timer.mark("first_update")
 
-                percentage, purchased_count, total_cost = calculate_completion_percentage(updated_categories)
-                total_items = sum(len(items) for items in updated_categories.values())
 
-                if percentage == 100:
-                    save_shopping_history(user_id, updated_categories, total_cost)
+dp.middleware.setup(StartupTimingMiddleware())
 
-                    response = f"🎉 Отлично! Все {total_items} товаров куплены! Список завершен!\n\n{formatted_list}\n\n💰 Общая стоимость покупки: {total_cost:,} сум".replace(
-                        ',', '.')
 
-                    # Удаляем старое сообщение со списком
-                    if 'list_message_id' in user_data[user_id]:
-                        try:
-                            await bot.delete_message(user_id, user_data[user_id]['list_message_id'])
-                        except Exception as e:
-                            logging.error(f"Error deleting message: {e}")
+class TrafficRecorderMiddleware(BaseMiddleware):
+    """Записывает входящие обновления и время их обработки в журнал трафика"""
 
-                    await message.reply(response)
-                    del user_data[user_id]
-                else:
-                    response = f"✅ Обновил список! Отметил купленное:\n\n{formatted_list}\n\n📊 Прогресс: {percentage}% ({purchased_count}/{total_items} товаров)"
-                    if new_costs > 0:
-                        response += f"\n💰 Добавлено расходов: {new_costs:,} сум".replace(',', '.')
-                        response += f"\n💰 Всего потрачено: {total_cost:,} сум".replace(',', '.')
+    async def on_pre_process_update(self, update: types.Update, data: Dict):
+        data["traffic_started"] = time.time()
 
-                    # Удаляем старое сообщение со списком
-                    if 'list_message_id' in user_data[user_id]:
-                        try:
-                            await bot.delete_message(user_id, user_data[user_id]['list_message_id'])
-                        except Exception as e:
-                            logging.error(f"Error deleting message: {e}")
+    async def on_post_process_update(self, update: types.Update, results: List, data: Dict):
+        started = data.get("traffic_started", time.time())
+        traffic_recorder.record_update(SOURCE_BOT, update.to_python(), started, time.time() - started)
 
-                    sent_message = await message.reply(response, reply_markup=create_list_keyboard())
-                    user_data[user_id]['list_message_id'] = sent_message.message_id
-            else:
-                await message.reply("🤔 Не смог определить какие товары ты купил. Попробуй назвать их точнее.")
-        else:
-            await message.reply("📝 Сначала создай список покупок!")
-    else:
-        response = await format_list_with_gpt(text)
 
-        if any(emoji in response for emoji in ['🥕', '🍎', '🥛', '🍖', '📦', '🥤', '🧴', '📝']) or any(
-                word in response.lower() for word in
-                ['овощи:', 'фрукты:', 'молочные:', 'мясо:', 'бакалея:', 'напитки:', 'химия:', 'другое:']):
-            response = fix_list_formatting(response)
+if traffic_recorder is not None:
+    dp.middleware.setup(TrafficRecorderMiddleware())
 
-            categories = parse_shopping_list(response)
-            user_data[user_id] = {
-                'categories': categories,
-                'last_message_id': message.message_id,
-                'editing': False
-            }
 
-            total_items = sum(len(items) for items in categories.values())
-            response_with_info = f"📋 Создал список покупок ({total_items} товаров):\n\n{response}"
+async def metrics_handler(request: web.Request) -> web.Response:
+    text = llm_admission.render_metrics() + background_jobs.render_metrics() + structured_stats.render_metrics()
+    text += startup_timer.render_metrics("bot")
+    if loop_watchdog is not None:
+        text += loop_watchdog.render_metrics("bot")
+    return web.Response(text=text, content_type="text/plain")
 
-            sent_message = await message.reply(response_with_info, reply_markup=create_list_keyboard())
-            user_data[user_id]['list_message_id'] = sent_message.message_id
-        else:
-            await message.reply(response)
+
+async def profile_http_handler(request: web.Request) -> web.Response:
+    """GET /debug/profile?seconds=10 — свернутые стеки цикла событий для flamegraph.pl / speedscope"""
+    try:
+        seconds = float(request.query.get("seconds", PROFILE_DEFAULT_SECONDS))
+    except ValueError:
+        return web.Response(status=400, text="seconds must be a number")
+    try:
+        stacks = await loop_profiler.profile(seconds)
+    except RuntimeError as e:
+        return web.Response(status=409, text=str(e))
+    return web.Response(text=render_folded(stacks), content_type="text/plain")
+
+
+async def stalls_handler(request: web.Request) -> web.Response:
+    """GET /debug/stalls — последние зависания цикла событий со стеками"""
+    text = loop_watchdog.render_recent() if loop_watchdog is not None else "SLOW_CALLBACK_MS=0\n"
+    return web.Response(text=text, content_type="text/plain")
+
+
+async def start_metrics_server(port: int):
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    # Сервер слушает только 127.0.0.1, поэтому отладочные ручки доступны лишь локально
+    app.router.add_get("/debug/profile", profile_http_handler)
+    app.router.add_get("/debug/stalls", stalls_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, "127.0.0.1", port).start()
+    logging.info(f"Metrics server listening on 127.0.0.1:{port}")
+
+
+async def on_startup(dispatcher: Dispatcher):
+    loop = asyncio.get_running_loop()
+    if loop_watchdog is not None:
+        loop_watchdog.start()
+        # Тот же порог для предупреждений asyncio в режиме отладки (PYTHONASYNCIODEBUG=1)
+        loop.slow_callback_duration = loop_watchdog.threshold
+    # Индексы расходов и клиент OpenAI готовятся в фоне, опрос Telegram начинается сразу.
+    # Восстановленные из журнала записи очередь допишет после построения индексов
+    loop.create_task(load_expense_indexes())
+    loop.run_in_executor(None, get_openai)
+    await background_jobs.start()
+    if METRICS_PORT:
+        await start_metrics_server(int(METRICS_PORT))
+    startup_timer.mark("ready")
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    # Дописываем все отложенные записи до закрытия хранилища
+    await background_jobs.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    if expense_store is not None:
+        expense_store.close()
+    if traffic_recorder is not None:
+        traffic_recorder.close()
+    if loop_watchdog is not None:
+        await loop_watchdog.stop()
 
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,86 @@
+"""Перенос shopping_expenses.json в хранилище SQLite.
+
+Файл читается потоково, записи вставляются пачками. После каждой пачки
+контрольная точка сохраняется в той же транзакции, поэтому прерванную
+миграцию можно просто запустить снова — она продолжит с места остановки.
+В конце количество записей, товаров и суммы сверяются с исходным файлом.
+
+Пример:
+    python migrate_expenses.py --db expenses.db
+"""
+import argparse
+import os
+import sys
+from typing import List, Optional
+
+from expense_stream import ExpenseStreamReader
+from expense_store import ExpenseStore
+
+EXPENSES_FILE = "shopping_expenses.json"
+
+
+def migrate(reader: ExpenseStreamReader, store: ExpenseStore, source: str, batch_size: int,
+            progress: bool = True) -> bool:
+    """Переносит записи и сверяет итоги. Возвращает True, если итоги совпали"""
+    checkpoint = store.get_checkpoint(source)
+    records_done = 0
+    if checkpoint is not None:
+        source_size, records_done = checkpoint
+        if source_size != reader.total_bytes:
+            raise SystemExit(f"{source} changed since the last run "
+                             f"({source_size} -> {reader.total_bytes} bytes); refusing to resume")
+        print(f"Resuming after {records_done} records")
+
+    source_records = source_items = source_cost = source_prices = 0
+    batch = []
+    for user_id, record in reader:
+        source_records += 1
+        source_items += len(record.get("items", []))
+        source_cost += int(record.get("total_cost", 0))
+        source_prices += sum(int(item.get("price", 0)) for item in record.get("items", []))
+
+        # Уже перенесенные записи только учитываем в итогах
+        if source_records <= records_done:
+            continue
+        batch.append((int(user_id), record))
+        if len(batch) >= batch_size:
+            store.add_migration_batch(batch, source, reader.total_bytes, source_records)
+            batch = []
+            if progress:
+                sys.stderr.write(f"\r{reader.progress:6.1%}  records: {source_records}")
+                sys.stderr.flush()
+    if batch:
+        store.add_migration_batch(batch, source, reader.total_bytes, source_records)
+    if progress:
+        sys.stderr.write(f"\r{reader.progress:6.1%}  records: {source_records}\n")
+
+    expected = (source_records, source_items, source_cost, source_prices)
+    migrated = store.source_totals(source)
+    labels = ("records", "items", "total_cost sum", "item price sum")
+    ok = True
+    for label, want, got in zip(labels, expected, migrated):
+        status = "OK" if want == got else "MISMATCH"
+        ok = ok and want == got
+        print(f"{label:>16}: source={want} store={got} {status}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Migrate shopping_expenses.json into the SQLite expense store")
+    parser.add_argument("--input", default=EXPENSES_FILE, help=f"expenses JSON file (default: {EXPENSES_FILE})")
+    parser.add_argument("--db", required=True, help="target SQLite database")
+    parser.add_argument("--batch-size", type=int, default=1000, help="records per insert transaction")
+    parser.add_argument("--no-progress", action="store_true", help="do not print progress to stderr")
+    args = parser.parse_args(argv)
+
+    reader = ExpenseStreamReader(args.input)
+    store = ExpenseStore(args.db)
+    try:
+        ok = migrate(reader, store, os.path.abspath(args.input), args.batch_size, not args.no_progress)
+    finally:
+        store.close()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
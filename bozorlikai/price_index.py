@@ -0,0 +1,97 @@
+import re
+from collections import deque
+from statistics import median
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+# Сколько последних цен учитывать в медиане
+RECENT_WINDOW = 10
+
+_NON_WORD_RE = re.compile(r"[^\w\s]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_product_name(name: str) -> str:
+    """Приводит название продукта к ключу индекса: "Яйца (С1)!" -> "яйца с1" """
+    name = name.lower().replace('ё', 'е')
+    name = _NON_WORD_RE.sub(' ', name)
+    return _SPACES_RE.sub(' ', name).strip()
+
+
+class PriceStats:
+    """Цены одного продукта: последние значения, минимум и максимум"""
+
+    __slots__ = ("recent", "min_price", "max_price", "count")
+
+    def __init__(self, recent_window: int = RECENT_WINDOW):
+        self.recent: Deque[int] = deque(maxlen=recent_window)
+        self.min_price = 0
+        self.max_price = 0
+        self.count = 0
+
+    def add(self, price: int):
+        if self.count == 0:
+            self.min_price = self.max_price = price
+        else:
+            self.min_price = min(self.min_price, price)
+            self.max_price = max(self.max_price, price)
+        self.recent.append(price)
+        self.count += 1
+
+    def median(self) -> int:
+        return int(median(self.recent))
+
+
+class PriceIndex:
+    """Индекс цен продуктов по истории покупок, по пользователю и общий.
+
+    Обновляется инкрементально при сохранении каждой завершенной покупки.
+    """
+
+    def __init__(self, recent_window: int = RECENT_WINDOW):
+        self.recent_window = recent_window
+        self._global: Dict[str, PriceStats] = {}
+        self._users: Dict[int, Dict[str, PriceStats]] = {}
+
+    def _stats(self, table: Dict[str, PriceStats], key: str) -> PriceStats:
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = PriceStats(self.recent_window)
+        return stats
+
+    def add(self, user_id: int, product: str, price: int):
+        key = normalize_product_name(product)
+        if not key or price <= 0:
+            return
+        self._stats(self._users.setdefault(int(user_id), {}), key).add(price)
+        self._stats(self._global, key).add(price)
+
+    def add_record(self, user_id: int, record: Dict):
+        """Добавляет цены из одной записи истории покупок (кроме оцененных по самому индексу)"""
+        for item in record.get("items", []):
+            if item.get("estimated"):
+                continue
+            self.add(user_id, item.get("product", ""), int(item.get("price", 0)))
+
+    def lookup(self, user_id: int, product: str) -> Optional[PriceStats]:
+        """Статистика цен продукта: сначала личная история, затем общая"""
+        key = normalize_product_name(product)
+        stats = self._users.get(user_id, {}).get(key)
+        if stats is None:
+            stats = self._global.get(key)
+        return stats
+
+    def estimate(self, user_id: int, product: str) -> Optional[int]:
+        """Ожидаемая цена продукта (медиана последних покупок) или None"""
+        stats = self.lookup(user_id, product)
+        return stats.median() if stats else None
+
+    def estimate_total(self, user_id: int, products: Iterable[str]) -> Tuple[int, int]:
+        """Возвращает (примерная сумма, сколько продуктов удалось оценить)"""
+        total = 0
+        known = 0
+        for product in products:
+            price = self.estimate(user_id, product)
+            if price is not None:
+                total += price
+                known += 1
+        return total, known
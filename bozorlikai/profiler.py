@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+# Предел длительности одного профиля, чтобы случайный /profile 3600 не висел часами
+MAX_PROFILE_SECONDS = 60.0
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Сколько последних зависаний цикла хранить для /profile и /debug/stalls
+RECENT_STALLS = 20
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    # Первая строка функции, а не текущая: иначе одна функция распадется на много узлов графа
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def folded_stack(frame) -> str:
+    """Стек от корня к листу через ";" — формат flamegraph.pl и speedscope"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class LoopProfiler:
+    """Семплирующий профайлер потока цикла событий.
+
+    Фоновый поток каждые interval секунд снимает стек потока цикла через
+    sys._current_frames() и считает одинаковые стеки. Сам цикл не
+    инструментируется, поэтому профиль можно снимать с работающего бота под
+    нагрузкой. Одновременно идет не больше одного профиля.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def _sample(self, thread_id: int, duration: float, interval: float) -> Counter:
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[folded_stack(frame)] += 1
+            del frame
+            time.sleep(interval)
+        return stacks
+
+    async def profile(self, duration: float, interval: float = DEFAULT_SAMPLE_INTERVAL) -> Counter:
+        """Профиль текущего цикла событий за duration секунд: {свернутый стек: число семплов}"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Profile is already running")
+        try:
+            duration = min(max(duration, interval), MAX_PROFILE_SECONDS)
+            thread_id = threading.get_ident()
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._sample, thread_id, duration, interval)
+        finally:
+            self._lock.release()
+
+
+def render_folded(stacks: Counter) -> str:
+    """Текст для flamegraph.pl / speedscope: "стек число" в строке"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _leaf(stack: str) -> str:
+    return stack.rsplit(";", 1)[-1] if stack else "unknown"
+
+
+def top_functions(stacks: Counter, limit: int = 10) -> List[tuple]:
+    """Функции с наибольшим собственным временем: [(функция, доля семплов)]"""
+    total = sum(stacks.values())
+    if not total:
+        return []
+    leaves: Counter = Counter()
+    for stack, count in stacks.items():
+        leaves[_leaf(stack)] += count
+    return [(name, count / total) for name, count in leaves.most_common(limit)]
+
+
+class Stall(NamedTuple):
+    started: float  # time.time() начала зависания
+    duration: float
+    stack: str
+
+
+class LoopWatchdog:
+    """Предупреждает, когда что-то блокирует цикл событий дольше threshold секунд.
+
+    Задача в цикле обновляет отметку времени; поток-сторож замечает, что
+    отметка устарела, и сразу снимает стек потока цикла — видно, какой код
+    держит цикл, а не только то, что он завис. Дешевле режима отладки asyncio
+    (loop.set_debug), поэтому может работать постоянно.
+    """
+
+    def __init__(self, threshold: float = 0.1):
+        self.threshold = threshold
+        self.stalls_total = 0
+        self.stall_seconds_max = 0.0
+        self.recent: Deque[Stall] = deque(maxlen=RECENT_STALLS)
+        self._beat = time.monotonic()
+        self._thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self):
+        stalled_since = None
+        stack = ""
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            lag = time.monotonic() - beat
+            if lag > self.threshold and stalled_since is None:
+                stalled_since = beat
+                frame = sys._current_frames().get(self._thread_id)
+                stack = folded_stack(frame) if frame is not None else ""
+                del frame
+            elif stalled_since is not None and beat > stalled_since:
+                started = time.time() - (time.monotonic() - stalled_since)
+                self._record(Stall(started, beat - stalled_since, stack))
+                stalled_since = None
+
+    def _record(self, stall: Stall):
+        self.stalls_total += 1
+        self.stall_seconds_max = max(self.stall_seconds_max, stall.duration)
+        self.recent.append(stall)
+        logging.warning(f"Event loop blocked for {stall.duration * 1000:.0f} ms in {_leaf(stall.stack)}\n"
+                        f"  stack: {stall.stack}")
+
+    def render_recent(self) -> str:
+        """Последние зависания: время, длительность, функция и полный стек"""
+        return "".join(f"{time.strftime('%H:%M:%S', time.localtime(stall.started))} "
+                       f"{stall.duration * 1000:.0f} ms {_leaf(stall.stack)}\n  {stall.stack}\n"
+                       for stall in reversed(self.recent))
+
+    def render_metrics(self, prefix: str) -> str:
+        return "\n".join([
+            f"# TYPE {prefix}_loop_stalls_total counter",
+            f"{prefix}_loop_stalls_total {self.stalls_total}",
+            f"# TYPE {prefix}_loop_stall_seconds_max gauge",
+            f"{prefix}_loop_stall_seconds_max {self.stall_seconds_max:.3f}",
+        ]) + "\n"
+
+
+class StartupTimer:
+    """Отметки времени от запуска процесса до первого ответа"""
+
+    def __init__(self, started: Optional[float] = None):
+        # started — time.perf_counter() как можно раньше при запуске, до тяжелых импортов
+        self.started = time.perf_counter() if started is None else started
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str):
+        if phase not in self.phases:
+            self.phases[phase] = time.perf_counter() - self.started
+            logging.info(f"Startup: {phase} after {self.phases[phase] * 1000:.0f} ms")
+
+    def render_metrics(self, prefix: str) -> str:
+        lines = [f"# TYPE {prefix}_startup_phase_seconds gauge"]
+        lines += [f'{prefix}_startup_phase_seconds{{phase="{phase}"}} {seconds:.3f}'
+                  for phase, seconds in self.phases.items()]
+        return "\n".join(lines) + "\n"
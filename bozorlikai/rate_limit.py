@@ -0,0 +1,130 @@
+import time
+from datetime import date
+from typing import Dict
+
+# Как часто удалять полные ведра неактивных пользователей, секунды
+PRUNE_INTERVAL = 600.0
+
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду до capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def try_consume(self, amount: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def charge(self, amount: float):
+        """Списывает фактический расход, даже если уходит в минус (долг)"""
+        self._refill()
+        self.tokens -= amount
+
+    def full(self) -> bool:
+        """Ведро полное: оно не отличается от нового, и его можно забыть"""
+        return self.available() >= self.capacity
+
+
+class UserRateLimiter:
+    """Лимиты на пользователя: сообщения, секунды голосовых, токены модели.
+
+    Токены модели ограничены дважды: ведром (сглаживает всплески) и дневной
+    квотой. Дневной расход считается в памяти; если задан usage_store
+    (ExpenseStore), из него читается расход за день, накопленный до запуска.
+    Записывать расход в хранилище должен вызывающий (в main.py — фоновая
+    очередь), чтобы не блокировать цикл событий. Пользователь сверх лимита на
+    модель не блокируется, а переводится на локальную обработку.
+
+    Ведра создаются на пользователя при первом обращении; раз в PRUNE_INTERVAL
+    полные ведра (пользователь давно ничего не тратил) удаляются.
+    """
+
+    def __init__(self, messages_per_minute: float, voice_seconds_per_hour: float, llm_tokens_per_hour: float,
+                 daily_llm_tokens: int, usage_store=None):
+        self.messages_per_minute = messages_per_minute
+        self.voice_seconds_per_hour = voice_seconds_per_hour
+        self.llm_tokens_per_hour = llm_tokens_per_hour
+        self.daily_llm_tokens = daily_llm_tokens
+        self.usage_store = usage_store
+
+        self._messages: Dict[int, TokenBucket] = {}
+        self._voice: Dict[int, TokenBucket] = {}
+        self._llm: Dict[int, TokenBucket] = {}
+        self._daily_usage: Dict[int, int] = {}
+        self._usage_day = date.today().isoformat()
+        self._pruned = time.monotonic()
+
+    @property
+    def max_voice_seconds(self) -> float:
+        """Самое длинное голосовое, которое вообще можно принять"""
+        return self.voice_seconds_per_hour / 4
+
+    def prune(self):
+        """Удаляет полные ведра"""
+        for buckets in (self._messages, self._voice, self._llm):
+            for user_id in [user_id for user_id, bucket in buckets.items() if bucket.full()]:
+                del buckets[user_id]
+        self._pruned = time.monotonic()
+
+    def _bucket(self, buckets: Dict[int, TokenBucket], user_id: int, per_second: float,
+                capacity: float) -> TokenBucket:
+        if time.monotonic() - self._pruned > PRUNE_INTERVAL:
+            self.prune()
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            bucket = buckets[user_id] = TokenBucket(per_second, capacity)
+        return bucket
+
+    def allow_message(self, user_id: int) -> bool:
+        # Разрешаем всплеск в половину минутного лимита
+        capacity = max(self.messages_per_minute / 2, 1)
+        return self._bucket(self._messages, user_id, self.messages_per_minute / 60, capacity).try_consume()
+
+    def allow_voice(self, user_id: int, seconds: int) -> bool:
+        """Списывает полную длительность; голосовое длиннее max_voice_seconds не принимается никогда"""
+        capacity = self.max_voice_seconds
+        if seconds > capacity:
+            return False
+        return self._bucket(self._voice, user_id, self.voice_seconds_per_hour / 3600, capacity).try_consume(seconds)
+
+    def daily_llm_usage(self, user_id: int) -> int:
+        """Токены модели, потраченные пользователем сегодня"""
+        today = date.today().isoformat()
+        if today != self._usage_day:
+            self._daily_usage.clear()
+            self._usage_day = today
+        if user_id not in self._daily_usage:
+            self._daily_usage[user_id] = self.usage_store.get_llm_usage(user_id, today) if self.usage_store else 0
+        return self._daily_usage[user_id]
+
+    def llm_allowed(self, user_id: int) -> bool:
+        """Можно ли сейчас отправить запрос пользователя в модель"""
+        if self.daily_llm_usage(user_id) >= self.daily_llm_tokens:
+            return False
+        capacity = self.llm_tokens_per_hour / 4
+        return self._bucket(self._llm, user_id, self.llm_tokens_per_hour / 3600, capacity).available() > 0
+
+    def charge_llm_tokens(self, user_id: int, tokens: int) -> str:
+        """Учитывает фактически потраченные токены после ответа модели; возвращает день расхода"""
+        self._daily_usage[user_id] = self.daily_llm_usage(user_id) + tokens
+        capacity = self.llm_tokens_per_hour / 4
+        self._bucket(self._llm, user_id, self.llm_tokens_per_hour / 3600, capacity).charge(tokens)
+        return self._usage_day
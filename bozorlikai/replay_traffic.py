@@ -0,0 +1,315 @@
+"""Воспроизведение записанного трафика для сравнения производительности версий.
+
+Журнал пишут main.py (TRAFFIC_LOG) и chatbot_backend.py (CHAT_TRAFFIC_LOG).
+Обновления подаются в dp бота и в /chat бэкенда в записанном порядке и темпе,
+запросы к моделям получают записанные ответы (с записанной задержкой, деленной
+на --speed). Telegram не вызывается: ответы бота только подсчитываются.
+Бот и бэкенд работают во временном каталоге, настоящая история расходов не
+трогается; лимиты пользователей при воспроизведении сняты.
+
+Примеры:
+    python replay_traffic.py traffic.log
+    python replay_traffic.py traffic.log chat_traffic.log --speed 10
+    python replay_traffic.py traffic.log --speed 0 --json > before.json
+    python replay_traffic.py "traffic.log.w*"    # журналы воркеров sharding.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+from typing import Deque, Dict, List, Optional, Tuple
+
+from traffic_log import (EVENT_LLM, EVENT_UPDATE, SOURCE_BOT, SOURCE_CHAT, expand_traffic_logs, iter_traffic_log,
+                         request_fingerprint)
+
+# Переменные окружения на время воспроизведения: ничего не пишем в боевые файлы и не упираемся в лимиты
+REPLAY_ENV = {
+    "TOKEN": "0:replay",
+    "TRAFFIC_LOG": "",
+    "CHAT_TRAFFIC_LOG": "",
+    "EXPENSES_DB": "",
+    "METRICS_PORT": "",
+    "JOBS_JOURNAL": "",
+    "RATE_MESSAGES_PER_MINUTE": "1000000000",
+    "RATE_VOICE_SECONDS_PER_HOUR": "1000000000",
+    "RATE_LLM_TOKENS_PER_HOUR": "1000000000",
+    "DAILY_LLM_TOKEN_QUOTA": "1000000000",
+}
+
+
+class RecordedHTTPResponse:
+    """Ответ SiliconFlow из журнала в виде, который ожидает chatbot_backend"""
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RecordedLLM:
+    """Отдает записанные ответы моделей по ключу (пользователь, запрос) в порядке записи"""
+
+    def __init__(self, events: List[Dict], speed: float):
+        self.speed = speed
+        self.hits = 0
+        self.misses = 0
+        self._responses: Dict[Tuple[Optional[int], str], Deque[Tuple[Dict, float]]] = defaultdict(deque)
+        self._lock = threading.Lock()
+        for event in events:
+            self._responses[(event.get("p"), event["f"])].append((event["r"], event.get("d", 0.0)))
+
+    def _take(self, user_id: Optional[int], fingerprint: str) -> Dict:
+        with self._lock:
+            queue = self._responses.get((user_id, fingerprint))
+            if not queue:
+                self.misses += 1
+                return {}
+            self.hits += 1
+            response, duration = queue.popleft()
+        # Имитируем задержку модели (вызывается в отдельном потоке)
+        if self.speed > 0:
+            time.sleep(duration / self.speed)
+        return response
+
+    def openai(self, user_id: int, create, **kwargs):
+        """Замена вызова OpenAI в main.call_llm"""
+        response = self._take(user_id, request_fingerprint(kwargs.get("model", ""), kwargs.get("messages")))
+        usage = SimpleNamespace(total_tokens=response.get("tokens", 0), completion_tokens=response.get("out", 0))
+        if "messages" in kwargs:
+            tool_calls = None
+            if "tool" in response:
+                name, arguments = response["tool"]
+                tool_calls = [SimpleNamespace(function=SimpleNamespace(name=name, arguments=arguments))]
+            message = SimpleNamespace(content=response.get("content", ""), tool_calls=tool_calls)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+        return SimpleNamespace(text=response.get("text", ""), usage=None)
+
+    def siliconflow(self, url: str, **kwargs):
+        """Замена requests.post в chatbot_backend"""
+        payload = kwargs["json"]
+        response = self._take(None, request_fingerprint(payload["model"], payload["messages"]))
+        if not response:
+            return RecordedHTTPResponse(503, "replay: no recorded response")
+        return RecordedHTTPResponse(response["status"], response["body"])
+
+
+def _percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def _summary(values: List[float]) -> Dict:
+    return {"count": len(values),
+            "p50_ms": round(_percentile(values, 0.50) * 1000, 1),
+            "p95_ms": round(_percentile(values, 0.95) * 1000, 1),
+            "p99_ms": round(_percentile(values, 0.99) * 1000, 1),
+            "max_ms": round(max(values, default=0.0) * 1000, 1)}
+
+
+def schedule(updates: List[Dict], max_gap: float) -> List[Tuple[float, Dict]]:
+    """Смещения от начала записи; паузы длиннее max_gap (перезапуски, ночь) сжимаются"""
+    result = []
+    offset = 0.0
+    previous = None
+    for event in updates:
+        if previous is not None:
+            offset += min(max(event["t"] - previous, 0.0), max_gap)
+        previous = event["t"]
+        result.append((offset, event))
+    return result
+
+
+class BotTarget:
+    """Подает обновления в dp из main.py без обращений к Telegram"""
+
+    def __init__(self, llm: RecordedLLM):
+        from aiogram import Bot, Dispatcher, types
+        import main
+        from sharding import update_user_id
+
+        self.main = main
+        self.types = types
+        self.update_user_id = update_user_id
+        self.replies = 0
+        self._message_ids = itertools.count(1)
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+
+        main.llm_transport = llm.openai
+        main.bot.request = self._request
+        main.download_voice = self._download_voice
+        Bot.set_current(main.bot)
+        Dispatcher.set_current(main.dp)
+
+    async def _request(self, method: str, data: Optional[Dict] = None, files=None, **kwargs):
+        data = data or {}
+        if method == "getFile":
+            return {"file_id": data.get("file_id", ""), "file_unique_id": data.get("file_id", ""),
+                    "file_path": "voice/replay.ogg"}
+        if method.startswith(("send", "edit")):
+            self.replies += 1
+            return {"message_id": next(self._message_ids), "date": int(time.time()),
+                    "chat": {"id": int(data.get("chat_id") or 0), "type": "private"},
+                    "text": str(data.get("text", ""))}
+        return True
+
+    @staticmethod
+    async def _download_voice(file_id: str, path: str):
+        # Аудио не записывается: распознанный текст придет из журнала
+        open(path, "wb").close()
+
+    async def start(self):
+        await self.main.background_jobs.start()
+
+    async def close(self):
+        await self.main.background_jobs.close()
+
+    async def process(self, update: Dict):
+        # Как в проде (sharding.py): обновления одного пользователя строго по порядку
+        user_id = self.update_user_id(update)
+        if user_id is None:
+            await self.main.dp.process_update(self.types.Update(**update))
+            return
+        lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            await self.main.dp.process_update(self.types.Update(**update))
+
+
+class ChatTarget:
+    """Подает запросы в /chat из chatbot_backend.py через тестовый клиент Flask"""
+
+    def __init__(self, llm: RecordedLLM):
+        import chatbot_backend
+
+        chatbot_backend.llm_transport = llm.siliconflow
+        self.app = chatbot_backend.app
+        self.errors = 0
+
+    def _post(self, body: Dict):
+        with self.app.test_client() as client:
+            if client.post("/chat", json=body).status_code != 200:
+                self.errors += 1
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def process(self, body: Dict):
+        await asyncio.to_thread(self._post, body)
+
+
+async def replay(events: List[Dict], sources: List[str], speed: float, max_gap: float) -> Dict:
+    llm = RecordedLLM([event for event in events if event["k"] == EVENT_LLM], speed)
+    updates = sorted((event for event in events if event["k"] == EVENT_UPDATE and event["s"] in sources),
+                     key=lambda event: event["t"])
+    targets = {}
+    if SOURCE_BOT in sources:
+        targets[SOURCE_BOT] = BotTarget(llm)
+    if SOURCE_CHAT in sources:
+        targets[SOURCE_CHAT] = ChatTarget(llm)
+
+    for target in targets.values():
+        await target.start()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    failures = 0
+
+    async def run(scheduled_at: float, event: Dict):
+        nonlocal failures
+        try:
+            await targets[event["s"]].process(event["u"])
+        except Exception as e:
+            failures += 1
+            logging.error(f"Replay of {event['s']} update failed: {e}")
+        latencies[event["s"]].append(time.perf_counter() - scheduled_at)
+
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    tasks = []
+    for offset, event in schedule(updates, max_gap):
+        if speed > 0:
+            delay = offset / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(loop.create_task(run(time.perf_counter(), event)))
+    await asyncio.gather(*tasks)
+    # Фоновые записи — часть работы версии, их время входит в замер
+    for target in targets.values():
+        await target.close()
+    wall = time.perf_counter() - started
+
+    report = {
+        "updates": len(updates),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_second": round(len(updates) / wall, 2) if wall else 0.0,
+        "failures": failures,
+        "llm_hits": llm.hits,
+        "llm_misses": llm.misses,
+        "sources": {},
+    }
+    for source in sources:
+        recorded = [event["d"] for event in updates if event["s"] == source]
+        report["sources"][source] = {"replayed": _summary(latencies[source]), "recorded": _summary(recorded)}
+    if SOURCE_BOT in targets:
+        report["sources"][SOURCE_BOT]["bot_replies"] = targets[SOURCE_BOT].replies
+    if SOURCE_CHAT in targets:
+        report["sources"][SOURCE_CHAT]["errors"] = targets[SOURCE_CHAT].errors
+    return report
+
+
+def print_report(report: Dict):
+    print(f"Updates: {report['updates']} in {report['wall_seconds']} s "
+          f"({report['throughput_per_second']}/s), failures: {report['failures']}")
+    print(f"LLM responses: {report['llm_hits']} replayed, {report['llm_misses']} missing in log")
+    for source, stats in report["sources"].items():
+        for kind in ("replayed", "recorded"):
+            summary = stats[kind]
+            print(f"  {source:<4} {kind:<8} n={summary['count']:<6} p50={summary['p50_ms']} ms "
+                  f"p95={summary['p95_ms']} ms p99={summary['p99_ms']} ms max={summary['max_ms']} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизвести записанный трафик бота и /chat")
+    parser.add_argument("logs", nargs="+",
+                        help="журналы TRAFFIC_LOG / CHAT_TRAFFIC_LOG (с ротацией) или маски, например traffic.log.w*")
+    parser.add_argument("--target", choices=["all", SOURCE_BOT, SOURCE_CHAT], default="all")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="во сколько раз быстрее записи (0 — без пауз, как можно быстрее)")
+    parser.add_argument("--max-gap", type=float, default=5.0, help="максимальная пауза между обновлениями, сек")
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON для сравнения версий")
+    args = parser.parse_args(argv)
+
+    # Обновления из разных файлов (воркеров) при воспроизведении сортируются по времени
+    events = [event for path in expand_traffic_logs(args.logs) for event in iter_traffic_log(os.path.abspath(path))]
+    present = {event["s"] for event in events if event["k"] == EVENT_UPDATE}
+    sources = sorted(present) if args.target == "all" else [args.target]
+    if not any(source in present for source in sources):
+        raise SystemExit("No updates to replay in the given logs")
+
+    # Боевые модули импортируются уже с подмененным окружением и во временном каталоге
+    os.environ.update(REPLAY_ENV)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="bozorlik-replay-"))
+
+    report = asyncio.run(replay(events, sources, args.speed, args.max_gap))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Многопроцессный режим бота: обновления распределяются по воркерам по user_id.
+
+Фронт (поллинг или прием вебхука) не обрабатывает сообщения сам, а по
+консистентному хешу user_id отправляет каждое обновление в очередь одного из
+N воркеров. Каждый воркер — отдельный процесс со своим dp и своим user_data,
+поэтому сессия пользователя всегда живет в одном процессе, а обновления одного
+пользователя обрабатываются строго по порядку. Общие данные (история расходов)
+должны лежать в EXPENSES_DB — SQLite безопасно делить между процессами; без
+него запускается только один воркер.
+
+Состояние в памяти у каждого воркера свое. Индекс цен и аналитика строятся из
+EXPENSES_DB при запуске, а дальше пополняются только покупками своих
+пользователей: общие (не личные) оценки цен в разных воркерах расходятся до
+перезапуска. Общий предел запросов к модели LLM_MAX_CONCURRENT делится между
+воркерами, поэтому воркеров не бывает больше этого предела.
+
+Примеры:
+    python sharding.py --workers 4
+    python sharding.py --workers 4 --webhook https://example.com/bot --port 8080
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+TOKEN = os.getenv("TOKEN")
+
+# Виртуальных узлов на воркер в кольце хешей
+VIRTUAL_NODES = 160
+
+# Значение LLM_MAX_CONCURRENT по умолчанию, как в main.py
+DEFAULT_LLM_MAX_CONCURRENT = 8
+
+# Поля обновления, в которых Telegram передает автора
+_USER_FIELDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                "shipping_query", "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request")
+
+
+def llm_max_concurrent() -> int:
+    return int(os.getenv("LLM_MAX_CONCURRENT", str(DEFAULT_LLM_MAX_CONCURRENT)))
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Консистентный хеш: при смене числа воркеров переезжает ~1/N пользователей"""
+
+    def __init__(self, workers: int, virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted((_hash(f"worker-{worker}-{node}"), worker)
+                        for worker in range(workers) for node in range(virtual_nodes))
+        self._keys = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    def worker_for(self, user_id: int) -> int:
+        index = bisect.bisect(self._keys, _hash(str(user_id))) % len(self._keys)
+        return self._workers[index]
+
+
+def update_user_id(update: Dict) -> Optional[int]:
+    """Достает id пользователя из сырого обновления Telegram"""
+    for field in _USER_FIELDS:
+        payload = update.get(field)
+        if payload and payload.get("from"):
+            return payload["from"]["id"]
+    return None
+
+
+def route_update(update: Dict, ring: HashRing, queues: List[multiprocessing.Queue]):
+    user_id = update_user_id(update)
+    key = user_id if user_id is not None else update.get("update_id", 0)
+    queues[ring.worker_for(key)].put(update)
+
+
+async def _worker_loop(queue: multiprocessing.Queue):
+    # Импортируем бота только в воркере: у каждого процесса свои dp и user_data
+    from aiogram import Bot, Dispatcher, types
+    import main
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    loop = asyncio.get_running_loop()
+    locks: Dict[int, asyncio.Lock] = {}
+    pending: Dict[int, int] = {}
+    tasks = set()
+
+    async def process(user_id: int, update: types.Update):
+        # Lock отдает очередь в порядке ожидания, так что порядок пользователя сохраняется
+        try:
+            async with locks[user_id]:
+                await main.dp.process_update(update)
+        except Exception as e:
+            logging.error(f"Error processing update {update.update_id}: {e}")
+        finally:
+            pending[user_id] -= 1
+            if not pending[user_id]:
+                del pending[user_id], locks[user_id]
+
+    await main.on_startup(main.dp)
+    while True:
+        data = await loop.run_in_executor(None, queue.get)
+        if data is None:
+            break
+        user_id = update_user_id(data) or 0
+        if user_id not in locks:
+            locks[user_id] = asyncio.Lock()
+            pending[user_id] = 0
+        pending[user_id] += 1
+        task = asyncio.create_task(process(user_id, types.Update(**data)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await main.on_shutdown(main.dp)
+    await main.bot.session.close()
+
+
+def llm_share(index: int, workers: int, limit: int) -> int:
+    """Доля воркера в общем пределе запросов к модели; доли в сумме дают limit"""
+    return limit // workers + (1 if index < limit % workers else 0)
+
+
+def run_worker(index: int, queue: multiprocessing.Queue, workers: int):
+    # Остановкой управляет фронт через сигнальный None в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # LLM_MAX_CONCURRENT — общий предел запросов к модели, а контроллер допуска у каждого воркера свой:
+    # делим предел между воркерами, иначе он вырос бы в workers раз
+    os.environ["LLM_MAX_CONCURRENT"] = str(llm_share(index, workers, llm_max_concurrent()))
+    # У каждого воркера свой порт метрик: METRICS_PORT + номер воркера
+    if os.getenv("METRICS_PORT"):
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    # И свой журнал фоновой очереди: файл нельзя делить между процессами
+    os.environ["JOBS_JOURNAL"] = f"{os.getenv('JOBS_JOURNAL', 'background_jobs.journal')}.{index}"
+    # И свой журнал трафика: процессы, пишущие в один gzip-файл, перемешали бы его блоки и гонялись
+    # при ротации. Суффикс .w<N>, а не .<N>: path.1, path.2 — это старые файлы ротации
+    if os.getenv("TRAFFIC_LOG"):
+        os.environ["TRAFFIC_LOG"] = f"{os.environ['TRAFFIC_LOG']}.w{index}"
+    logging.info(f"Worker {index} started (pid {os.getpid()})")
+    asyncio.run(_worker_loop(queue))
+    logging.info(f"Worker {index} stopped")
+
+
+async def poll_updates(ring: HashRing, queues: List[multiprocessing.Queue], stop: asyncio.Event):
+    from aiogram import Bot
+
+    bot = Bot(token=TOKEN)
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while not stop.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=20)
+            except Exception as e:
+                logging.error(f"Error getting updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                route_update(update.to_python(), ring, queues)
+                offset = update.update_id + 1
+    finally:
+        await bot.session.close()
+
+
+async def serve_webhook(ring: HashRing, queues: List[multiprocessing.Queue], stop: asyncio.Event,
+                        url: str, host: str, port: int):
+    from aiogram import Bot
+    from aiohttp import web
+
+    # Telegram присылает секрет в каждом запросе: без него любой, кто знает URL,
+    # мог бы подделать обновление от имени любого пользователя (в том числе из ADMIN_IDS)
+    secret = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+    async def receive(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, secret):
+            return web.Response(status=401)
+        route_update(await request.json(), ring, queues)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post("/", receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    bot = Bot(token=TOKEN)
+    await bot.set_webhook(url, secret_token=secret)
+    try:
+        await stop.wait()
+    finally:
+        await bot.delete_webhook()
+        await bot.session.close()
+        await runner.cleanup()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run the bot with N worker processes sharded by user_id")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker processes (default: CPU count with EXPENSES_DB, otherwise 1)")
+    parser.add_argument("--webhook", help="public webhook URL; polling is used when omitted")
+    parser.add_argument("--host", default="0.0.0.0", help="webhook listen host")
+    parser.add_argument("--port", type=int, default=8080, help="webhook listen port")
+    args = parser.parse_args(argv)
+
+    if args.workers is None:
+        args.workers = (os.cpu_count() or 1) if os.getenv("EXPENSES_DB") else 1
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not os.getenv("EXPENSES_DB"):
+        # Каждый воркер читает и переписывает shopping_expenses.json целиком: записи соседей потеряются
+        parser.error("EXPENSES_DB must be set to run more than one worker")
+    limit = llm_max_concurrent()
+    if args.workers > limit:
+        logging.warning(f"--workers {args.workers} exceeds LLM_MAX_CONCURRENT={limit}: starting {limit} workers")
+        args.workers = limit
+
+    queues = [multiprocessing.Queue() for _ in range(args.workers)]
+    workers = [multiprocessing.Process(target=run_worker, args=(index, queue, args.workers),
+                                       name=f"bot-worker-{index}")
+               for index, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    ring = HashRing(args.workers)
+
+    async def front():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        if args.webhook:
+            await serve_webhook(ring, queues, stop, args.webhook, args.host, args.port)
+        else:
+            await poll_updates(ring, queues, stop)
+
+    try:
+        asyncio.run(front())
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import json
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Режимы запроса к модели
+MODE_JSON_SCHEMA = "json_schema"  # response_format со строгой схемой
+MODE_TOOLS = "tools"              # вызов функции со строгой схемой параметров
+MODE_OFF = "off"                  # JSON описан только в промпте (прежнее поведение)
+STRUCTURED_MODES = (MODE_JSON_SCHEMA, MODE_TOOLS, MODE_OFF)
+
+EDIT_ACTIONS = ("add", "remove", "replace")
+
+# Короткие имена полей экономят выходные токены: b/n/p — куплено/название/цена,
+# c/a/o/n/q — изменения/действие/старый продукт/новый продукт/количество
+PURCHASE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "b": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"n": {"type": "string"}, "p": {"type": "integer"}},
+                "required": ["n", "p"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["b"],
+    "additionalProperties": False,
+}
+
+EDIT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "c": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "a": {"type": "string", "enum": list(EDIT_ACTIONS)},
+                    "o": {"type": "string"},
+                    "n": {"type": "string"},
+                    "q": {"type": "string"},
+                },
+                "required": ["a", "o", "n", "q"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["c"],
+    "additionalProperties": False,
+}
+
+# Формат ответа задает схема, поэтому промпты короче прежних
+SYSTEM_PROMPT_PURCHASE_STRUCTURED = """
+Определи, какие продукты из списка пользователь купил, и их цену в сумах.
+b — купленные продукты: n — название как в списке, p — цена числом ("20 тысяч", "20.000 сум", "20 тыс" → 20000), 0 если цена не названа.
+Распознавай синонимы ("купил", "взял", "приобрел") и падежи. Продукты не из списка игнорируй. Ничего не куплено — пустой b.
+"""
+
+SYSTEM_PROMPT_EDIT_STRUCTURED = """
+Определи, что пользователь хочет изменить в списке покупок.
+c — изменения: a — действие ("добавь" → add, "удали/убери/не нужно" → remove, "замени/поменяй/измени" → replace),
+o — продукт из списка для remove/replace, n — новый продукт для add/replace, q — количество ("" если не названо).
+Пустые поля — "". Изменений нет — пустой c.
+"""
+
+
+def _price(value: Any) -> Optional[int]:
+    """Цена в сумах или None, если ее нет в ответе (0 — модель сказала, что цена не названа)"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return max(int(value), 0)
+    digits = re.sub(r"\D", "", str(value or ""))
+    return int(digits) if digits else None
+
+
+def _items(data: Any, keys: Tuple[str, ...]) -> List:
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        for key in keys:
+            if isinstance(data.get(key), list):
+                return data[key]
+    return []
+
+
+def normalize_purchases(data: Any) -> List[Dict]:
+    """Ответ в любом из форматов (короткие поля или прежние name/price) -> [{"name", "price"}].
+
+    Элементы без названия или без цены отбрасываются: это обрывок, а не покупка за 0.
+    """
+    purchases = []
+    for item in _items(data, ("b", "products")):
+        if not isinstance(item, dict):
+            continue
+        name = str(item.get("n", item.get("name", "")) or "").strip()
+        price = _price(item.get("p", item.get("price")))
+        if name and price is not None:
+            purchases.append({"name": name, "price": price})
+    return purchases
+
+
+def normalize_edit_changes(data: Any) -> List[Dict]:
+    """Ответ в любом из форматов -> [{"action", "old_product", "new_product", "quantity"}].
+
+    Изменения без нужных действию продуктов (add — новый, remove — старый, replace — оба)
+    отбрасываются.
+    """
+    changes = []
+    for item in _items(data, ("c", "changes")):
+        if not isinstance(item, dict):
+            continue
+        action = str(item.get("a", item.get("action", ""))).strip().lower()
+        if action not in EDIT_ACTIONS:
+            continue
+        change = {
+            "action": action,
+            "old_product": str(item.get("o", item.get("old_product", "")) or "").strip(),
+            "new_product": str(item.get("n", item.get("new_product", "")) or "").strip(),
+            "quantity": str(item.get("q", item.get("quantity", "")) or "").strip(),
+        }
+        if action != "add" and not change["old_product"]:
+            continue
+        if action != "remove" and not change["new_product"]:
+            continue
+        changes.append(change)
+    return changes
+
+
+class StructuredTask(NamedTuple):
+    name: str
+    schema: Dict
+    system_prompt: str
+    normalize: Callable[[Any], List[Dict]]
+
+
+PURCHASE_TASK = StructuredTask("purchases", PURCHASE_SCHEMA, SYSTEM_PROMPT_PURCHASE_STRUCTURED, normalize_purchases)
+EDIT_TASK = StructuredTask("edit_changes", EDIT_SCHEMA, SYSTEM_PROMPT_EDIT_STRUCTURED, normalize_edit_changes)
+
+
+def build_request(task: StructuredTask, mode: str) -> Dict:
+    """Дополнительные параметры chat.completions.create для режима"""
+    if mode == MODE_JSON_SCHEMA:
+        return {"response_format": {"type": "json_schema",
+                                    "json_schema": {"name": task.name, "strict": True, "schema": task.schema}}}
+    if mode == MODE_TOOLS:
+        return {"tools": [{"type": "function",
+                           "function": {"name": task.name, "strict": True, "parameters": task.schema}}],
+                "tool_choice": {"type": "function", "function": {"name": task.name}}}
+    return {}
+
+
+def response_text(completion: Any) -> str:
+    """Текст ответа: аргументы вызова функции или содержимое сообщения"""
+    message = completion.choices[0].message
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        return tool_calls[0].function.arguments or ""
+    return message.content or ""
+
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_PYTHON_LITERAL_RE = re.compile(r"\b(True|False|None)\b")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class JSONExtractor:
+    """Достает первый JSON-объект или массив из потока текста модели.
+
+    Текст подается кусками через feed() (целиком или по мере стриминга).
+    Терпит пояснения и ```json вокруг, висячие запятые и True/False/None.
+    Оборванный ответ обрезается до последнего целого элемента списка
+    (корневого массива или первого массива в корневом объекте) и скобки
+    закрываются: недописанный элемент — название, цена ("p": 120 вместо
+    12000) или замена без нового продукта — не попадет в результат даже
+    частично. repaired показывает, что понадобилась починка.
+    """
+
+    def __init__(self):
+        self._start = -1
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._end = -1
+        # Глубина массива элементов: 1 для корневого массива, 2 для массива в корневом объекте;
+        # 0 — массив еще не встретился, -1 — уже закрыт
+        self._items_depth = 0
+        # Позиции, до которых все элементы списка целые, и открытые там скобки
+        self._cuts: List[Tuple[int, Tuple[str, ...]]] = []
+        self._text = ""
+        self.repaired = False
+
+    @property
+    def complete(self) -> bool:
+        """Объект закрыт, дальше можно не читать"""
+        return self._end >= 0
+
+    def feed(self, chunk: str):
+        if self.complete:
+            return
+        self._text += chunk
+        text = self._text
+        for index in range(self._pos, len(text)):
+            char = text[index]
+            if self._start < 0:
+                if char in _CLOSERS:
+                    self._start = index
+                    self._stack.append(char)
+                    if char == "[":
+                        self._items_depth = 1
+                        self._cuts.append((index + 1, ("[",)))
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in _CLOSERS:
+                self._stack.append(char)
+                if char == "[" and not self._items_depth and len(self._stack) <= 2:
+                    # Обрыв до первого целого элемента дает пустой список
+                    self._items_depth = len(self._stack)
+                    self._cuts.append((index + 1, tuple(self._stack)))
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if not self._stack:
+                    self._end = index + 1
+                    break
+                if len(self._stack) == self._items_depth:
+                    # Закрылся элемент списка
+                    self._cuts.append((index + 1, tuple(self._stack)))
+                elif len(self._stack) == self._items_depth - 1:
+                    # Закрылся сам список: дальше резать внутри объектов незачем
+                    self._cuts.append((index + 1, tuple(self._stack)))
+                    self._items_depth = -1
+            elif char == "," and len(self._stack) == self._items_depth:
+                self._cuts.append((index, tuple(self._stack)))
+        self._pos = len(text)
+
+    @staticmethod
+    def _loads(candidate: str) -> Tuple[Optional[Any], bool]:
+        try:
+            return json.loads(candidate), False
+        except ValueError:
+            pass
+        fixed = _TRAILING_COMMA_RE.sub(r"\1", candidate)
+        fixed = _PYTHON_LITERAL_RE.sub(lambda match: _PYTHON_LITERALS[match.group(1)], fixed)
+        try:
+            return json.loads(fixed), True
+        except ValueError:
+            return None, True
+
+    @staticmethod
+    def _close(body: str, stack: Tuple[str, ...]) -> str:
+        return body + "".join(_CLOSERS[opener] for opener in reversed(stack))
+
+    def close(self) -> Optional[Any]:
+        """Разобранное значение или None, если JSON в тексте не найден"""
+        if self._start < 0:
+            return None
+        if self.complete:
+            value, self.repaired = self._loads(self._text[self._start:self._end])
+            return value
+
+        # Оборванный ответ
+        self.repaired = True
+        for index, stack in reversed(self._cuts):
+            value, _ = self._loads(self._close(self._text[self._start:index], stack))
+            if value is not None:
+                return value
+        return None
+
+
+def extract_json(text: str) -> Tuple[Optional[Any], bool]:
+    """(значение, понадобилась ли починка) из полного текста ответа"""
+    extractor = JSONExtractor()
+    extractor.feed(text)
+    return extractor.close(), extractor.repaired
+
+
+class StructuredOutputStats:
+    """Счетчики разбора ответов модели по задаче и режиму: отказы, повторы, починки, выходные токены"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._counters: Dict[Tuple[str, str], Dict[str, int]] = {}
+
+    def _counter(self, task: str, mode: str) -> Dict[str, int]:
+        key = (task, mode)
+        if key not in self._counters:
+            self._counters[key] = {"requests": 0, "parse_failures": 0, "repaired": 0, "retries": 0,
+                                   "failed": 0, "output_tokens": 0}
+        return self._counters[key]
+
+    def record_attempt(self, task: str, mode: str, parsed: bool, repaired: bool, retry: bool, output_tokens: int):
+        counter = self._counter(task, mode)
+        counter["requests"] += 1
+        counter["output_tokens"] += output_tokens
+        if retry:
+            counter["retries"] += 1
+        if not parsed:
+            counter["parse_failures"] += 1
+        elif repaired:
+            counter["repaired"] += 1
+
+    def record_failure(self, task: str, mode: str):
+        """Все попытки исчерпаны, пользователь получит "не понял\""""
+        self._counter(task, mode)["failed"] += 1
+
+    def snapshot(self) -> Dict:
+        return {f"{task}/{mode}": dict(counter) for (task, mode), counter in self._counters.items()}
+
+    def render_metrics(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        prefix = f"{self.name}_structured_output"
+        lines = []
+        for metric in ("requests", "parse_failures", "repaired", "retries", "failed", "output_tokens"):
+            lines.append(f"# TYPE {prefix}_{metric}_total counter")
+            lines += [f'{prefix}_{metric}_total{{task="{task}",mode="{mode}"}} {counter[metric]}'
+                      for (task, mode), counter in self._counters.items()]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from admission import PRIORITY_CHAT, PRIORITY_UPDATE, AdmissionController, Overloaded
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_waiter_is_shed_after_deadline():
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, queue_deadline=0.01)
+        await controller.acquire(PRIORITY_CHAT)
+        with pytest.raises(Overloaded):
+            await controller.acquire(PRIORITY_CHAT)
+        controller.release()
+        return controller
+
+    controller = run(scenario())
+    assert controller.active == 0
+    assert controller.shed[PRIORITY_CHAT] == 1
+    assert controller.queued[PRIORITY_CHAT] == 0
+
+
+def test_higher_priority_is_admitted_first():
+    order = []
+
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, queue_deadline=1.0)
+        await controller.acquire(PRIORITY_CHAT)
+
+        async def wait(priority, name):
+            async with controller.slot(priority):
+                order.append(name)
+
+        chat = asyncio.create_task(wait(PRIORITY_CHAT, "chat"))
+        await asyncio.sleep(0)
+        update = asyncio.create_task(wait(PRIORITY_UPDATE, "update"))
+        await asyncio.sleep(0)
+        controller.release()
+        await asyncio.gather(chat, update)
+        return controller
+
+    controller = run(scenario())
+    assert order == ["update", "chat"]
+    assert controller.active == 0
+
+
+def test_one_users_backlog_does_not_delay_others():
+    order = []
+
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, queue_deadline=1.0)
+        await controller.acquire(PRIORITY_CHAT)
+
+        async def wait(user_id, name):
+            async with controller.slot(PRIORITY_CHAT, user_id):
+                order.append(name)
+
+        tasks = []
+        for user_id, name in ((1, "a1"), (1, "a2"), (2, "b1")):
+            tasks.append(asyncio.create_task(wait(user_id, name)))
+            await asyncio.sleep(0)
+        controller.release()
+        await asyncio.gather(*tasks)
+
+    run(scenario())
+    assert order == ["a1", "b1", "a2"]
+
+
+def test_cancelled_waiter_releases_granted_slot():
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, queue_deadline=1.0)
+        await controller.acquire(PRIORITY_CHAT)
+        waiter = asyncio.create_task(controller.acquire(PRIORITY_CHAT))
+        await asyncio.sleep(0)
+        # Слот передан ждущему, и в тот же момент его отменяют
+        controller.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        # Если отмена опоздала и acquire успел вернуться, слот у ждущего и он его отдает сам
+        if not waiter.cancelled():
+            controller.release()
+        return controller
+
+    controller = run(scenario())
+    assert controller.active == 0
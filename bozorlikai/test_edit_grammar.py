@@ -0,0 +1,54 @@
+from edit_grammar import parse_edit_commands
+
+PRODUCTS = {"Огурцы": "1 кг", "Картошка": "2 кг", "Молоко": "1 литр", "Olma": "1 kg"}
+
+
+def test_simple_commands_are_parsed_locally():
+    assert parse_edit_commands("добавь хлеб 2 шт", PRODUCTS) == [
+        {"action": "add", "old_product": "", "new_product": "Хлеб", "quantity": "2 шт"}]
+    assert parse_edit_commands("удали картошку", PRODUCTS) == [
+        {"action": "remove", "old_product": "Картошка", "new_product": "", "quantity": ""}]
+    assert parse_edit_commands("замени молоко на кефир", PRODUCTS) == [
+        {"action": "replace", "old_product": "Молоко", "new_product": "Кефир", "quantity": "1 литр"}]
+
+
+def test_inflected_name_goes_to_model():
+    # "Огурцов" задублировал бы "Огурцы"
+    assert parse_edit_commands("добавь 2 кг огурцов", PRODUCTS) is None
+    assert parse_edit_commands("замени картошку на колбасу", PRODUCTS) is None
+
+
+def test_free_text_goes_to_model():
+    assert parse_edit_commands("добавь что-нибудь вкусное на ужин", PRODUCTS) is None
+    assert parse_edit_commands("добавь что-нибудь", PRODUCTS) is None
+
+
+def test_multi_word_name_goes_to_model():
+    assert parse_edit_commands("добавь красную рыбу", PRODUCTS) is None
+
+
+def test_existing_product_goes_to_model():
+    assert parse_edit_commands("добавь огурцы", PRODUCTS) is None
+
+
+def test_uzbek_commands_match_only_uzbek_names():
+    assert parse_edit_commands("olmani o'chir", PRODUCTS) == [
+        {"action": "remove", "old_product": "Olma", "new_product": "", "quantity": ""}]
+    # "Картошка" записана по-русски: решает модель
+    assert parse_edit_commands("kartoshkani o'chir", PRODUCTS) is None
+    assert parse_edit_commands("kartoshkani piyozga almashtir", PRODUCTS) is None
+
+
+def test_name_after_quantity_goes_to_model():
+    # После количества название в родительном падеже: "Сахара", "Лука" вместо "Сахар", "Лук"
+    for text in ("добавь 2 кг сахара", "добавь 1 кг лука", "добавь 2 пачки масла", "добавь полкило мяса",
+                 "добавь 10 яиц", "замени картошку на 2 кг лука"):
+        assert parse_edit_commands(text, PRODUCTS) is None, text
+
+
+def test_prefix_match_goes_to_model():
+    products = {"Рисовая мука": "1 кг", "Огурцы": "1 кг"}
+    assert parse_edit_commands("удали рис", products) is None
+    assert parse_edit_commands("замени рис на хлеб", products) is None
+    assert parse_edit_commands("удали огурцы", products) == [
+        {"action": "remove", "old_product": "Огурцы", "new_product": "", "quantity": ""}]
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from expense_stream import ExpenseStreamReader
+
+EXPENSES = {
+    "1": [{"date": "2026-10-01 10:00:00", "total_cost": 5000,
+           "items": [{"product": "Хлеб", "quantity": "1 шт", "category": "📦 Бакалея", "price": 5000}]},
+          {"date": "2026-10-02 10:00:00", "total_cost": 0, "items": []}],
+    "2": [],
+    "3": [{"date": "2026-10-03 10:00:00", "total_cost": 12000, "items": []}],
+}
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_records_in_file_order_with_small_chunks(tmp_path):
+    path = write(tmp_path / "expenses.json", json.dumps(EXPENSES, ensure_ascii=False, indent=2))
+    # Блок в 7 байт режет и названия, и многобайтные символы кириллицы
+    reader = ExpenseStreamReader(path, chunk_size=7)
+    expected = [(user_id, record) for user_id, records in EXPENSES.items() for record in records]
+    assert list(reader) == expected
+    assert reader.records_read == 3
+    assert reader.progress == 1.0
+
+
+def test_empty_object_and_bom(tmp_path):
+    assert list(ExpenseStreamReader(write(tmp_path / "empty.json", " {} "))) == []
+    path = tmp_path / "bom.json"
+    path.write_bytes(b"\xef\xbb\xbf" + json.dumps({"1": [{"date": "d"}]}).encode())
+    assert list(ExpenseStreamReader(str(path))) == [("1", {"date": "d"})]
+
+
+def test_truncated_file_raises(tmp_path):
+    text = json.dumps(EXPENSES, ensure_ascii=False)
+    reader = ExpenseStreamReader(write(tmp_path / "cut.json", text[:len(text) // 2]), chunk_size=16)
+    with pytest.raises(ValueError):
+        list(reader)
@@ -0,0 +1,145 @@
+import asyncio
+import json
+
+import jobs
+from jobs import JobQueue
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_failed_job_is_retried(monkeypatch):
+    monkeypatch.setattr(jobs, "RETRY_DELAY", 0)
+    calls = []
+
+    def flaky(payload):
+        calls.append(payload)
+        if len(calls) < jobs.MAX_ATTEMPTS:
+            raise OSError("disk busy")
+
+    async def scenario():
+        queue = JobQueue("test")
+        queue.register("write", flaky)
+        await queue.start()
+        await queue.submit("write", 1)
+        await queue.close()
+        return queue.snapshot()
+
+    snapshot = run(scenario())
+    assert calls == [1] * jobs.MAX_ATTEMPTS
+    assert snapshot["completed"] == {"write": 1}
+    assert snapshot["failed"] == {"write": 0}
+
+
+def test_on_success_runs_once_after_retries(monkeypatch):
+    monkeypatch.setattr(jobs, "RETRY_DELAY", 0)
+    attempts = []
+    applied = []
+
+    def flaky(payload):
+        attempts.append(payload)
+        if len(attempts) == 1:
+            raise OSError("disk busy")
+
+    async def scenario():
+        queue = JobQueue("test", batch_window=0.01)
+        queue.register("expense", flaky, batch=True, on_success=applied.append)
+        await queue.start()
+        await asyncio.gather(queue.submit("expense", "a"), queue.submit("expense", "b"))
+        await queue.close()
+
+    run(scenario())
+    assert len(attempts) == 2
+    assert applied == [["a", "b"]]
+
+
+def test_durable_job_failing_every_attempt_is_dead_lettered(monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "RETRY_DELAY", 0)
+    journal = str(tmp_path / "jobs.journal")
+
+    def broken(payload):
+        raise OSError("disk full")
+
+    async def scenario():
+        queue = JobQueue("test", journal_path=journal)
+        queue.register("expense", broken, batch=True, durable=True)
+        await queue.start()
+        await queue.submit("expense", {"user_id": 1})
+        await queue.close()
+        return queue.snapshot()
+
+    snapshot = run(scenario())
+    assert snapshot["dead_lettered"] == 1
+    with open(journal + ".failed", encoding="utf-8") as f:
+        failed = [json.loads(line) for line in f]
+    assert [(entry["kind"], entry["payload"], entry["error"]) for entry in failed] == [
+        ("expense", {"user_id": 1}, "disk full")]
+
+    # Отказ не возвращается в очередь при следующем запуске
+    async def restart():
+        queue = JobQueue("test", journal_path=journal)
+        queue.register("expense", broken, batch=True, durable=True)
+        await queue.start()
+        pending = queue.snapshot()["pending_durable"]
+        await queue.close()
+        return pending
+
+    assert run(restart()) == 0
+
+
+def test_unfinished_durable_jobs_are_replayed_from_journal(tmp_path):
+    journal = str(tmp_path / "jobs.journal")
+    done = []
+
+    async def crash():
+        queue = JobQueue("test", journal_path=journal)
+        started = asyncio.Event()
+
+        async def stuck(payload):
+            started.set()
+            await asyncio.Event().wait()
+
+        queue.register("expense", stuck, batch=True, durable=True)
+        await queue.start()
+        for payload in range(3):
+            await queue.submit("expense", payload)
+        await started.wait()
+        # Процесс "упал" посреди записи: воркеры остановлены, close() не вызван
+        for task in queue._tasks:
+            task.cancel()
+        await asyncio.gather(*queue._tasks, return_exceptions=True)
+
+    async def restart():
+        queue = JobQueue("test", journal_path=journal)
+
+        async def write(payloads):
+            done.extend(payloads)
+
+        queue.register("expense", write, batch=True, durable=True)
+        await queue.start()
+        await queue.close()
+
+    run(crash())
+    run(restart())
+    assert sorted(done) == [0, 1, 2]
+
+
+def test_batches_of_one_kind_keep_submission_order():
+    written = []
+
+    async def write(payloads):
+        # Пачки разного размера выполняются разное время: без упорядочивания они бы обгоняли друг друга
+        await asyncio.sleep(0.001 * (len(payloads) % 3))
+        written.extend(payloads)
+
+    async def scenario():
+        queue = JobQueue("test", workers=3, batch_size=4, batch_window=0.001)
+        queue.register("expense", write, batch=True)
+        await queue.start()
+        for payload in range(40):
+            await queue.submit("expense", payload)
+        await queue.close()
+
+    run(scenario())
+    assert written == list(range(40))
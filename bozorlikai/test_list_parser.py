@@ -0,0 +1,33 @@
+from list_parser import ListParser, parse_list_output
+
+RESPONSE = "🥕 Овощи:\n• Картошка — 2 кг\n• Лук — 1 кг\n\n🥛 Молочные продукты:\n• Молоко — 1 литр\n"
+
+
+def test_list_with_emoji_headers():
+    parsed = parse_list_output(RESPONSE)
+    assert parsed.is_list
+    assert parsed.categories == {
+        "🥕 Овощи": [("Картошка", "2 кг", False, 0), ("Лук", "1 кг", False, 0)],
+        "🥛 Молочные продукты": [("Молоко", "1 литр", False, 0)],
+    }
+
+
+def test_headers_without_emoji_and_dash_bullets_are_fixed():
+    parsed = parse_list_output("Овощи:\n- Морковь - 1 кг\nБакалея и молоко:\n- Сыр - 200 г")
+    assert parsed.is_list
+    assert parsed.text == "🥕 Овощи:\n• Морковь - 1 кг\n🥛 Молочные продукты:\n• Сыр - 200 г"
+    assert parsed.categories == {"🥕 Овощи": [("Морковь", "1 кг", False, 0)],
+                                 "🥛 Молочные продукты": [("Сыр", "200 г", False, 0)]}
+
+
+def test_plain_reply_is_not_a_list():
+    parsed = parse_list_output("Извините, я могу помочь только со списком базара.")
+    assert not parsed.is_list
+    assert parsed.categories == {}
+
+
+def test_chunks_split_mid_line_match_whole_text():
+    parser = ListParser()
+    for index in range(0, len(RESPONSE), 5):
+        parser.feed(RESPONSE[index:index + 5])
+    assert parser.close() == parse_list_output(RESPONSE)
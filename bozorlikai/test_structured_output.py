@@ -0,0 +1,41 @@
+from structured_output import JSONExtractor, extract_json, normalize_edit_changes, normalize_purchases
+
+
+def test_truncated_response_keeps_only_whole_items():
+    data, repaired = extract_json('{"b":[{"n":"хлеб","p":5000},{"n":"сыр","p":120')
+    assert repaired
+    assert data == {"b": [{"n": "хлеб", "p": 5000}]}
+
+
+def test_truncated_first_item_gives_empty_list():
+    data, repaired = extract_json('{"c":[{"a":"replace","o":"лук","n":"гру')
+    assert repaired
+    assert data == {"c": []}
+
+
+def test_truncated_bare_array():
+    assert extract_json('[{"name":"a","price":1},{"name":"b",') == ([{"name": "a", "price": 1}], True)
+
+
+def test_prose_fence_and_python_literals():
+    text = 'Вот ответ:\n```json\n{"b": [{"n": "молоко", "p": 12000},], "ok": True}\n```'
+    assert extract_json(text) == ({"b": [{"n": "молоко", "p": 12000}], "ok": True}, True)
+    assert extract_json("не понял") == (None, False)
+
+
+def test_streamed_chunks_stop_at_end_of_object():
+    extractor = JSONExtractor()
+    for chunk in ('{"b":[{"n":"хлеб",', '"p":5000}]}', ' и еще текст {"x": 1}'):
+        extractor.feed(chunk)
+    assert extractor.complete
+    assert extractor.close() == {"b": [{"n": "хлеб", "p": 5000}]}
+
+
+def test_items_missing_required_fields_are_dropped():
+    assert normalize_purchases({"b": [{"n": "хлеб"}, {"n": "сыр", "p": 0}, {"n": "", "p": 5}]}) == [
+        {"name": "сыр", "price": 0}]
+    assert normalize_edit_changes({"c": [
+        {"a": "replace", "o": "лук", "n": ""},
+        {"a": "remove", "o": ""},
+        {"a": "add", "o": "", "n": "хлеб", "q": "1 шт"},
+    ]}) == [{"action": "add", "old_product": "", "new_product": "хлеб", "quantity": "1 шт"}]
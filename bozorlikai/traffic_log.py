@@ -0,0 +1,237 @@
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+# Виды событий в журнале
+EVENT_UPDATE = "update"  # входящее сообщение (бот или /chat)
+EVENT_LLM = "llm"        # запрос к модели и ее ответ
+
+SOURCE_BOT = "bot"
+SOURCE_CHAT = "chat"
+
+# Поля с персональными данными: удаляются целиком
+DROP_KEYS = {"first_name", "last_name", "username", "phone_number", "title", "bio", "contact", "location",
+             "venue", "photo", "entities", "caption_entities"}
+# Идентификаторы пользователей и чатов внутри этих объектов заменяются псевдонимами
+PSEUDONYM_PARENTS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+# Ссылки на файлы Telegram (по ним можно скачать голосовое) заменяются хешем
+HASHED_KEYS = {"file_id", "file_unique_id"}
+
+_PHONE_RE = re.compile(r"\+?\d[\d\s\-()]{7,}\d")
+MIN_PHONE_DIGITS = 9
+PHONE_MASK = "<phone>"
+
+
+def mask_text(text: str) -> str:
+    """Скрывает номера телефонов, цены и количества оставляет как есть"""
+    def replace(match):
+        digits = sum(char.isdigit() for char in match.group(0))
+        return PHONE_MASK if digits >= MIN_PHONE_DIGITS else match.group(0)
+    return _PHONE_RE.sub(replace, text)
+
+
+class Anonymizer:
+    """Заменяет идентификаторы стабильными псевдонимами (HMAC с солью).
+
+    С одной и той же солью пользователь получает один и тот же псевдоним во
+    всех файлах журнала; без соли она случайная для каждого запуска.
+    """
+
+    def __init__(self, salt: Optional[str] = None):
+        self.salt = (salt or secrets.token_hex(16)).encode()
+
+    def _digest(self, value: Any) -> bytes:
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def pseudonym(self, value: int) -> int:
+        # Положительное число, помещается в int32 — aiogram и Telegram примут его как id
+        return int.from_bytes(self._digest(value)[:4], "big") & 0x7FFFFFFF
+
+    def token(self, value: str) -> str:
+        return self._digest(value)[:12].hex()
+
+    def update(self, data: Any, parent: str = "") -> Any:
+        if isinstance(data, dict):
+            result = {}
+            for key, value in data.items():
+                if key in DROP_KEYS:
+                    continue
+                if key == "id" and parent in PSEUDONYM_PARENTS and isinstance(value, int):
+                    result[key] = self.pseudonym(value)
+                elif key in HASHED_KEYS and isinstance(value, str):
+                    result[key] = self.token(value)
+                else:
+                    result[key] = self.update(value, key)
+            return result
+        if isinstance(data, list):
+            return [self.update(value, parent) for value in data]
+        if isinstance(data, str):
+            return mask_text(data)
+        return data
+
+
+def request_fingerprint(model: str, messages: Optional[List[Dict]] = None) -> str:
+    """Ключ запроса к модели для поиска записанного ответа при воспроизведении.
+
+    Системные промпты не учитываются, чтобы записи подходили и после их правки.
+    Для распознавания речи ключ — только модель (ответы берутся по порядку).
+    """
+    payload = [model]
+    for message in messages or []:
+        if message.get("role") != "system":
+            payload.append([message.get("role"), mask_text(str(message.get("content", "")))])
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+def describe_llm_response(result: Any) -> Dict:
+    """Сжатое описание ответа OpenAI (чат или распознавание речи)"""
+    response: Dict[str, Any] = {}
+    choices = getattr(result, "choices", None)
+    if choices:
+        message = choices[0].message
+        response["content"] = mask_text(message.content or "")
+        tool_calls = getattr(message, "tool_calls", None)
+        if tool_calls:
+            response["tool"] = [tool_calls[0].function.name, mask_text(tool_calls[0].function.arguments or "")]
+    elif hasattr(result, "text"):
+        response["text"] = mask_text(result.text or "")
+    usage = getattr(result, "usage", None)
+    if usage is not None and getattr(usage, "total_tokens", None):
+        response["tokens"] = usage.total_tokens
+        response["out"] = getattr(usage, "completion_tokens", None) or 0
+    return response
+
+
+class TrafficRecorder:
+    """Пишет обезличенный трафик в сжатый журнал с ротацией.
+
+    Каждое событие — строка JSON в gzip-файле: {"k": вид, "t": время, ...}.
+    Когда файл превышает max_bytes, он сдвигается в path.1, path.1 в path.2
+    и т.д., хранится не больше backups старых файлов. Буфер сжатия сбрасывается
+    на диск раз в flush_interval секунд, при аварийном выходе теряется хвост.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024, backups: int = 5,
+                 salt: Optional[str] = None, flush_interval: float = 5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.anonymizer = Anonymizer(salt)
+        self.events = 0
+        self._lock = threading.Lock()
+        self._raw = None
+        self._gzip = None
+        self._flushed = time.monotonic()
+        self._open()
+
+    def _open(self):
+        self._raw = open(self.path, "ab")
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode="ab")
+
+    def _close_file(self):
+        self._gzip.close()
+        self._raw.close()
+
+    def _rotate(self):
+        self._close_file()
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, event: Dict):
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._gzip.write(line.encode())
+            self.events += 1
+            now = time.monotonic()
+            if now - self._flushed >= self.flush_interval:
+                self._gzip.flush()
+                self._flushed = now
+            if self._raw.tell() >= self.max_bytes:
+                self._rotate()
+
+    def record_update(self, source: str, update: Dict, started: float, duration: float):
+        """Входящее сообщение: started — time.time() начала обработки, duration — секунды"""
+        try:
+            self._write({"k": EVENT_UPDATE, "s": source, "t": round(started, 4), "d": round(duration, 4),
+                         "u": self.anonymizer.update(update)})
+        except Exception as e:
+            logging.error(f"Traffic recorder failed to write update: {e}")
+
+    def record_llm(self, user_id: Optional[int], fingerprint: str, response: Dict, started: float,
+                   duration: float):
+        """Ответ модели на запрос с ключом fingerprint"""
+        try:
+            self._write({"k": EVENT_LLM, "t": round(started, 4), "d": round(duration, 4),
+                         "p": self.anonymizer.pseudonym(user_id) if user_id is not None else None,
+                         "f": fingerprint, "r": response})
+        except Exception as e:
+            logging.error(f"Traffic recorder failed to write LLM call: {e}")
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+
+def traffic_log_files(path: str) -> List[str]:
+    """Файлы журнала от старых к новым"""
+    rotated = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        rotated.append(f"{path}.{index}")
+        index += 1
+    files = list(reversed(rotated))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def expand_traffic_logs(patterns: List[str]) -> List[str]:
+    """Пути и маски журналов -> основные файлы (старые файлы ротации читает iter_traffic_log).
+
+    "traffic.log.w*" отдает журналы всех воркеров sharding.py; файлы ротации
+    path.1, path.2 отбрасываются, если в списке есть сам path.
+    """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches or [pattern])
+    listed = set(paths)
+    result = []
+    for path in paths:
+        base, _, suffix = path.rpartition(".")
+        if suffix.isdigit() and base in listed:
+            continue
+        if path not in result:
+            result.append(path)
+    return result
+
+
+def iter_traffic_log(path: str) -> Iterator[Dict]:
+    """События журнала с учетом ротации. Оборванный хвост (аварийный выход) пропускается"""
+    for file_path in traffic_log_files(path):
+        with gzip.open(file_path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Skipping damaged traffic log line in {file_path}")
+            except (EOFError, OSError) as e:
+                logging.warning(f"Traffic log {file_path} is truncated: {e}")